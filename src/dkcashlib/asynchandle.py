@@ -0,0 +1,201 @@
+"""An asyncio interface to `dkhandle.Connection`.
+
+`AsyncConnection` offers the find, report and interest operations of a
+`dkhandle.Connection` as coroutines, for use in asyncio applications (e.g. a web
+frontend), without blocking the event loop.
+
+The blocking work runs in two bounded thread pools:
+
+- Reads run in a pool of up to `readers` threads.  Each thread opens its own
+  read-only books (see `dkdata._opened_book`), so concurrent reads do not share
+  a SQLite connection.  They are not isolated from writes, though: an operation
+  which reads several times (e.g. the reports) may see a write which was
+  committed in between.
+- Writes run in a single thread, one after the other, because SQLite only allows
+  one writer at a time.  Reads are not blocked by waiting writes.
+
+The number of operations which are submitted but not done yet is limited by
+`max_pending`, further calls wait until there is room.
+
+Cancelling an operation (e.g. with `asyncio.wait_for`) which did not start yet
+removes it from the queue.  An operation which already runs in its thread can
+not be interrupted, it is finished in the background, with the exception of
+`generate_report` and `generate_account_statements`: They stop after the
+current creditor, or with several workers, after the renders which already
+started.
+
+Example::
+
+    async with AsyncConnection("kredite.gnucash") as connection:
+        creditors, due = await asyncio.gather(
+            connection.find_creditors(), connection.next_due_dates())
+
+The returned creditors and contracts belong to the synchronous `connection`
+attribute, their own methods block.
+"""
+
+import asyncio
+import concurrent.futures
+import functools
+import threading
+
+from . import dkhandle
+
+
+def _reader(name):
+    """Return a coroutine method which runs `dkhandle.Connection.<name>` as a
+read."""
+    async def method(self, *args, **kwargs):
+        return await self.run_read(getattr(dkhandle.Connection, name), *args,
+                                   **kwargs)
+    method.__name__ = name
+    method.__doc__ = "Coroutine version of `dkhandle.Connection.{}`.".format(
+        name)
+    return method
+
+
+def _writer(name):
+    """Like `_reader`, but the method runs as a write."""
+    async def method(self, *args, **kwargs):
+        return await self.run_write(getattr(dkhandle.Connection, name), *args,
+                                    **kwargs)
+    method.__name__ = name
+    method.__doc__ = "Coroutine version of `dkhandle.Connection.{}`.".format(
+        name)
+    return method
+
+
+class AsyncConnection:
+    """Coroutine versions of the `dkhandle.Connection` operations.
+
+Attributes
+----------
+connection : dkhandle.Connection
+    The synchronous connection which does the work.
+    """
+
+    def __init__(self, gnucash_file="dkcash_data.sql", readers=4,
+                 max_pending=64, **kwargs):
+        """Create the connection.  This opens the file, so it blocks.
+
+Parameters
+----------
+gnucash_file : str, optional
+    The GnuCash file, see `dkhandle.Connection`.
+
+readers : int, optional
+    The maximum number of concurrent reads.  Default is 4.
+
+max_pending : int, optional
+    The maximum number of submitted operations which are not done yet.  Default
+    is 64.
+
+**kwargs :
+    Passed on to `dkhandle.Connection`, e.g. `base_dk`.
+        """
+        if readers < 1 or max_pending < 1:
+            raise ValueError("`readers` and `max_pending` must be at least 1.")
+        self.connection = dkhandle.Connection(gnucash_file=gnucash_file,
+                                              **kwargs)
+        self._readers = concurrent.futures.ThreadPoolExecutor(
+            max_workers=readers, thread_name_prefix="dkcash-read")
+        self._writer = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="dkcash-write")
+        self._max_pending = max_pending
+        self._pending = None
+
+    @classmethod
+    async def open(cls, *args, **kwargs):
+        """Create the connection without blocking the event loop."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, functools.partial(cls, *args, **kwargs))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def close(self):
+        """Wait for the running operations, cancel the queued ones."""
+        loop = asyncio.get_running_loop()
+        for executor in (self._readers, self._writer):
+            await loop.run_in_executor(None, functools.partial(
+                executor.shutdown, wait=True, cancel_futures=True))
+
+    async def _run(self, executor, function, *args, **kwargs):
+        # The semaphore is created here, it must belong to the running loop.
+        if self._pending is None:
+            self._pending = asyncio.Semaphore(self._max_pending)
+        async with self._pending:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(executor, functools.partial(
+                function, self.connection, *args, **kwargs))
+
+    async def run_read(self, function, *args, **kwargs):
+        """Run `function(connection, *args, **kwargs)` in a reader thread.
+
+`function` must not change the file.
+        """
+        return await self._run(self._readers, function, *args, **kwargs)
+
+    async def run_write(self, function, *args, **kwargs):
+        """Run `function(connection, *args, **kwargs)` in the writer thread."""
+        return await self._run(self._writer, function, *args, **kwargs)
+
+    async def _run_report(self, function, *args, progress=None, **kwargs):
+        """Run a report generating `function`, which takes a `progress`
+callback, as a read which can be cancelled between creditors.
+
+`progress` is called in the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        cancelled = threading.Event()
+
+        def report_progress(done, total, creditor_id):
+            if cancelled.is_set():
+                raise concurrent.futures.CancelledError()
+            if progress is not None:
+                loop.call_soon_threadsafe(progress, done, total, creditor_id)
+
+        try:
+            return await self.run_read(function, *args,
+                                       progress=report_progress, **kwargs)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    find_creditors = _reader("find_creditors")
+    find_contracts = _reader("find_contracts")
+    find_creditors_page = _reader("find_creditors_page")
+    find_contracts_page = _reader("find_contracts_page")
+    search_creditors = _reader("search_creditors")
+    balances = _reader("balances")
+    contract_balances = _reader("contract_balances")
+    calculate_interests = _reader("calculate_interests")
+    next_due_dates = _reader("next_due_dates")
+    forecast = _reader("forecast")
+    generate_spreadsheet = _reader("generate_spreadsheet")
+    delete_creditors = _writer("delete_creditors")
+
+    async def generate_report(self, directory, year=None, workers=None,
+                              progress=None, **kwargs):
+        """Coroutine version of `dkhandle.Connection.generate_report`.
+
+`progress` is called in the event loop.  If the coroutine is cancelled, no more
+reports are written.
+        """
+        return await self._run_report(
+            dkhandle.Connection.generate_report, directory, year=year,
+            workers=workers, progress=progress, **kwargs)
+
+    async def generate_account_statements(self, directory=None, start=None,
+                                          end=None, workers=None,
+                                          progress=None, **kwargs):
+        """Coroutine version of
+`dkhandle.Connection.generate_account_statements`, like `generate_report`.
+        """
+        return await self._run_report(
+            dkhandle.Connection.generate_account_statements, directory,
+            start=start, end=end, workers=workers, progress=progress, **kwargs)
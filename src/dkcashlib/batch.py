@@ -0,0 +1,246 @@
+"""Run DKCash tasks on many GnuCash files at once.
+
+Projects usually keep one GnuCash file each, so year-end processing means doing
+the same work for dozens of files.  The files are independent from each other,
+therefore each one is handled by its own worker process and the results are
+collected into one consolidated summary.
+
+Example::
+
+    python3 -m dkcashlib.batch -t summary interest -- projects/*.gnucash
+
+The interest is only calculated, not booked: DKCash has no booking of interest
+into GnuCash yet, so there is no batch task for it either.
+"""
+
+import argparse
+import concurrent.futures
+import datetime
+import glob
+import os
+import re
+
+from . import dkhandle
+
+# Task name -> name of the `dkhandle.Connection` method which does the work.
+TASKS = {
+    "summary": None,
+    "interest": "calculate_interests",
+    "export": "generate_spreadsheet",
+    "statements": "generate_account_statements",
+}
+
+# The backups which piecash writes when opening a file for writing:
+# `<file>.YYYYmmddHHMMSS.gnucash`.
+_BACKUP_PATTERN = re.compile(r"\.\d{14}\.gnucash$")
+
+
+def expand_files(patterns):
+    """Expand file names and glob patterns into a list of file names.
+
+The order of `patterns` is kept, duplicates are removed.  Patterns which do not
+match anything are kept verbatim, so that missing files show up in the summary
+instead of being ignored silently.  The backups of piecash
+(`<file>.YYYYmmddHHMMSS.gnucash`) are left out.
+
+Parameters
+----------
+patterns : iterable of str
+    File names or glob patterns.
+
+Returns
+-------
+out : list of str
+    """
+    filenames = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) or [pattern]
+        for filename in matches:
+            if _BACKUP_PATTERN.search(filename):
+                continue
+            if filename not in filenames:
+                filenames.append(filename)
+    return filenames
+
+
+def _summarize(connection):
+    """Return the number of creditors and contracts and the contract total."""
+    data = connection._data
+    return {
+        "creditors": data.find_creditors().count(),
+        "contracts": data.find_contracts().count(),
+        "amount": data.sum_amounts(),
+    }
+
+
+def _file_task_kwargs(task, filename, task_kwargs):
+    """Return the keyword arguments of `task` for the file `filename`.
+
+Missing arguments get per-file defaults: the interest is calculated for the
+previous year, like the statements, and the export is written to
+`<file without extension>.csv`.
+    """
+    kwargs = dict(task_kwargs.get(task, {}))
+    if task == "interest":
+        year = datetime.date.today().year - 1
+        start = dkhandle._parse_date(kwargs.get("start")) or datetime.date(
+            year, 1, 1)
+        kwargs["start"] = start
+        kwargs["end"] = (dkhandle._parse_date(kwargs.get("end"))
+                         or datetime.date(start.year + 1, 1, 1))
+    elif task == "export":
+        kwargs.setdefault("filename", os.path.splitext(filename)[0] + ".csv")
+    return kwargs
+
+
+def _process_file(filename, tasks, task_kwargs, connection_kwargs):
+    """Run all `tasks` on a single file.  This is executed in a worker process.
+
+Returns
+-------
+out : dict
+    With the keys "file", "results" (task -> result) and "errors" (task ->
+    error message).  Errors are collected instead of raised, so that one broken
+    file does not stop the whole batch.  This includes SystemExit, e.g. from
+    `dkdata.DKData` if a base account is missing.
+    """
+    outcome = {"file": filename, "results": {}, "errors": {}}
+    if not os.path.exists(filename):
+        outcome["errors"]["open"] = "File does not exist."
+        return outcome
+    try:
+        connection = dkhandle.Connection(gnucash_file=filename,
+                                         **connection_kwargs)
+    except (Exception, SystemExit) as exc:
+        outcome["errors"]["open"] = "{}: {}".format(type(exc).__name__, exc)
+        return outcome
+    for task in tasks:
+        try:
+            if TASKS[task] is None:
+                result = _summarize(connection)
+            else:
+                method = getattr(connection, TASKS[task])
+                result = method(**_file_task_kwargs(task, filename,
+                                                    task_kwargs))
+            outcome["results"][task] = result
+        except (Exception, SystemExit) as exc:
+            outcome["errors"][task] = "{}: {}".format(type(exc).__name__, exc)
+    return outcome
+
+
+def run_batch(files, tasks=("summary",), task_kwargs=None, workers=None,
+              **connection_kwargs):
+    """Run `tasks` on each of the given files, in parallel.
+
+Parameters
+----------
+files : iterable of str
+    GnuCash files or glob patterns, see `expand_files`.
+
+tasks : iterable of str, optional
+    Names of the tasks to be run on each file, keys of `TASKS`.  Default is
+    only "summary".
+
+task_kwargs : dict, optional
+    Task name -> keyword arguments for the task's `Connection` method.  Missing
+    ones get per-file defaults, see `_file_task_kwargs`.
+
+workers : int, optional
+    Maximum number of worker processes.  By default, one per file, but not more
+    than there are CPUs.
+
+**connection_kwargs :
+    Passed on to the `dkhandle.Connection` of each file, e.g. `base_dk`.
+
+Returns
+-------
+out : dict
+    The consolidated summary, with the keys "files" (the per-file outcomes of
+    `_process_file`, in the order of `files`), "totals" (the summed up numbers
+    of all "summary" results) and "failed" (the files with at least one error).
+    """
+    tasks = list(tasks)
+    for task in tasks:
+        if task not in TASKS:
+            raise ValueError("Unknown task: {}".format(task))
+    if task_kwargs is None:
+        task_kwargs = {}
+    filenames = expand_files(files)
+    if not filenames:
+        return {"files": [], "totals": {}, "failed": []}
+    if workers is None:
+        workers = min(len(filenames), os.cpu_count() or 1)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_process_file, filename, tasks, task_kwargs,
+                               connection_kwargs)
+                   for filename in filenames]
+        outcomes = [future.result() for future in futures]
+
+    totals = {}
+    for outcome in outcomes:
+        for key, value in outcome["results"].get("summary", {}).items():
+            totals[key] = totals.get(key, 0) + value
+    failed = [outcome["file"] for outcome in outcomes if outcome["errors"]]
+    return {"files": outcomes, "totals": totals, "failed": failed}
+
+
+def format_summary(summary):
+    """Return a human readable text for the result of `run_batch`."""
+    lines = []
+    for outcome in summary["files"]:
+        lines.append(outcome["file"])
+        for task, result in outcome["results"].items():
+            lines.append("    {}: {}".format(task, result))
+        for task, error in outcome["errors"].items():
+            lines.append("    {} FAILED: {}".format(task, error))
+    lines.append("Total: {} file(s), {} failed".format(
+        len(summary["files"]), len(summary["failed"])))
+    for key, value in summary["totals"].items():
+        lines.append("    {}: {}".format(key, value))
+    return "\n".join(lines)
+
+
+def _parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('files', nargs="+",
+                        help="GnuCash files or glob patterns")
+    parser.add_argument('-t', '--tasks', nargs="+", default=["summary"],
+                        choices=sorted(TASKS),
+                        help="The tasks to run on each file.")
+    parser.add_argument('--start', type=str, default=None,
+                        help="First day (YYYY-MM-DD) of the period for the "
+                        "interest and the statements.  Default is the start "
+                        "of the previous year.")
+    parser.add_argument('--end', type=str, default=None,
+                        help="The end of the period, exclusive.  Default is "
+                        "one year after the start.")
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help="Maximum number of worker processes.")
+    parser.add_argument('-b', '--base_dk', type=str, default=None,
+                        help="The base account for `Direktkredite`.")
+    parser.add_argument('-a', '--base_ausgleich', type=str, default=None,
+                        help="The base account for the balancing account.")
+    parser.add_argument('-z', '--base_zinsen', type=str, default=None,
+                        help="The base account for the interest account.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Run the batch from the command line, return the exit code."""
+    args = _parse_arguments(argv)
+    period = {key: value for key, value in (("start", args.start),
+                                            ("end", args.end))
+              if value is not None}
+    task_kwargs = {"interest": period, "statements": period}
+    summary = run_batch(args.files, tasks=args.tasks, task_kwargs=task_kwargs,
+                        workers=args.workers,
+                        base_dk=args.base_dk,
+                        base_ausgleich=args.base_ausgleich,
+                        base_zinsen=args.base_zinsen)
+    print(format_summary(summary))
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
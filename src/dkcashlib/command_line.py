@@ -1,13 +1,37 @@
+"""Command line interface of DKCash.
+
+Without a subcommand, the GUI is started.  The subcommands work without a GUI
+(and without importing Qt), their output is machine-readable (JSON lines or
+CSV), so that they can be used in scripts and cron jobs.
+"""
 
 import argparse
+import csv
+import json
+import os
+import sys
+
+from . import daemon
 
-from IPython import embed
-from dkcash.gui import mainapp
+# Subcommand -> help text, see `_create_headless_parser`.
+_COMMANDS = {
+    "creditors": "List or find creditors.",
+    "contracts": "List or find contracts.",
+    "due": "List the next due dates of contracts.",
+    "interest": "Calculate the interest for a date range.",
+    "export": "Export all contracts as a CSV file.",
+    "statements": "Generate the account statements.",
+    "import": "Import creditors or contracts from a CSV or ODS file.",
+    "batch": "Run tasks on many GnuCash files, see `dkcashlib.batch`.",
+    "serve": "Keep the file open for faster queries, see `dkcashlib.daemon`.",
+}
 
 
 def _create_parser():
     parser = argparse.ArgumentParser(
-        description='Dieses Programm verwaltet Direktkredite.')
+        description='Dieses Programm verwaltet Direktkredite.',
+        epilog="Kommandos ohne GUI: {}".format(", ".join(_COMMANDS)),
+    )
     parser.add_argument(
         'gnucash_file', nargs="?",
         type=argparse.FileType(mode="a"),
@@ -16,13 +40,193 @@ def _create_parser():
     )
     return parser
 
-def main():
+
+def _filter_argument(text):
+    """Parse a `column=value` filter argument."""
+    if "=" not in text:
+        raise argparse.ArgumentTypeError(
+            "Filters must look like `column=value`: {}".format(text))
+    return tuple(text.split("=", 1))
+
+
+def _create_headless_parser():
+    parser = argparse.ArgumentParser(
+        prog="dkcash", description=__doc__.split("\n")[0])
+    parser.add_argument('-f', '--file', type=str, default="dkcash.sqlite",
+                        help="The GnuCash database file")
+    parser.add_argument('--format', choices=("jsonl", "csv"), default="jsonl",
+                        help="The output format, default is JSON lines.")
+    parser.add_argument('--no-daemon', action="store_true",
+                        help="Do not use a running daemon for queries.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for command, help_text in _COMMANDS.items():
+        subparser = subparsers.add_parser(command, help=help_text)
+        if command in ("creditors", "contracts", "due", "interest", "export"):
+            subparser.add_argument(
+                '-w', '--where', type=_filter_argument, action="append",
+                default=[], metavar="COLUMN=VALUE",
+                help="Filter by column, `*` in the value is a wildcard.")
+        if command == "due":
+            subparser.add_argument('--before', type=str, default=None,
+                                   help="Only contracts due before this date.")
+        if command == "interest":
+            subparser.add_argument('start', help="First day (YYYY-MM-DD).")
+            subparser.add_argument('end', help="Last day, exclusive.")
+        if command == "export":
+            subparser.add_argument('output', help="The CSV file to write.")
+        if command == "statements":
+            subparser.add_argument('-o', '--output', default=None,
+                                   help="The output directory.")
+            subparser.add_argument('--start', default=None,
+                                   help="First day (YYYY-MM-DD).")
+            subparser.add_argument('--end', default=None,
+                                   help="Last day, exclusive.")
+        if command == "import":
+            subparser.add_argument('kind', choices=("creditors", "contracts"))
+            subparser.add_argument('input', help="The CSV or ODS file.")
+            subparser.add_argument('--dry-run', action="store_true",
+                                   help="Only validate, insert nothing.")
+        if command == "batch":
+            subparser.add_argument('arguments', nargs=argparse.REMAINDER,
+                                   help="Arguments for the batch run.")
+    return parser
+
+
+def _contract_record(contract):
+    return {"id": contract.contract_id, "creditor": contract.creditor_id,
+            "date": contract.date, "amount": contract.amount,
+            "interest": contract.interest,
+            "interest_payment": contract.interest_payment,
+            "period_type": contract.period_type,
+            "period_notice": contract.period_notice,
+            "period_end": contract.period_end, "version": contract.version,
+            "cancellation_date": contract.cancellation_date}
+
+
+def _write_records(records, output_format, stream=None):
+    """Write the records (dicts with the same keys) to `stream`."""
+    if stream is None:
+        stream = sys.stdout
+    if output_format == "csv":
+        writer = None
+        for record in records:
+            if writer is None:
+                writer = csv.DictWriter(stream, fieldnames=list(record))
+                writer.writeheader()
+            writer.writerow(record)
+    else:
+        for record in records:
+            stream.write(json.dumps(record, default=str) + "\n")
+
+
+def _run_command(connection, args):
+    """Run the subcommand given in `args`, return the records to be written."""
+    from .common import Creditor, Contract
+    filters = dict(getattr(args, "where", []))
+    if args.command == "creditors":
+        return [row._asdict()
+                for row in Creditor.find_rows(connection, **filters)]
+    if args.command == "contracts":
+        return [row._asdict()
+                for row in Contract.find_rows(connection, **filters)]
+    if args.command == "due":
+        return [dict(due_date=due_date, **_contract_record(contract))
+                for due_date, contract in connection.next_due_dates(
+                    before=args.before, **filters)]
+    if args.command == "interest":
+        interests = connection.calculate_interests(args.start, args.end,
+                                                   **filters)
+        return [{"id": contract_id, "interest": interest}
+                for contract_id, interest in interests.items()]
+    if args.command == "export":
+        exported = connection.generate_spreadsheet(args.output, **filters)
+        return [{"file": args.output, "contracts": exported}]
+    if args.command == "import":
+        from . import importer
+        report = importer.import_file(connection, args.input, args.kind,
+                                      dry_run=args.dry_run)
+        if report.errors:
+            print(importer.format_report(report), file=sys.stderr)
+        return [{"kind": report.kind, "rows": report.rows,
+                 "inserted": report.inserted, "errors": len(report.errors)}]
+    if args.command == "statements":
+        result = connection.generate_account_statements(
+            directory=args.output, start=args.start, end=args.end)
+        return [{"creditor": creditor_id, "file": filename,
+                 "rendered": creditor_id in result.rendered}
+                for creditor_id, filename in result.files.items()]
+    raise ValueError("Unknown command: {}".format(args.command))
+
+
+def _daemon_argv(argv, command, gnucash_file):
+    """Return `argv` for the daemon, with `gnucash_file` as an absolute path.
+
+The daemon runs in its own working directory, so relative paths would be
+resolved against that.  Only the options before `command` are looked at.
+    """
+    options = ["--file", os.path.abspath(gnucash_file)]
+    rest = list(argv)
+    while rest and rest[0] != command:
+        arg = rest.pop(0)
+        if arg in ("-f", "--file"):
+            rest.pop(0)
+        elif arg.startswith("--file=") or (arg.startswith("-f")
+                                           and not arg.startswith("--")):
+            continue
+        else:
+            options.append(arg)
+            if arg == "--format" and rest:
+                options.append(rest.pop(0))
+    return options + rest
+
+
+def headless_main(argv):
+    """Run a subcommand without GUI, return the exit code."""
+    parser = _create_headless_parser()
+    args = parser.parse_args(argv)
+    if args.command == "batch":
+        from . import batch
+        return batch.main(args.arguments)
+    if args.command == "serve":
+        return daemon.serve(args.file)
+    if args.command in daemon.DAEMON_COMMANDS and not args.no_daemon:
+        response = daemon.request(
+            args.file, _daemon_argv(argv, args.command, args.file))
+        if response is not None:
+            if response["error"]:
+                print("{}: {}".format(args.command, response["error"]),
+                      file=sys.stderr)
+            _write_records(response["records"], args.format)
+            return response["exit"]
+
+    from . import dkhandle
+    connection = dkhandle.Connection(gnucash_file=args.file)
+    try:
+        records = _run_command(connection, args)
+    except NotImplementedError as exc:
+        print("{}: {}".format(args.command, exc), file=sys.stderr)
+        return 2
+    _write_records(records, args.format)
+    return 0
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if any(arg in _COMMANDS for arg in argv):
+        return headless_main(argv)
+
     parser = _create_parser()
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     filename=args.gnucash_file
     if not filename is None:
         filename.close()
         filename = filename.name
 
+    from .dkgui import mainapp
     return mainapp.start(filename)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
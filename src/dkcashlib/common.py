@@ -1,9 +1,18 @@
 """Common classes for DKCash.
 """
 
+import collections
+
 from . import dkdata
 from .dkhandle import Connection
 
+# Lightweight read-only rows for listings, see `Creditor.find_rows` and
+# `Contract.find_rows`.
+CreditorRow = collections.namedtuple("CreditorRow",
+                                     dkdata.DKData.creditor_columns)
+ContractRow = collections.namedtuple("ContractRow",
+                                     dkdata.DKData.contract_columns)
+
 def has_connection(fun):
     """Make sure that a connection exists."""
     def wrapped(self, *args, **kwargs):
@@ -22,6 +31,12 @@ class Creditor:
     creditor has an ID, its properties can also be updated in the database.
 
     """
+    __slots__ = ("name", "address", "phone", "email", "newsletter",
+                 "connection", "creditor_id")
+
+    # Validation rule, see `_check`.
+    max_address_lines = 4
+
     def __init__(self, name, address, phone=None, email=None, newsletter=False,
                  connection=None, insert=True):
         """Create a creditor, and may also immediately add it.
@@ -53,16 +68,11 @@ insert : bool, optional
         self.name = name
         if type(address) == str:
             address = [address]
-        if len(address) == 0:
-            raise ValueError("Adress must not be empty.")
-        if len(address) > 4:
-            raise ValueError("Adress must consist of at most 4 entries.")
-        if address[0] == None or len(address[0]) == 0:
-            raise ValueError("First line of address must not be empty.")
+        problems = Creditor._check(address, email, newsletter)
+        if problems:
+            raise ValueError(problems[0][1])
         self.address = address
         self.phone = phone
-        if newsletter and not email:
-            raise ValueError("Newsletter is True, but no email is set.")
         self.email = email
         self.newsletter = bool(newsletter)
         self.connection = connection
@@ -71,12 +81,43 @@ insert : bool, optional
         if insert:
             self.insert()
 
+    @staticmethod
+    def _check(address, email=None, newsletter=False):
+        """Check the values against the rules for creditors.
+
+This is used by the constructor and, for each row, by `importer`.
+
+Returns
+-------
+out : list
+    (column, message) for each broken rule, empty if the values are valid.
+        """
+        problems = []
+        if len(address) == 0:
+            problems.append(("address1", "Adress must not be empty."))
+        elif len(address) > Creditor.max_address_lines:
+            problems.append(("address", "Adress must consist of at most {} "
+                             "entries.".format(Creditor.max_address_lines)))
+        elif address[0] == None or len(address[0]) == 0:
+            problems.append(("address1",
+                             "First line of address must not be empty."))
+        if newsletter and not email:
+            problems.append(("newsletter",
+                             "Newsletter is True, but no email is set."))
+        return problems
+
     @staticmethod
     def from_namespace(values, connection, insert=False):
         """Create and return a Creditor from a namespace.
 
-By default, do not insert the Creditor because probably it exists already.
+By default, do not insert the Creditor because probably it exists already.  In
+this case the values are trusted and not validated again.
         """
+        if not insert:
+            return Creditor._from_row(
+                [getattr(values, column)
+                 for column in dkdata.DKData.creditor_columns],
+                connection=connection)
         creditor = Creditor(name=values.name,
                             address=(values.address1,
                                      values.address2,
@@ -91,32 +132,62 @@ By default, do not insert the Creditor because probably it exists already.
             creditor.creditor_id = values.id
         return creditor
 
+    @staticmethod
+    def _from_row(row, connection):
+        """Create a Creditor from a database row, without any validation.
+
+Only use this for trusted rows, e.g. from `DKData.creditor_rows`.  The values
+must be in the order of `DKData.creditor_columns`.
+        """
+        creditor = Creditor.__new__(Creditor)
+        (creditor.creditor_id, creditor.name, address1, address2, address3,
+         address4, creditor.phone, creditor.email, creditor.newsletter) = row
+        creditor.address = (address1, address2, address3, address4)
+        creditor.connection = connection
+        return creditor
+
     @staticmethod
     def find(connection, creditor_id=None, name=None, address=None, phone=None,
              email=None, newsletter=None):
         """Retrieve all matching creditors from the database.
 
 At least one of the specifying arguments must be given.  Only exact matches are
-returned.  The address
+returned, unless the (string) values contain `*` wildcards.  The address is an
+iterable of up to 4 lines, each line which is not None is matched.
 
 Returns
 -------
-A tuple with the found contracts.
+A list with the found creditors.
         """
         filters = {}
         if creditor_id is not None:
             filters["id"] = creditor_id
-        # if creditor is not None:
-        #     if isinstance(creditor, Creditor):
-        #         creditor = creditor.creditor_id
-        #     filters["creditor"] = creditor
-        contracts = connection._data.find_creditors(**filters)
-        contracts = connection._data.find_contracts(**filters)
-        contracts = [Contract.from_namespace(x, connection=connection) for x in
-                     contracts]
-        return contracts
+        if name is not None:
+            filters["name"] = name
+        if address is not None:
+            if isinstance(address, str):
+                address = [address]
+            for number, line in enumerate(address, start=1):
+                if line is not None:
+                    filters["address{}".format(number)] = line
+        if phone is not None:
+            filters["phone"] = phone
+        if email is not None:
+            filters["email"] = email
+        if newsletter is not None:
+            filters["newsletter"] = newsletter
+        return [Creditor._from_row(row, connection=connection)
+                for row in connection._data.creditor_rows(**filters)]
 
+    @staticmethod
+    def find_rows(connection, **kwargs):
+        """Return all matching creditors as read-only `CreditorRow` tuples.
 
+This is much cheaper than creating Creditor objects and should be used for
+listings.  The filters are the same as for `DKData.find_creditors`.
+        """
+        return [CreditorRow._make(row)
+                for row in connection._data.creditor_rows(**kwargs)]
 
     @staticmethod
     def retrieve(connection, creditor_id=None, name=None):
@@ -134,17 +205,16 @@ If no match is found, None is returned.
             filters["id"] = creditor_id
         if name is not None:
             filters["name"] = name
-        query_result = connection._data.find_creditors(**filters)
-        if query_result.count() == 0:
+        rows = connection._data.creditor_rows(**filters)
+        if len(rows) == 0:
             print("No results found.")
             return None
-        if query_result.count() > 1:
+        if len(rows) > 1:
             print(
 "Warning: more than one match found for `{}`, returning only one.".format(
     filters
 ))
-        creditor = Creditor.from_namespace(query_result.first(),
-                                           connection=connection)
+        creditor = Creditor._from_row(rows[0], connection=connection)
         return creditor
 
     @has_connection
@@ -159,40 +229,44 @@ Upon successful insertion, this also assigns the ID.
 
     @has_connection
     def update(self, name=None, address=None, phone=None, email=None,
-               newsletter=False):
+               newsletter=None):
         """Update the Creditor's properties (those which are not None).
 
 The Creditor must be inserted already in the database, i.e. its ID must not be
 None.
 
-Note that address should be a 4 element list.
+Note that address should be a list of up to 4 elements, missing elements are
+set to empty strings.
 
 Returns
 -------
 out: boolean
 True if something was updated, else False.
         """
-        address1, address2, address3, address4 = [None] * 4
+        values = {"name": name, "phone": phone, "email": email,
+                  "newsletter": newsletter}
+        values = {key: value for key, value in values.items()
+                  if value is not None}
         if address is not None:
-            address1, address2, address3, address4 = address
-        updated = self.connection._data.update_creditor(
-            self.creditor_id, name=name, phone=phone, email=email,
-            newsletter=newsletter,
-            address1=address1, address2=address2, address3=address3,
-            address4=address4)
-        reloaded = self.connection._data.find_creditors(id=self.creditor_id)[0]
+            address = list(address) + [""] * (4 - len(address))
+            for number, line in enumerate(address, start=1):
+                values["address{}".format(number)] = line
+        if not values:
+            return False
+        rows = self.connection._data.update_creditors([self.creditor_id],
+                                                      **values)
+        if not rows:
+            return False
+        reloaded = Creditor._from_row(rows[0], connection=self.connection)
         self.name = reloaded.name
-        self.address = [reloaded.address1,
-                        reloaded.address2,
-                        reloaded.address3,
-                        reloaded.address4]
+        self.address = list(reloaded.address)
         self.phone = reloaded.phone
         self.email = reloaded.email
         self.newsletter = reloaded.newsletter
-        return updated
+        return True
 
     @has_connection
-    def delete(self, delete_contracts=False):
+    def delete(self, delete_contracts=False, delete_accounts=False):
         """Delete this creditor from the database.
 
 Parameters
@@ -200,21 +274,27 @@ Parameters
 delete_contracts : bool, optional
     If contracts by this Creditor shall also be deleted.  Default is False.  If
     False, an exception is raised if there are any contracts by this Creditor.
+
+delete_accounts : bool, optional
+    If the (empty) GnuCash accounts of the deleted contracts shall also be
+    deleted.  Default is False.
         """
-        linked_contracts = Contract.find(self.connection, creditor=self)
-        print("linked:")
-        print(linked_contracts)
-        if linked_contracts:
-            if delete_contracts:
-                for contract in linked_contracts:
-                    print("Warning, deleting contract: {}".format(contract))
-                    contract.delete()
-            else:
-                raise RuntimeError(
-                    "Deleting the creditor {} failed, because there are still "
-                    "contracts linked to the creditor.".format(self))
-
-        self.connection._data.delete_creditor(creditor_id=self.creditor_id)
+        _, contracts, _ = self.connection._data.delete_creditors(
+            [self.creditor_id], delete_contracts=delete_contracts,
+            delete_accounts=delete_accounts)
+        if contracts:
+            print("Warning, deleted {} contract(s) of creditor {}.".format(
+                contracts, self.creditor_id))
+
+
+def _state_property(name):
+    """Return a property which accesses the attribute `name` of the state."""
+    def getter(self):
+        return getattr(self._initial_state, name)
+
+    def setter(self, value):
+        setattr(self._initial_state, name, value)
+    return property(getter, setter)
 
 
 class Contract:
@@ -232,7 +312,22 @@ infer any information.  If there is no state stored for a certain time, the
 parameters (run time, interest rate, etc.) of the contract do not change,
 although the accumulated interest may change over time of course.
 
+The state attributes (``date``, ``amount``, ...) can be accessed directly on the
+Contract, they refer to the initial state.
+
     """
+    __slots__ = ("contract_id", "creditor_id", "_initial_state", "_states",
+                 "connection")
+
+    date = _state_property("date")
+    amount = _state_property("amount")
+    interest = _state_property("interest")
+    interest_payment = _state_property("interest_payment")
+    period_type = _state_property("period_type")
+    period_notice = _state_property("period_notice")
+    period_end = _state_property("period_end")
+    version = _state_property("version")
+    cancellation_date = _state_property("cancellation_date")
 
     def __init__(self, contract_id, creditor, date, amount, interest,
                  interest_payment="payout", period_type="fixed_duration",
@@ -328,10 +423,16 @@ Raise exceptions or print warnings for invalid or unusual attributes.
     def from_namespace(values, connection, insert=False):
         """Create and return a Contract from a namespace.
 
-By default, do not insert the Contract because probably it exists already.
+By default, do not insert the Contract because probably it exists already.  In
+this case the values are trusted and not validated again.
         """
         # for k, v in values.__dict__.items():
         #     print("{}:\t{}".format(k,v))
+        if not insert:
+            return Contract._from_row(
+                [getattr(values, column)
+                 for column in dkdata.DKData.contract_columns],
+                connection=connection)
         contract = Contract(contract_id=values.id,
                             creditor=values.creditor,
                             date=values.date,
@@ -346,6 +447,26 @@ By default, do not insert the Contract because probably it exists already.
                             connection=connection, insert=insert)
         return contract
 
+    @staticmethod
+    def _from_row(row, connection):
+        """Create a Contract from a database row, without any validation.
+
+Only use this for trusted rows, e.g. from `DKData.contract_rows`.  The values
+must be in the order of `DKData.contract_columns`.
+        """
+        contract = Contract.__new__(Contract)
+        state = _State.__new__(_State)
+        (contract_id, contract.creditor_id, _account, state.date, state.amount,
+         state.interest, state.interest_payment, state.version,
+         state.period_type, state.period_notice, state.period_end,
+         state.cancellation_date, _active) = row
+        state.balance = 0.0
+        contract.contract_id = int(contract_id)
+        contract._initial_state = state
+        contract._states = {state.date: state}
+        contract.connection = connection
+        return contract
+
     @staticmethod
     def retrieve(connection, contract_id=None,  creditor_id=None):
         """Retrieve a contract from the database if a matching one can be found.
@@ -363,15 +484,14 @@ If no match is found, None is returned.
             filters["id"] = contract_id
         if creditor_id is not None:
             filters["creditor"] = creditor_id
-        query_result = connection._data.find_contracts(**filters)
-        if query_result.count() == 0:
+        rows = connection._data.contract_rows(**filters)
+        if len(rows) == 0:
             print("No results found.")
             return None
-        if query_result.count() > 1:
+        if len(rows) > 1:
             raise RuntimeError(
                 "Warning: more than one match found for `{}`.".format(filters))
-        contract = Contract.from_namespace(query_result.first(),
-                                           connection=connection)
+        contract = Contract._from_row(rows[0], connection=connection)
         return contract
 
     @staticmethod
@@ -386,7 +506,7 @@ returned.
 
 Returns
 -------
-A tuple with the found contracts.
+A list with the found contracts.
         """
         filters = {}
         if contract_id is not None:
@@ -395,10 +515,27 @@ A tuple with the found contracts.
             if isinstance(creditor, Creditor):
                 creditor = creditor.creditor_id
             filters["creditor"] = creditor
-        contracts = connection._data.find_contracts(**filters)
-        contracts = [Contract.from_namespace(x, connection=connection) for x in
-                     contracts]
-        return contracts
+        for column, value in (("date", date), ("amount", amount),
+                              ("interest", interest),
+                              ("interest_payment", interest_payment),
+                              ("period_type", period_type),
+                              ("period_notice", period_notice),
+                              ("period_end", period_end),
+                              ("version", version)):
+            if value is not None:
+                filters[column] = value
+        return [Contract._from_row(row, connection=connection)
+                for row in connection._data.contract_rows(**filters)]
+
+    @staticmethod
+    def find_rows(connection, **kwargs):
+        """Return all matching contracts as read-only `ContractRow` tuples.
+
+This is much cheaper than creating Contract objects and should be used for
+listings.  The filters are the same as for `DKData.find_contracts`.
+        """
+        return [ContractRow._make(row)
+                for row in connection._data.contract_rows(**kwargs)]
 
     def update(self, contract_id=None, creditor=None, date=None, amount=None,
                interest=None, interest_payment=None, period_type=None,
@@ -423,31 +560,51 @@ True if something was updated, else False.
         else:
             creditor_id = creditor
 
-        updated = self.connection._data.update_contract(
-            self.contract_id,
-            creditor=creditor_id, date=date,
-            amount=amount, interest=interest,
-            interest_payment=interest_payment,
-            period_type=period_type,
-            period_notice=period_notice,
-            period_end=period_end,
-            version=version,
-            cancellation_date=cancellation_date,
-            active=active)
-        reloaded = self.connection._data.find_contracts(id=self.contract_id)[0]
-        self.creditor_id = reloaded.creditor
-        self.date = reloaded.date
-        self.amount = reloaded.amount
-        self.interest = reloaded.interest
-        self.interest_payment = reloaded.interest_payment
-        self.interest_payment = reloaded.interest_payment
-        self.period_type = reloaded.period_type
-        self.period_notice = reloaded.period_notice
-        self.period_end = reloaded.period_end
-        self.cancellation_date = reloaded.cancellation_date
-        self.version = reloaded.version
-
-        return updated
+        values = {"creditor": creditor_id, "date": date, "amount": amount,
+                  "interest": interest, "interest_payment": interest_payment,
+                  "period_type": period_type, "period_notice": period_notice,
+                  "period_end": period_end, "version": version,
+                  "cancellation_date": cancellation_date, "active": active}
+        values = {key: value for key, value in values.items()
+                  if value is not None}
+        if not values:
+            return False
+        rows = self.connection._data.update_contracts([self.contract_id],
+                                                      **values)
+        if not rows:
+            return False
+        reloaded = Contract._from_row(rows[0], connection=self.connection)
+        self.creditor_id = reloaded.creditor_id
+        self._initial_state = reloaded._initial_state
+        self._states = reloaded._states
+        return True
+
+    @staticmethod
+    def update_many(connection, contracts, **values):
+        """Set the same values for many contracts at once.
+
+This is done in a single database statement, e.g. for a mass deactivation::
+
+    Contract.update_many(connection, contracts, active=False)
+
+Parameters
+----------
+contracts : iterable
+    The contracts (Contract objects or IDs) to be updated.
+
+**values :
+    Column -> new value, see `DKData.contract_columns`.
+
+Returns
+-------
+out : list
+    The updated contracts, freshly loaded from the database.
+        """
+        contract_ids = [contract.contract_id
+                        if isinstance(contract, Contract) else contract
+                        for contract in contracts]
+        rows = connection._data.update_contracts(contract_ids, **values)
+        return [Contract._from_row(row, connection=connection) for row in rows]
 
     def delete(self):
         """Delete this Contract from the database.
@@ -462,6 +619,23 @@ out : int
 
 
 class _State:
+    __slots__ = ("date", "amount", "interest", "interest_payment",
+                 "period_type", "period_notice", "period_end", "version",
+                 "cancellation_date", "balance")
+
+    # Validation rules, see `_validate_attributes`.
+    required = ("date", "amount", "interest")
+    non_negative = ("amount", "interest", "balance")
+    choices = {"interest_payment": ("payout", "cumulative", "reinvest")}
+    # period_type -> (required attributes, attributes without effect)
+    period_rules = {
+        "fixed_duration": (("period_end",), ("period_notice",)),
+        "fixed_period_notice": (("period_notice",), ("period_end",)),
+        "initial_plus_n": (("period_notice", "period_end"), ()),
+    }
+    missing_message = ('If "period type" is `{period_type}`, `{name}` must be '
+                       'given.')
+
     def __init__(self, date, amount, interest, interest_payment="payout",
                  period_type="fixed_duration", period_notice=None,
                  period_end=None, version=None, cancellation_date=None,
@@ -480,37 +654,24 @@ class _State:
     def _validate_attributes(self):
         """Validate the attributes, especially for the different period types.
 
-Raise exceptions or print warnings for invalid or unusual attributes.
+Raise exceptions or print warnings for invalid or unusual attributes.  The rules
+are the class attributes above, so that `importer` can check whole columns.
         """
-        assert self.date is not None
-        assert self.amount is not None
-        assert self.amount >= 0.0
-        assert self.balance is not None
-        assert self.balance >= 0.0
-        assert self.interest is not None
-        assert self.interest >= 0.0
-        assert self.interest_payment in ("payout", "cumulative", "reinvest")
-        if self.period_type == "fixed_duration":
-            if self.period_end is None:
-                raise ValueError('If "period type" is `fixed_duration`, '
-                                 '`period_end` must be given.')
-            if self.period_notice is not None:
-                print("Warning, `period_notice` has no effect for fixed "
-                      "duration period type.")
-        elif self.period_type == "fixed_period_notice":
-            if self.period_notice is None:
-                raise ValueError('If "period type" is `fixed_period_notice`, '
-                                 '`period_notice` must be given.')
-            if self.period_end is not None:
-                print('Warning, `period_end` has no effect for period type '
-                      '"fixed period notice".')
-        elif self.period_type == "initial_plus_n":
-            if self.period_notice is None:
-                raise ValueError('If "period type" is `initial_plus_n`, '
-                                 '`period_notice` must be given.')
-            if self.period_end is None:
-                raise ValueError('If "period type" is `initial_plus_n`, '
-                                 '`period_end` must be given.')
-        else:
+        for name in self.required + ("balance",):
+            assert getattr(self, name) is not None
+        for name in self.non_negative:
+            assert getattr(self, name) >= 0.0
+        for name, choices in self.choices.items():
+            assert getattr(self, name) in choices
+        if self.period_type not in self.period_rules:
             raise ValueError("Unknown `period_type` argument.")
+        required, ignored = self.period_rules[self.period_type]
+        for name in required:
+            if getattr(self, name) is None:
+                raise ValueError(self.missing_message.format(
+                    period_type=self.period_type, name=name))
+        for name in ignored:
+            if getattr(self, name) is not None:
+                print("Warning, `{}` has no effect for period type "
+                      "\"{}\".".format(name, self.period_type))
 
@@ -0,0 +1,176 @@
+"""A local daemon which answers queries for one GnuCash file.
+
+Each command line invocation has to start Python, import piecash and
+SqlAlchemy, open the book and reflect the database before doing any actual
+work.  With `dkcash -f FILE serve`, a daemon keeps a `dkhandle.Connection` to
+FILE (with its reflected schema and caches) alive and answers the read-only
+subcommands (see `DAEMON_COMMANDS`) over a Unix socket.  The command line
+interface uses the daemon automatically if one is running for the file.
+
+The book itself is still opened (read-only, without a backup copy) for each
+request, so that changes by other processes are always seen.  What is saved is
+the start-up, the reflection and the caches of the connection.
+
+Protocol: The client sends one JSON line ``{"argv": [...]}`` with the command
+line arguments, the daemon answers with one JSON line ``{"exit": int,
+"records": [...], "error": str or null}``.
+"""
+
+import hashlib
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import tempfile
+
+# Subcommands which may be answered by the daemon.  They only read data and do
+# not depend on the client's working directory.
+DAEMON_COMMANDS = ("creditors", "contracts", "due", "interest")
+
+
+def socket_path(gnucash_file):
+    """Return the socket path of the daemon for `gnucash_file`.
+
+The path does not depend on the current working directory and is short enough
+for Unix sockets.
+    """
+    filename = os.path.abspath(gnucash_file)
+    digest = hashlib.sha1(filename.encode()).hexdigest()[:16]
+    return os.path.join(tempfile.gettempdir(),
+                        "dkcash-{}-{}.sock".format(os.getuid(), digest))
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            response = self.server.answer(request["argv"])
+        except (ValueError, KeyError, TypeError) as exc:
+            response = {"exit": 1, "records": [],
+                        "error": "Invalid request: {}".format(exc)}
+        self.wfile.write(json.dumps(response, default=str).encode() + b"\n")
+
+
+class DaemonServer(socketserver.UnixStreamServer):
+    """Serve queries for one GnuCash file.
+
+Requests are handled one after the other, the book is never accessed from more
+than one request at a time.
+    """
+
+    def __init__(self, connection, path=None):
+        """
+Parameters
+----------
+connection : dkhandle.Connection
+    The connection which is kept alive.
+
+path : str, optional
+    The socket path, default is `socket_path` of the connection's file.
+        """
+        self.connection = connection
+        self.gnucash_file = os.path.abspath(connection._data._gnucash_file)
+        if path is None:
+            path = socket_path(self.gnucash_file)
+        if os.path.exists(path):
+            if request(self.gnucash_file, [], path=path) is not None:
+                raise RuntimeError(
+                    "A daemon is running already for {}.".format(
+                        self.gnucash_file))
+            os.remove(path)
+        # The socket must not be accessible by other users, not even between
+        # binding and a chmod.
+        umask = os.umask(0o077)
+        try:
+            super().__init__(path, _RequestHandler)
+        finally:
+            os.umask(umask)
+        os.chmod(path, 0o600)
+
+    def answer(self, argv):
+        """Run the subcommand given by the command line arguments `argv`.
+
+Returns
+-------
+out : dict
+    The response, see the module documentation.
+        """
+        from . import command_line
+        parser = command_line._create_headless_parser()
+        try:
+            args = parser.parse_args(argv)
+        except SystemExit:
+            return {"exit": 1, "records": [],
+                    "error": "Invalid arguments: {}".format(argv)}
+        if args.command not in DAEMON_COMMANDS:
+            return {"exit": 1, "records": [],
+                    "error": "Not a daemon command: {}".format(args.command)}
+        if os.path.abspath(args.file) != self.gnucash_file:
+            return {"exit": 1, "records": [],
+                    "error": "The daemon serves {}.".format(self.gnucash_file)}
+        try:
+            records = command_line._run_command(self.connection, args)
+        except NotImplementedError as exc:
+            return {"exit": 2, "records": [], "error": str(exc)}
+        except Exception as exc:
+            return {"exit": 1, "records": [],
+                    "error": "{}: {}".format(type(exc).__name__, exc)}
+        return {"exit": 0, "records": records, "error": None}
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+def serve(gnucash_file):
+    """Run the daemon for `gnucash_file` until it is interrupted.
+
+Returns
+-------
+out : int
+    The exit code.
+    """
+    from . import dkhandle
+    connection = dkhandle.Connection(gnucash_file=gnucash_file)
+    server = DaemonServer(connection)
+    # Terminate cleanly (removing the socket) on SIGTERM, too.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print("Serving {} on {}".format(server.gnucash_file,
+                                    server.server_address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+def request(gnucash_file, argv, path=None):
+    """Send `argv` to the daemon for `gnucash_file`.
+
+Returns
+-------
+out : dict or None
+    The daemon's response, or None if no daemon is running.
+    """
+    if not hasattr(socket, "AF_UNIX"):
+        return None
+    if path is None:
+        path = socket_path(gnucash_file)
+    if not os.path.exists(path):
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(path)
+            sock.sendall(json.dumps({"argv": argv}).encode() + b"\n")
+            with sock.makefile("rb") as stream:
+                line = stream.readline()
+    except (ConnectionRefusedError, FileNotFoundError):
+        return None
+    if not line:
+        return None
+    return json.loads(line)
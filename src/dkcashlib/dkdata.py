@@ -8,13 +8,19 @@ Because the same Sqlite GnuCash file is used for GnuCash specific operations
 opening and closing of the database connection on demand may be necessary.
 """
 
+import collections
+import contextlib
+import datetime
 import functools
 import inspect
 import os
 import sys
+import threading
+from decimal import Decimal, ROUND_HALF_UP
 from warnings import warn
 
 import sqlalchemy
+import sqlalchemy.orm
 from sqlalchemy import event, Column, ForeignKey
 from sqlalchemy.engine import Engine
 from sqlalchemy.ext.automap import automap_base
@@ -33,43 +39,389 @@ import piecash
 
 import logging; logging.getLogger('sqlalchemy.engine').setLevel('INFO')
 
-_open_books = dict()
+
+class _OpenBooks(threading.local):
+    """The books which are open in the current thread, see `_opened_book`.
+
+A piecash book (and its SqlAlchemy session) must not be shared between threads,
+so each thread opens its own.
+    """
+
+    def __init__(self):
+        self.books = {}
+        # The filenames of the books which were opened read-only.
+        self.readonly = set()
+        # Filename -> the ChangeEvents to be published after saving.
+        self.events = {}
+        # Filename -> callables to be called if the book is not saved.
+        self.rollbacks = {}
+
+
+_open_books = _OpenBooks()
+
+
+@contextlib.contextmanager
+def _opened_book(data, readonly=False):
+    """Yield the opened GnuCash book of `data`, a DKData object.
+
+Each book must be open only once at a time per thread.  If the book is open
+already, it is simply reused.  Otherwise it is opened, added to the list of open books and at
+the end saved (unless `readonly` is True), closed and removed from the list
+again.  If an exception is raised, the changes are not saved.
+
+A book which is open read-only cannot be reused for writing, changes would be
+lost silently.  A RuntimeError is raised instead.
+
+The change events which were recorded while the book was open (see
+`DKData._record_changes`) are published after it was saved and closed.  If it
+is not saved, the callbacks of `_on_rollback` are called instead.
+    """
+    # Get the normalized book filename.
+    filename = os.path.abspath(data._gnucash_file)
+
+    # Default case: Book was opened already
+    if filename in _open_books.books:
+        if not readonly and filename in _open_books.readonly:
+            raise RuntimeError("{} is open read-only (e.g. while iterating "
+                               "over rows), it can not be changed now.".format(
+                                   filename))
+        yield _open_books.books[filename]
+        return
+    events = []
+    rollbacks = []
+    saved = False
+    with piecash.open_book(filename, readonly=readonly) as book:
+        _open_books.books[filename] = book
+        _open_books.events[filename] = events
+        _open_books.rollbacks[filename] = rollbacks
+        if readonly:
+            _open_books.readonly.add(filename)
+        try:
+            yield book
+            if not readonly:
+                book.save()
+                saved = True
+        finally:
+            _open_books.books.pop(filename)
+            _open_books.readonly.discard(filename)
+            _open_books.events.pop(filename)
+            _open_books.rollbacks.pop(filename)
+            if not saved:
+                for callback in rollbacks:
+                    callback()
+    if events:
+        data._publish(events)
+
+
+def _on_rollback(data, callback):
+    """Call `callback()` if the book of `data`, which must be open in this
+thread, is closed without saving it."""
+    _open_books.rollbacks[os.path.abspath(data._gnucash_file)].append(callback)
+
 
 # Possibly better implementation, as a class again:
 # https://stackoverflow.com/questions/30104047/how-can-i-decorate-an-instance-method-with-a-decorator-class
 def _book_open(func):
-    """Each book must be open only once at a time."""
+    """Each book must be open only once at a time.
+
+Deferred updates (see `DKData.defer_writes`) are written first, in the same
+transaction.
+    """
     @functools.wraps(func)
     def wrap(self, *args, **kwargs):
-        # print("self: {self}\n*args: {args}\nkwargs: {kwargs}".format(
-        #     self=self, args=args, kwargs=kwargs))
-        # Get the normalized book filename.
-        filename = self._gnucash_file
-        filename = os.path.abspath(filename)
-
-        # Default case: Book was opened already
-        if filename in _open_books:
-            # print("    Not opening {} again for {}.".format(filename,
-            #                                             func.__name__))
-            kwargs.update({"book": _open_books[filename]})
-            result = func(self, *args, **kwargs)
-        else:
-            # Now the book is opened, the function called, then the book is
-            # saved and closed automatically.  Also the book is added to the
-            # list of open books and removed at the end.
-            with piecash.open_book(filename, readonly=False) as book:
-                # print("Opened {} for {}".format(filename, func.__name__))
-                _open_books[filename] = book
-                kwargs.update({"book": book})
-                result = func(self, *args, **kwargs)
-                # print("Saving and closing {}".format(filename))
-                book.save()
-                _open_books.pop(filename)
-        return result
+        with _opened_book(self) as book:
+            self._flush_writes()
+            kwargs.update({"book": book})
+            return func(self, *args, **kwargs)
 
     return wrap
 
 
+def _book_read(func=None, overlay=False):
+    """Like `_book_open`, but a book which is not open yet is opened read-only.
+
+Opening read-only skips piecash's backup copy of the whole file, which is by far
+the most expensive part of a simple lookup.  Deferred updates are written before,
+so that they are visible to the read.  Reads which apply them to their results
+instead (`overlay=True`, see `DKData._overlay_writes`) only write them if the
+filters or the sort order use an updated column.
+    """
+    if func is None:
+        return functools.partial(_book_read, overlay=overlay)
+
+    @functools.wraps(func)
+    def wrap(self, *args, **kwargs):
+        if not overlay or self._writes_filtered(kwargs):
+            self._flush_writes()
+        with _opened_book(self, readonly=True) as book:
+            kwargs.update({"book": book})
+            return func(self, *args, **kwargs)
+
+    return wrap
+
+
+def _to_date(value):
+    """Convert `value` to a datetime.date, for storing it in a date column.
+
+Strings are interpreted as `YYYY-MM-DD`, the month and day do not need to be
+zero-padded.
+    """
+    if value is None or value == "":
+        return None
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    try:
+        year, month, day = (int(part) for part in str(value).split("-"))
+        return datetime.date(year, month, day)
+    except ValueError as err:
+        raise ValueError("Not a YYYY-MM-DD date: {}".format(value)) from err
+
+
+def _to_cents(value):
+    """Convert the money amount `value` to integer cents."""
+    if value is None:
+        return None
+    amount = Decimal(str(value)).quantize(Decimal("0.01"),
+                                          rounding=ROUND_HALF_UP)
+    return int(amount.scaleb(2))
+
+
+class _IsoDate(sqlalchemy.types.TypeDecorator):
+    """A date column which also accepts `YYYY-MM-DD` strings."""
+    impl = sqlalchemy.Date
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return _to_date(value)
+
+
+class _Cents(sqlalchemy.types.TypeDecorator):
+    """Money amounts, stored as integer cents and returned as Decimal.
+
+This is exact like GnuCash's num/denom values, and sums can be calculated by
+the database.
+    """
+    impl = sqlalchemy.Integer
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return _to_cents(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return Decimal(value).scaleb(-2)
+
+
+# Columns with converters: (table, column) -> (type, stored type).
+_typed_columns = {
+    ("contracts", "date"): (_IsoDate, sqlalchemy.Date),
+    ("contracts", "period_end"): (_IsoDate, sqlalchemy.Date),
+    ("contracts", "cancellation_date"): (_IsoDate, sqlalchemy.Date),
+    ("contracts", "amount"): (_Cents, sqlalchemy.Integer),
+}
+
+
+def _column_reflect(inspector, table, column_info):
+    """Use the converter types for the reflected `_typed_columns`."""
+    typed = _typed_columns.get((table.name, column_info["name"]))
+    if typed is not None and isinstance(column_info["type"], typed[1]):
+        column_info["type"] = typed[0]()
+
+
+def _as_stored(table, column, value):
+    """Convert `value` to what is read back from `column` of `table`."""
+    typed = _typed_columns.get((table, column))
+    if typed is None or value is None:
+        return value
+    converter = typed[0]()
+    value = converter.process_bind_param(value, None)
+    if isinstance(converter, _Cents):
+        value = converter.process_result_value(value, None)
+    return value
+
+
+def _contracts_table(metadata, name="contracts"):
+    """Define the contracts table with the name `name` in `metadata`.
+
+The referenced tables (creditors and accounts) must be in `metadata`.
+    """
+    return sqlalchemy.Table(
+        name, metadata,
+        Column("id", sqlalchemy.String, primary_key=True),
+        Column("creditor", sqlalchemy.Integer, ForeignKey('creditors.id'),
+               nullable=False),
+        Column("account", sqlalchemy.String, ForeignKey('accounts.guid'),
+               nullable=False),
+        Column("date", _IsoDate, nullable=False),
+        Column("amount", _Cents, nullable=False),
+        Column("interest", sqlalchemy.Float, nullable=False),
+        Column("interest_payment", sqlalchemy.String, nullable=False),
+        Column("version", sqlalchemy.String, nullable=True),
+        Column("period_type", sqlalchemy.String, nullable=False),
+        Column("period_notice", sqlalchemy.String, nullable=True),
+        Column("period_end", _IsoDate, nullable=True),
+        Column("cancellation_date", _IsoDate, nullable=True),
+        Column("active", sqlalchemy.Boolean, nullable=False),
+        sqlalchemy.Index("ix_contracts_creditor", "creditor"),
+        sqlalchemy.Index("ix_contracts_period_end", "period_end"),
+    )
+
+
+# Cheap fingerprint of GnuCash's own tables, see `DKData.gnucash_state`.
+GnuCashState = collections.namedtuple(
+    "GnuCashState", ("splits", "max_split_rowid", "accounts",
+                     "max_account_rowid", "max_enter_date", "max_post_date"))
+
+# A split as returned by `DKData.split_rows`.
+SplitRow = collections.namedtuple(
+    "SplitRow", ("rowid", "guid", "account", "post_date", "value",
+                 "description"))
+
+
+# One page of rows, see `DKData.creditor_page`.  `cursor` is passed as `after`
+# to get the next page, it is None on the last page.
+Page = collections.namedtuple("Page", ("rows", "cursor"))
+
+
+# A change of the data, published by `DKData` after it was saved.  `action` is
+# "inserted", "updated" or "deleted", `kind` is "creditor", "contract" or (from
+# `dkhandle.Connection.sync`, when a balance changed) "account".  `id` is the
+# creditor ID, the contract ID (int) or the account guid.
+ChangeEvent = collections.namedtuple("ChangeEvent", ("action", "kind", "id"))
+# Table name -> kind of the ChangeEvents.
+_change_kinds = {"creditors": "creditor", "contracts": "contract"}
+
+
+# Key/value table with information about the DKCash data in the file, e.g. the
+# schema version.
+_meta_table = sqlalchemy.Table(
+    "dkcash_meta", sqlalchemy.MetaData(),
+    Column("key", sqlalchemy.String, primary_key=True),
+    Column("value", sqlalchemy.String),
+)
+
+
+# Full text index over the creditors, see `DKData.search_creditors`.  The
+# trigram tokenizer matches any substring of at least three characters.  The
+# index has no content of its own, the triggers keep it in sync with the
+# creditors table, however the table is changed.  The tokenizer needs SQLite
+# 3.34, without it there is no index and the search uses LIKE.
+_search_columns = ("name", "address1", "address2", "address3", "address4",
+                   "email", "phone")
+_search_ddl = [
+    "CREATE VIRTUAL TABLE creditors_fts USING fts5({columns}, "
+    "content='creditors', content_rowid='id', tokenize='trigram')",
+    "CREATE TRIGGER creditors_fts_insert AFTER INSERT ON creditors BEGIN "
+    "INSERT INTO creditors_fts(rowid, {columns}) VALUES (new.id, {new}); END",
+    "CREATE TRIGGER creditors_fts_delete AFTER DELETE ON creditors BEGIN "
+    "INSERT INTO creditors_fts(creditors_fts, rowid, {columns}) "
+    "VALUES ('delete', old.id, {old}); END",
+    "CREATE TRIGGER creditors_fts_update AFTER UPDATE ON creditors BEGIN "
+    "INSERT INTO creditors_fts(creditors_fts, rowid, {columns}) "
+    "VALUES ('delete', old.id, {old}); "
+    "INSERT INTO creditors_fts(rowid, {columns}) VALUES (new.id, {new}); END",
+    "INSERT INTO creditors_fts(creditors_fts) VALUES ('rebuild')",
+]
+_search_ddl = [statement.format(
+    columns=", ".join(_search_columns),
+    new=", ".join("new." + column for column in _search_columns),
+    old=", ".join("old." + column for column in _search_columns))
+               for statement in _search_ddl]
+
+
+# Change log of the creditors and contracts, see `DKData.changes_since`.  The
+# triggers keep one row per changed record, with the sequence number of its last
+# change, also for changes by other programs and processes.
+_changes_ddl = [
+    "CREATE TABLE dkcash_changes (kind TEXT NOT NULL, key TEXT NOT NULL, "
+    "seq INTEGER NOT NULL, PRIMARY KEY (kind, key))",
+    "CREATE INDEX ix_dkcash_changes_seq ON dkcash_changes (seq)",
+] + [
+    "CREATE TRIGGER {table}_log_{event} AFTER {event} ON {table} BEGIN "
+    "INSERT OR REPLACE INTO dkcash_changes (kind, key, seq) VALUES ('{kind}', "
+    "{row}.id, (SELECT coalesce(max(seq), 0) + 1 FROM dkcash_changes)); "
+    "END".format(table=table, kind=kind, event=event, row=row)
+    for table, kind in (("creditors", "creditor"), ("contracts", "contract"))
+    for event, row in (("insert", "new"), ("update", "new"), ("delete", "old"))
+]
+
+
+def _trigrams(text):
+    """The set of trigrams of `text`, case insensitive."""
+    text = (text or "").lower()
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+# Table -> name in the `include` argument of the finders (see
+# `DKData.find_contracts`) -> (relationship attribute, loader option).  Single
+# related objects are loaded with a join, collections with a second query.
+_INCLUDES = {
+    "contracts": {
+        "creditor": ("creditor_record", sqlalchemy.orm.joinedload),
+        "account": ("account_record", sqlalchemy.orm.joinedload),
+        "splits": ("splits", sqlalchemy.orm.selectinload),
+    },
+    "creditors": {
+        "contracts": ("contracts", sqlalchemy.orm.selectinload),
+    },
+}
+
+
+def _add_relationships(base):
+    """Add the (read-only) relationships of `_INCLUDES` to the automapped
+classes.
+
+The names which automap generates from the foreign keys collide with the column
+names, and GnuCash does not declare foreign keys for the splits.
+    """
+    classes = base.classes
+    if "contracts" not in classes or "creditors" not in classes:
+        return
+    Contract = classes.contracts
+    Creditor = classes.creditors
+    Account = classes.accounts
+    Split = classes.splits
+    orm = sqlalchemy.orm
+    Contract.creditor_record = orm.relationship(
+        Creditor, primaryjoin=orm.foreign(Contract.creditor) == Creditor.id,
+        viewonly=True)
+    Contract.account_record = orm.relationship(
+        Account, primaryjoin=orm.foreign(Contract.account) == Account.guid,
+        viewonly=True)
+    Contract.splits = orm.relationship(
+        Split, primaryjoin=orm.foreign(Split.account_guid) == Contract.account,
+        viewonly=True, order_by=Split.guid)
+    Creditor.contracts = orm.relationship(
+        Contract, primaryjoin=orm.foreign(Contract.creditor) == Creditor.id,
+        viewonly=True,
+        order_by=sqlalchemy.cast(Contract.id, sqlalchemy.Integer))
+
+
+def _include_options(base, tablename, include):
+    """Return the loader options for the `include` argument of the finders.
+
+Dotted names load nested relationships, e.g. "contracts.splits" for creditors.
+    """
+    options = []
+    for path in include:
+        option = None
+        table = tablename
+        for name in path.split("."):
+            if name not in _INCLUDES.get(table, {}):
+                raise ValueError("Cannot include `{}` for {}.".format(
+                    name, table))
+            attribute, loader = _INCLUDES[table][name]
+            relationship = getattr(_get_table(base, table), attribute)
+            option = (loader(relationship) if option is None
+                      else getattr(option, loader.__name__)(relationship))
+            table = relationship.property.mapper.local_table.name
+        options.append(option)
+    return options
+
+
 def _get_table(base, tablename):
     Table = base.classes[tablename]
     Table.object_to_validate = lambda *x: []
@@ -99,13 +451,76 @@ like_filters: dict
     return verbatim_filters, like_filters
 
 
-def _filter_flexible(query, smap, **kwargs):
-    """Apply `kwargs` as additional filters to the query.
+class _QueryCache:
+    """Filtered queries, built once per filter shape.
+
+The shape of a filter is the mapped class, which columns are compared exactly
+(and if to None) and which are matched with LIKE.  The cached queries contain
+bound parameters instead of the values and no session, so that building and
+compiling them (which SqlAlchemy caches by statement structure) is skipped when
+the same kind of filter is used again, e.g. while typing into a search field.
+    """
+
+    def __init__(self, maxsize=256):
+        self._queries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+    def query(self, session, smap, **kwargs):
+        """Return the query for `smap` with the filters `kwargs` applied."""
+        verbatim_filters, like_filters = _extract_like(**kwargs)
+        shape = (smap,
+                 tuple(sorted((key, value is None)
+                              for key, value in verbatim_filters.items())),
+                 tuple(sorted(like_filters)))
+        with self._lock:
+            query = self._queries.get(shape)
+            if query is None:
+                self.misses += 1
+                query = self._build(*shape)
+                self._queries[shape] = query
+                if len(self._queries) > self.maxsize:
+                    self._queries.popitem(last=False)
+            else:
+                self.hits += 1
+                self._queries.move_to_end(shape)
+        params = {"eq_" + key: value
+                  for key, value in verbatim_filters.items()
+                  if value is not None}
+        params.update({"like_" + key: value
+                       for key, value in like_filters.items()})
+        return query.with_session(session).params(**params)
+
+    @staticmethod
+    def _build(smap, verbatim_keys, like_keys):
+        verbatim = {key: None if is_none else sqlalchemy.bindparam("eq_" + key)
+                    for key, is_none in verbatim_keys}
+        columns = smap.__dict__
+        # LIKE patterns are text, also for typed (date, amount) columns.
+        likes = [columns[key].like(sqlalchemy.bindparam(
+            "like_" + key, type_=sqlalchemy.String)) for key in like_keys]
+        return sqlalchemy.orm.Query(smap).filter_by(**verbatim).filter(*likes)
+
+    def stats(self):
+        """Return the numbers of hits and misses, the hit rate and the size."""
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "size": len(self._queries)}
+
+
+_query_cache = _QueryCache()
+
+
+def _filter_flexible(session, smap, **kwargs):
+    """Return a query for `smap`, filtered by `kwargs`.
 
 Parameters
 ----------
-query: Query
-The Query to be filtered.
+session: Session
+The session in which the query is executed.
 
 smap: sqlalchemy map class
 The class in whose context the kwargs are to be interpreted.
@@ -117,17 +532,159 @@ _extract_like() is used to split these into exact and pattern matching values.
 Returns
 -------
 query: Query
-Filtered Query object.
+Filtered Query object.  It is taken from the `_QueryCache`.
     """
-    verbatim_filters, like_filters = _extract_like(**kwargs)
-    columns =smap.__dict__
-    likes = [columns[key].like(value) for key, value in like_filters.items()]
-    filtered_query = query.filter_by(**verbatim_filters).filter(*likes)
-    return filtered_query
+    return _query_cache.query(session, smap, **kwargs)
+
+
+class _WriteBehind:
+    """Deferred updates of creditors and contracts, see `DKData.defer_writes`.
+
+The updates are collected per record, later values for the same column replace
+earlier ones.  They are written in one transaction by `flush`, which is called
+`delay` seconds after the last update (in a timer thread), and before anything
+else is done with the data.
+    """
+
+    def __init__(self, data, delay):
+        self._data = data
+        self.delay = delay
+        # (table name, ID) -> column -> value
+        self.pending = collections.OrderedDict()
+        self._lock = threading.RLock()
+        self._timer = None
+
+    def add(self, table, columns, rows, values):
+        """Add the updates for the existing `rows` of `table`.
+
+Returns
+-------
+out : list
+    The rows with all pending updates applied, as named tuples.
+        """
+        updated = []
+        with self._lock:
+            for row in rows:
+                self.pending.setdefault((table, row.id), {}).update(values)
+                updated.append(self.overlay(table, columns, row))
+            self._schedule()
+        return updated
+
+    def overlay(self, table, columns, row):
+        """Return `row` (the values of `columns` of `table`) with the pending
+updates applied.  Rows without updates are returned unchanged."""
+        with self._lock:
+            pending = self.pending.get((table, row.id))
+            if pending is None:
+                return row
+            return _row_type(columns)._make(
+                _as_stored(table, column, pending[column])
+                if column in pending else value
+                for column, value in zip(columns, row))
+
+    def overlay_loaded(self, table, record):
+        """Apply the pending updates to the loaded `record` of `table`."""
+        with self._lock:
+            pending = dict(self.pending.get((table, record.id), {}))
+        for column, value in pending.items():
+            sqlalchemy.orm.attributes.set_committed_value(
+                record, column, _as_stored(table, column, value))
+
+    def columns(self):
+        """The names of the columns with pending updates."""
+        with self._lock:
+            return {column for values in self.pending.values()
+                    for column in values}
+
+    def _schedule(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self.delay is not None and self.pending:
+            self._timer = threading.Timer(self.delay, self._on_timer)
+            self._timer.start()
+
+    def _on_timer(self):
+        try:
+            self.flush()
+        except Exception as exc:
+            # Keep the updates, the next update, read or `DKData.save` tries
+            # again.
+            warn("Writing the deferred updates failed: {}".format(exc))
+
+    def flush(self):
+        """Write all pending updates, return the number of updated records."""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self.pending:
+                return 0
+            written = self.pending
+            with _opened_book(self._data) as book:
+                base = self._data._reflect(book)
+                for (table, key), values in written.items():
+                    Table = _get_table(base, table)
+                    if book.session.query(Table).filter(
+                            Table.id == key).update(
+                                values, synchronize_session=False):
+                        self._data._record_changes(
+                            "updated", _change_kinds[table], [int(key)])
+                book.session.flush()
+                # If the book was open already, e.g. in a
+                # `dkhandle.Connection.transaction`, it may still be rolled
+                # back.  The updates are pending again then.
+                self.pending = collections.OrderedDict()
+                _on_rollback(self._data,
+                             functools.partial(self._restore, written))
+            return len(written)
+
+    def _restore(self, written):
+        """Make the `written` updates pending again, below the newer ones."""
+        with self._lock:
+            for key, values in self.pending.items():
+                written.setdefault(key, {}).update(values)
+            self.pending = written
+
+
+@functools.lru_cache()
+def _row_type(columns):
+    """The named tuple type for rows with the given `columns`."""
+    return collections.namedtuple("Row", columns)
+
+
+def _raise_unique_error(int_err):
+    """Raise a DatabaseError for a UNIQUE violation, else re-raise `int_err`."""
+    unique_expr = "UNIQUE constraint failed: "
+    if unique_expr in int_err.args[0]:
+        table_col = int_err.args[0].split(unique_expr)
+        table_name, col_name = table_col[-1].split(".")
+        exc = errors.DatabaseError(
+            table_name, col_name,
+            "`{}` of `{}` was not unique.".format(col_name, table_name))
+        raise exc from int_err
+    # Unhandled exception
+    raise int_err
 
 
 class DKData:
 
+    # Version of the DKCash tables, stored in the `dkcash_meta` table.
+    # 1: Initial version.
+    # 2: Typed date and amount columns in the contracts table.
+    # 3: Full text search index for the creditors.
+    # 4: Change log of creditors and contracts.
+    schema_version = 4
+
+    # The columns of the extra tables, in the order of the rows returned by
+    # `creditor_rows` and `contract_rows`.
+    creditor_columns = ("id", "name", "address1", "address2", "address3",
+                        "address4", "phone", "email", "newsletter")
+    contract_columns = ("id", "creditor", "account", "date", "amount",
+                        "interest", "interest_payment", "version",
+                        "period_type", "period_notice", "period_end",
+                        "cancellation_date", "active")
+
     account_params = {
         "dk": {"name": "Direktkredite",
                "type": "LIABILITY",
@@ -167,8 +724,11 @@ base_account : String, optional
         self._base_dk = base_dk
         self._base_ausgleich = base_ausgleich
         self._base_zinsen = base_zinsen
-        self._init_gnucash()
-        self._init_tables()
+        self._base = None
+        self._account_guids = {}
+        self._write_behind = None
+        self._subscribers = []
+        self._init_database()
 
     def _create_gnucash_file(self):
         """Creates the GnuCash file for this DKData object.
@@ -177,6 +737,92 @@ The GnuCash file must not exist yet."""
         new_book = piecash.create_book(self._gnucash_file)
         new_book.close()
 
+    def _reflect(self, book, refresh=False):
+        """Return the automapped database classes.
+
+The database is reflected only once and the result is cached, unless `refresh`
+is True.
+        """
+        if self._base is None or refresh:
+            Base = automap_base()
+            event.listen(Base.metadata, "column_reflect", _column_reflect)
+            Base.prepare(book.session.connection(), reflect=True)
+            _add_relationships(Base)
+            for table in _change_kinds:
+                if table in Base.classes:
+                    event.listen(Base.classes[table], "load",
+                                 self._overlay_listener(table))
+            self._base = Base
+        return self._base
+
+    def _init_database(self):
+        """Initialize the database, unless this has been done already.
+
+For files which are initialized and up to date, this is a single read of the
+`dkcash_meta` table.  Otherwise, e.g. also if the base accounts differ from the
+stored ones, the accounts and tables are created or migrated, and the meta data
+is written.
+        """
+        with _opened_book(self, readonly=True) as book:
+            meta = self._read_meta(book)
+            account_guids = {key: meta.get("account_" + key)
+                             for key in DKData.account_params}
+            up_to_date = (
+                meta.get("schema_version") == str(DKData.schema_version)
+                and all((meta.get(key) or "") == value
+                        for key, value in self._base_accounts().items())
+                and self._accounts_exist(account_guids, book=book))
+        if up_to_date:
+            self._account_guids = account_guids
+        else:
+            self._init_full()
+
+    @_book_open
+    def _init_full(self, book=None):
+        """Initialize accounts and tables, then write the meta data."""
+        self._init_gnucash()
+        self._init_tables()
+        self._write_meta(book=book)
+
+    def _read_meta(self, book):
+        """Return the content of the `dkcash_meta` table as dict."""
+        session = book.session
+        exists = session.execute(sqlalchemy.text(
+            "SELECT count(*) FROM sqlite_master "
+            "WHERE type = 'table' AND name = 'dkcash_meta'")).scalar()
+        if not exists:
+            return {}
+        return dict(session.execute(_meta_table.select()).fetchall())
+
+    def _base_accounts(self):
+        """The base accounts as stored in `dkcash_meta`, "" for the root."""
+        return {"base_dk": self._base_dk or "",
+                "base_ausgleich": self._base_ausgleich or "",
+                "base_zinsen": self._base_zinsen or ""}
+
+    def _write_meta(self, book):
+        """Write the schema version, base accounts and account guids to
+`dkcash_meta`."""
+        connection = book.session.connection()
+        _meta_table.create(bind=connection, checkfirst=True)
+        meta = {"schema_version": str(DKData.schema_version)}
+        meta.update(self._base_accounts())
+        for key, guid in self._account_guids.items():
+            meta["account_" + key] = guid
+        connection.execute(_meta_table.delete())
+        connection.execute(_meta_table.insert(),
+                           [{"key": key, "value": value}
+                            for key, value in meta.items()])
+
+    def _accounts_exist(self, account_guids, book):
+        """Check if all the accounts with the given guids exist."""
+        guids = list(account_guids.values())
+        if None in guids:
+            return False
+        found = book.session.query(piecash.Account).filter(
+            piecash.Account.guid.in_(guids)).count()
+        return found == len(guids)
+
     @_book_open
     def _init_gnucash(self, book=None):
         """Initialize the GnuCash database with the necessary accounts."""
@@ -190,15 +836,19 @@ The GnuCash file must not exist yet."""
         parent_zinsen = self._init_account(
             parent=self._base_zinsen,
             params=DKData.account_params["zinsen"])
+        # Need to flush to get the guids of new accounts.
+        book.flush()
+        self._account_guids = {"dk": parent_dk.guid,
+                               "ausgleich": parent_ausgleich.guid,
+                               "zinsen": parent_zinsen.guid}
 
     @_book_open
     def _init_tables(self, book=None):
         """Initialize the GnuCash database with extra tables."""
         # print("_init_tables")
         # print(self._gnucash_file)
-        engine = book.session.connection().engine
-        Base = automap_base()
-        Base.prepare(engine, reflect=True)
+        connection = book.session.connection()
+        Base = self._reflect(book)
 
         # Creditors table #####################################################
         if not "creditors" in Base.classes.__dir__():
@@ -217,44 +867,66 @@ The GnuCash file must not exist yet."""
                 newsletter = sqlalchemy.Column(sqlalchemy.Boolean,
                                                nullable=False)
 
-            Creditor.metadata.create_all(bind=engine)
-            Base = automap_base()
-            Base.prepare(engine, reflect=True)
+            Creditor.metadata.create_all(bind=connection)
+            Base = self._reflect(book, refresh=True)
 
         # print("Table `creditors` should exist now.")
         # import IPython; IPython.embed()
 
         # Contracts table #####################################################
         if not "contracts" in Base.classes.__dir__():
-            class Contract(Base):
-                __tablename__ = "contracts"
-                id = Column(sqlalchemy.String, primary_key=True)
-                creditor = Column(sqlalchemy.Integer,
-                                  ForeignKey('creditors.id'),
-                                  nullable=False)
-                account = Column(sqlalchemy.String, ForeignKey('accounts.guid'),
-                                 nullable=False)
-                date = Column(sqlalchemy.String, nullable=False)
-                amount = Column(sqlalchemy.Float, nullable=False)
-                interest = Column(sqlalchemy.Float, nullable=False)
-                interest_payment = Column(sqlalchemy.String, nullable=False)
-                version = Column(sqlalchemy.String, nullable=True)
-                period_type = Column(sqlalchemy.String, nullable=False)
-                period_notice = Column(sqlalchemy.String, nullable=True)
-                period_end = Column(sqlalchemy.String, nullable=True)
-                cancellation_date = Column(sqlalchemy.String, nullable=True)
-                active = Column(sqlalchemy.Boolean, nullable=False)
-
-            Contract.metadata.create_all(bind=engine)
-            Base = automap_base()
-            Base.prepare(engine, reflect=True)
-
-        # acc1 = Base.classes.accounts(name="Hello")
-        # print(acc1.name)
+            _contracts_table(Base.metadata).create(bind=connection)
+            Base = self._reflect(book, refresh=True)
 
         # print("Table `contracts` should exist now.")
         # import IPython; IPython.embed()
 
+        # Files of older versions have untyped contract columns.
+        if isinstance(Base.classes.contracts.__table__.c.amount.type,
+                      sqlalchemy.Float):
+            self._migrate_contracts(book=book)
+
+        # Search index ########################################################
+        exists = book.session.execute(sqlalchemy.text(
+            "SELECT count(*) FROM sqlite_master "
+            "WHERE name = 'creditors_fts'")).scalar()
+        if not exists:
+            try:
+                for statement in _search_ddl:
+                    book.session.execute(sqlalchemy.text(statement))
+            except sqlalchemy.exc.OperationalError as exc:
+                # The first statement fails, so nothing was created.
+                warn("No search index, the creditor search is slower: "
+                     "{}".format(exc.orig))
+
+        # Change log ##########################################################
+        exists = book.session.execute(sqlalchemy.text(
+            "SELECT count(*) FROM sqlite_master "
+            "WHERE name = 'dkcash_changes'")).scalar()
+        if not exists:
+            for statement in _changes_ddl:
+                book.session.execute(sqlalchemy.text(statement))
+
+    @_book_open
+    def _migrate_contracts(self, book=None):
+        """Migrate the contracts table to typed date and amount columns.
+
+Older files stored the dates as strings and the amount as float.  SQLite cannot
+change column types, so the data is copied into a new table (converting dates
+and amounts to cents on the way), which then replaces the old one.
+        """
+        connection = book.session.connection()
+        Base = self._reflect(book)
+        rows = [dict(row) for row in connection.execute(
+            Base.classes.contracts.__table__.select()).mappings()]
+        new_table = _contracts_table(Base.metadata, name="contracts_new")
+        new_table.create(bind=connection)
+        if rows:
+            connection.execute(new_table.insert(), rows)
+        connection.execute(sqlalchemy.text("DROP TABLE contracts"))
+        connection.execute(sqlalchemy.text(
+            "ALTER TABLE contracts_new RENAME TO contracts"))
+        self._reflect(book, refresh=True)
 
     @_book_open
     def _init_account(self, parent, params, book=None):
@@ -324,9 +996,7 @@ Returns
 out : str
 The ID of the new creditor.
         """
-        engine = book.session.connection().engine
-        Base = automap_base()
-        Base.prepare(engine, reflect=True)
+        Base = self._reflect(book)
         Creditor = _get_table(Base, "creditors")
         addr = [""] * 4
         if type(address) == str:
@@ -343,60 +1013,251 @@ The ID of the new creditor.
         book.session.add(creditor)
         # import IPython; IPython.embed()
         book.session.flush()
+        self._record_changes("inserted", "creditor", [creditor.id])
         return creditor.id
 
-    @_book_open
+    def subscribe(self, callback):
+        """Call `callback(events)` after each saved change of the data.
+
+`events` is a list of ChangeEvent, the changes which were saved together, in
+order and without duplicates.  This is meant for updating views (e.g. Qt models)
+without reading everything again.
+
+The callback is called in the thread which saved the changes, which may be a
+worker thread (e.g. for deferred writes, see `defer_writes`).  Exceptions in the
+callback are turned into warnings, the changes are saved already.
+        """
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        """Remove a callback which was added with `subscribe`."""
+        self._subscribers.remove(callback)
+
+    def _record_changes(self, action, kind, ids):
+        """Record ChangeEvents, to be published when the book is saved."""
+        events = _open_books.events.get(os.path.abspath(self._gnucash_file))
+        if events is not None:
+            events.extend(ChangeEvent(action, kind, key) for key in ids)
+
+    def _publish(self, events):
+        events = list(dict.fromkeys(events))
+        for callback in list(self._subscribers):
+            try:
+                callback(events)
+            except Exception as exc:
+                warn("Change subscriber {!r} failed: {}".format(callback, exc))
+
+    def defer_writes(self, enabled=True, delay=0.5):
+        """Defer the updates of creditors and contracts (write-behind).
+
+This is meant for interactive editing, where each edited field would otherwise
+be written (and the file saved) on its own.  With deferred writes,
+`update_creditors` and `update_contracts` (and thus the `update` methods of
+`common.Creditor` and `common.Contract`) only record the new values and return
+the updated rows.  Repeated updates of the same record are merged.
+
+The recorded updates are written in one transaction:
+
+- `delay` seconds after the last update,
+- when `save` is called,
+- before any other write through this object, and before reads which can not
+  show them otherwise.
+
+The reads of creditors and contracts (e.g. `find_creditors`, `contract_rows`,
+`contract_page`) apply the pending updates to their results instead, so that
+repeated edits and reads are still merged.  Only if their filters or sort order
+use an updated column, the updates are written first.
+
+Errors, e.g. invalid values, only show up when the updates are written.  Inside
+a `dkhandle.Connection.transaction`, updates are written immediately.
+
+Parameters
+----------
+enabled : bool, optional
+    If False, the pending updates are written and the following ones are not
+    deferred any more.  Default is True.
+
+delay : float, optional
+    Seconds after the last update until it is written, None to write only on
+    `save` (or before other operations).  Default is 0.5.
+        """
+        if not enabled:
+            if self._write_behind is not None:
+                self._write_behind.flush()
+            self._write_behind = None
+            return
+        if self._write_behind is None:
+            self._write_behind = _WriteBehind(self, delay)
+        else:
+            self._write_behind.delay = delay
+
+    def save(self):
+        """Write the deferred updates now, see `defer_writes`.
+
+Returns
+-------
+out : int
+    The number of updated records.
+        """
+        if self._write_behind is None:
+            return 0
+        return self._write_behind.flush()
+
+    def pending_writes(self):
+        """The deferred updates which were not written yet.
+
+Returns
+-------
+out : dict
+    (table name, ID) -> dict of the new values.
+        """
+        if self._write_behind is None:
+            return {}
+        with self._write_behind._lock:
+            return {key: dict(values)
+                    for key, values in self._write_behind.pending.items()}
+
+    def _overlay_listener(self, table):
+        """Return a listener for the "load" event of `table`'s class, which
+applies the deferred updates to the loaded records."""
+        def on_load(record, context):
+            if self._write_behind is not None:
+                self._write_behind.overlay_loaded(table, record)
+        return on_load
+
+    def _overlay_writes(self, table, rows):
+        """Apply the deferred updates to `rows` of `table`, see `defer_writes`.
+
+The rows must have the values of `creditor_columns` or `contract_columns`.
+Returns an iterator over the rows.
+        """
+        if self._write_behind is None:
+            return iter(rows)
+        columns = {"creditors": self.creditor_columns,
+                   "contracts": self.contract_columns}[table]
+        return (self._write_behind.overlay(table, columns, row)
+                for row in rows)
+
+    def _writes_filtered(self, kwargs):
+        """True if the filters or the sort order in `kwargs` use a column with
+deferred updates."""
+        if self._write_behind is None:
+            return False
+        used = set(kwargs)
+        used.add(kwargs.get("order_by"))
+        return bool(used & self._write_behind.columns())
+
+    def _flush_writes(self):
+        """Write the deferred updates before another operation.
+
+This is not possible while the book is open read-only in this thread, e.g.
+during `iter_creditor_rows`.
+        """
+        if self._write_behind is None or not self._write_behind.pending:
+            return
+        if os.path.abspath(self._gnucash_file) in _open_books.readonly:
+            return
+        self._write_behind.flush()
+
     def update_creditor(self, creditor_id,
                         name=None, phone=None, email=None,
                         newsletter=None, address1=None, address2=None,
-                        address3=None, address4=None, book=None):
+                        address3=None, address4=None):
         """Updates the creditor's entry in the database.
 
+Only the values which are not None are changed.
+
 Returns
 -------
 out: boolean
 True if something was updated, else False.
         """
-        creditor = self.find_creditors(id=creditor_id)[0]
-        update = False
-        if name is not None:
-            creditor.name = name
-            update = True
-        if address1 is not None:
-            creditor.address1 = address1
-            update = True
-        if address2 is not None:
-            creditor.address2 = address2
-            update = True
-        if address3 is not None:
-            creditor.address3 = address3
-            update = True
-        if address4 is not None:
-            creditor.address4 = address4
-            update = True
-        if phone is not None:
-            creditor.phone = phone
-            print(creditor.phone)
-            update = True
-        if email is not None:
-            creditor.email = email
-            update = True
-        if newsletter is not None:
-            creditor.newsletter = newsletter
-            update = True
-        if update:
-            book.session.commit()
+        values = {"name": name, "phone": phone, "email": email,
+                  "newsletter": newsletter, "address1": address1,
+                  "address2": address2, "address3": address3,
+                  "address4": address4}
+        values = {key: value for key, value in values.items()
+                  if value is not None}
+        if not values:
+            return False
+        return len(self.update_creditors([creditor_id], **values)) > 0
+
+    def update_creditors(self, creditor_ids, **values):
+        """Set the same values for all given creditors.
+
+The database is changed with a single UPDATE statement for the given columns,
+the changed rows are read back in the same transaction.  If writes are
+deferred (see `defer_writes`), the update is only recorded.
+
+Parameters
+----------
+creditor_ids : iterable
+    The IDs of the creditors to be updated.
+
+**values :
+    Column -> new value.
+
+Returns
+-------
+out : list
+    The updated creditors as tuples, see `creditor_rows`.
+        """
+        return self._update_rows("creditors", self.creditor_columns,
+                                 list(creditor_ids), values)
+
+    def _update_rows(self, table, columns, keys, values):
+        """UPDATE the rows of `table` with the primary keys `keys`.
+
+Returns the updated rows with the given `columns`.
+        """
+        if not keys:
+            return []
+        for column in values:
+            if column not in columns or column == "id":
+                raise ValueError("Cannot update column: {}".format(column))
+        filename = os.path.abspath(self._gnucash_file)
+        if (self._write_behind is not None and values
+                and (filename not in _open_books.books
+                     or filename in _open_books.readonly)):
+            # Deferred, unless inside a `dkhandle.Connection.transaction`.
+            with _opened_book(self, readonly=True) as book:
+                Table = _get_table(self._reflect(book), table)
+                rows = book.session.query(*[getattr(Table, column)
+                                            for column in columns]).filter(
+                                                Table.id.in_(keys)).all()
+            return self._write_behind.add(table, columns, rows, values)
+        with _opened_book(self) as book:
+            self._flush_writes()
+            rows = self._write_rows(_get_table(self._reflect(book), table),
+                                    columns, keys, values, book)
+            if values:
+                self._record_changes("updated", _change_kinds[table],
+                                     [int(row.id) for row in rows])
+            return rows
+
+    @staticmethod
+    def _write_rows(Table, columns, keys, values, book):
+        if values:
+            book.session.query(Table).filter(Table.id.in_(keys)).update(
+                values, synchronize_session=False)
             book.session.flush()
-            print(creditor)
-        return update
+        query = book.session.query(*[getattr(Table, column)
+                                     for column in columns])
+        return query.filter(Table.id.in_(keys)).all()
 
-    @_book_open
-    def find_creditors(self, book=None, **kwargs):
+    @_book_read(overlay=True)
+    def find_creditors(self, book=None, include=(), **kwargs):
         """Find creditors matching the given filters.
 
 Parameters
 ----------
 
+include : iterable of str, optional
+    Related records which are loaded together with the creditors, instead of
+    one query per creditor when they are accessed.  Possible values are
+    "contracts" (as the `contracts` attribute) and nested paths such as
+    "contracts.splits", see `find_contracts`.
+
 **kwargs : SqlAlchemy filters
     Filters which are passed on to SqlAlchemy's `filter_by` method:
     https://docs.sqlalchemy.org/en/13/orm/query.html#sqlalchemy.orm.query.Query.filter_by
@@ -409,26 +1270,358 @@ Returns
 out : Query
 An iterable of contracts (automapped by SqlAlchemy).
         """
-        engine = book.session.connection().engine
-        Base = automap_base()
-        Base.prepare(engine, reflect=True)
+        Base = self._reflect(book)
         Creditor = _get_table(Base, "creditors")
         if "address" in kwargs:
             raise NotImplementedError(
                 "Special handling for generic address expr not implemented.")
-        filtered = _filter_flexible(book.session.query(Creditor), Creditor,
-                                    **kwargs)
+        filtered = _filter_flexible(book.session, Creditor, **kwargs)
+        if include:
+            filtered = filtered.options(
+                *_include_options(Base, "creditors", include))
         return filtered
 
+    @staticmethod
+    def query_cache_stats():
+        """Statistics of the cache of filtered queries, see `_QueryCache`.
+
+Returns
+-------
+out : dict
+    With the keys "hits", "misses", "hit_rate" and "size".
+        """
+        return _query_cache.stats()
+
+    @_book_read(overlay=True)
+    def creditor_rows(self, book=None, **kwargs):
+        """Like `find_creditors`, but return plain rows instead of objects.
+
+Returns
+-------
+out : list
+    The matching creditors as tuples, with the values in the order of
+    `creditor_columns`.
+        """
+        Creditor = _get_table(self._reflect(book), "creditors")
+        query = self.find_creditors(**kwargs).with_entities(
+            *[getattr(Creditor, column) for column in self.creditor_columns])
+        return list(self._overlay_writes("creditors", query.all()))
+
+    def _page(self, query, Table, columns, key, order_by, page_size, after):
+        """Return one page of `query`, see `creditor_page`."""
+        if page_size < 1:
+            raise ValueError("`page_size` must be positive.")
+        if order_by == "id":
+            order = (key,)
+        else:
+            order = (getattr(Table, order_by), key)
+        if after is not None:
+            query = query.filter(sqlalchemy.tuple_(*order) > tuple(after))
+        rows = query.with_entities(*columns.values()).order_by(*order).limit(
+            page_size + 1).all()
+        if len(rows) <= page_size:
+            return Page(rows, None)
+        rows = rows[:page_size]
+        last = rows[-1]
+        cursor = [int(last.id)]
+        if order_by != "id":
+            cursor.insert(0, getattr(last, order_by))
+        return Page(rows, tuple(cursor))
+
+    @_book_read(overlay=True)
+    def creditor_page(self, page_size=100, after=None, order_by="id",
+                      book=None, **kwargs):
+        """Return one page of the creditors matching the filters.
+
+This uses keyset pagination: The rows are ordered by `order_by` and the ID, and
+the next page starts after the last row of the previous one, without skipping
+over all rows before it.  Rows which are inserted or deleted in between do not
+lead to duplicate or skipped rows.
+
+Parameters
+----------
+page_size : int, optional
+    The maximum number of rows, default is 100.
+
+after : tuple, optional
+    The cursor of the previous page.  By default, the first page is returned.
+
+order_by : str, optional
+    The column to order by, "id" (the default) or "name".
+
+**kwargs :
+    Filters, see `find_creditors`.
+
+Returns
+-------
+out : Page
+    The rows as in `creditor_rows`, and the cursor for the next page.
+        """
+        Creditor = _get_table(self._reflect(book), "creditors")
+        columns = {column: getattr(Creditor, column)
+                   for column in self.creditor_columns}
+        if order_by not in ("id", "name"):
+            raise ValueError("Cannot order by `{}`.".format(order_by))
+        page = self._page(self.find_creditors(**kwargs), Creditor, columns,
+                          Creditor.id, order_by, page_size, after)
+        return page._replace(rows=list(self._overlay_writes("creditors",
+                                                            page.rows)))
+
+    @_book_read(overlay=True)
+    def contract_page(self, page_size=100, after=None, order_by="id",
+                      book=None, **kwargs):
+        """Return one page of the contracts matching the filters.
+
+Like `creditor_page`, `order_by` may be "id", "creditor", "date" or "amount".
+The contracts are ordered by the numerical value of their ID.
+
+Returns
+-------
+out : Page
+    The rows as in `contract_rows`, and the cursor for the next page.
+        """
+        Contract = _get_table(self._reflect(book), "contracts")
+        columns = {column: getattr(Contract, column)
+                   for column in self.contract_columns}
+        if order_by not in ("id", "creditor", "date", "amount"):
+            raise ValueError("Cannot order by `{}`.".format(order_by))
+        page = self._page(self.find_contracts(**kwargs), Contract, columns,
+                          sqlalchemy.cast(Contract.id, sqlalchemy.Integer),
+                          order_by, page_size, after)
+        return page._replace(rows=list(self._overlay_writes("contracts",
+                                                            page.rows)))
+
+    @_book_read
+    def search_creditors(self, text, limit=20, fuzzy=True, book=None):
+        """Search creditors by name, address, email or phone number.
+
+All creditors which contain `text` (case insensitive) in one of these columns
+are found with the full text index.  If there are less than `limit` of them and
+`fuzzy` is True, creditors with a similar text are added, e.g. with typos.
+These are ranked by the share of the trigrams of `text` which they contain.
+
+If SQLite has no trigram tokenizer and thus the file no index, the creditors
+are searched with LIKE, and all of them are candidates for similar matches.
+
+Parameters
+----------
+text : str
+    The search text.  With less than three characters, only creditors whose
+    name starts with it are found.
+
+limit : int, optional
+    The maximum number of results, default is 20.
+
+fuzzy : bool, optional
+    If similar matches shall be found, too.  Default is True.
+
+Returns
+-------
+out : list
+    The creditors as tuples in the order of `creditor_columns`, the best
+    matches first.
+        """
+        Creditor = _get_table(self._reflect(book), "creditors")
+        columns = [getattr(Creditor, column)
+                   for column in self.creditor_columns]
+        text = text.strip()
+        if len(text) < 3:
+            return book.session.query(*columns).filter(
+                Creditor.name.like(text + "%")).order_by(
+                    Creditor.name, Creditor.id).limit(limit).all()
+
+        search_columns = [getattr(Creditor, column)
+                          for column in _search_columns]
+        indexed = book.session.execute(sqlalchemy.text(
+            "SELECT count(*) FROM sqlite_master "
+            "WHERE name = 'creditors_fts'")).scalar()
+        search = sqlalchemy.text(
+            "SELECT rowid FROM creditors_fts WHERE creditors_fts MATCH :query "
+            "ORDER BY rank LIMIT :limit")
+        if indexed:
+            phrase = '"{}"'.format(text.replace('"', '""'))
+            ids = [row[0] for row in book.session.execute(
+                search, {"query": phrase, "limit": limit})]
+        else:
+            pattern = "%{}%".format(text.replace("\\", "\\\\").replace(
+                "%", "\\%").replace("_", "\\_"))
+            ids = [row[0] for row in book.session.query(Creditor.id).filter(
+                sqlalchemy.or_(*[column.like(pattern, escape="\\")
+                                 for column in search_columns])).order_by(
+                                     Creditor.name, Creditor.id).limit(limit)]
+        if fuzzy and len(ids) < limit:
+            trigrams = _trigrams(text)
+            candidates = book.session.query(Creditor.id, *search_columns)
+            if indexed:
+                query = " OR ".join('"{}"'.format(trigram.replace('"', '""'))
+                                    for trigram in sorted(trigrams))
+                candidates = candidates.filter(Creditor.id.in_(
+                    [row[0] for row in book.session.execute(
+                        search, {"query": query, "limit": 10 * limit})]))
+            scores = {}
+            for row in candidates:
+                if row[0] in ids:
+                    continue
+                scores[row[0]] = max(len(trigrams & _trigrams(value))
+                                     for value in row[1:]) / len(trigrams)
+            similar = sorted((rowid for rowid, score in scores.items()
+                              if score >= 0.3),
+                             key=lambda rowid: (-scores[rowid], rowid))
+            ids += similar[:limit - len(ids)]
+        rows = {row[0]: row for row in book.session.query(*columns).filter(
+            Creditor.id.in_(ids))}
+        return [rows[rowid] for rowid in ids]
+
+    @_book_read
+    def creditor_contract_rows(self, book=None, **kwargs):
+        """The creditors together with their contracts, in one query.
+
+Parameters
+----------
+**kwargs :
+    Filters for the creditors, see `find_creditors`.
+
+Returns
+-------
+out : list
+    Tuples (creditor, contract), with the values in the order of
+    `creditor_columns` and `contract_columns`.  Creditors without contracts
+    occur once, with None as contract.  Ordered by the creditor ID.
+        """
+        Base = self._reflect(book)
+        Creditor = _get_table(Base, "creditors")
+        Contract = _get_table(Base, "contracts")
+        query = self.find_creditors(**kwargs).outerjoin(
+            Contract, Contract.creditor == Creditor.id).with_entities(
+                *[getattr(Creditor, column)
+                  for column in self.creditor_columns],
+                *[getattr(Contract, column)
+                  for column in self.contract_columns]).order_by(Creditor.id)
+        count = len(self.creditor_columns)
+        return [(tuple(row[:count]),
+                 tuple(row[count:]) if row[count] is not None else None)
+                for row in query]
+
+    def iter_creditor_rows(self, batch_size=500, **kwargs):
+        """Like `creditor_rows`, but yield the rows one by one.
+
+The rows are fetched from the database in batches of `batch_size`, so that the
+memory use does not depend on the number of rows.  The rows are ordered by ID.
+
+The book stays open read-only until the generator is exhausted or closed, it can
+not be changed in the meantime.  Deferred updates are applied to the rows, see
+`defer_writes`.
+        """
+        if self._writes_filtered(kwargs):
+            self._flush_writes()
+        with _opened_book(self, readonly=True) as book:
+            Creditor = _get_table(self._reflect(book), "creditors")
+            query = self.find_creditors(**kwargs).with_entities(
+                *[getattr(Creditor, column)
+                  for column in self.creditor_columns]).order_by(Creditor.id)
+            yield from self._overlay_writes("creditors",
+                                            query.yield_per(batch_size))
+
+    def iter_contract_rows(self, batch_size=500, **kwargs):
+        """Like `contract_rows`, but yield the rows one by one.
+
+See `iter_creditor_rows`.  The rows are ordered by the numerical value of the
+ID.
+        """
+        if self._writes_filtered(kwargs):
+            self._flush_writes()
+        with _opened_book(self, readonly=True) as book:
+            Contract = _get_table(self._reflect(book), "contracts")
+            query = self.find_contracts(**kwargs).with_entities(
+                *[getattr(Contract, column)
+                  for column in self.contract_columns]).order_by(
+                      sqlalchemy.cast(Contract.id, sqlalchemy.Integer))
+            yield from self._overlay_writes("contracts",
+                                            query.yield_per(batch_size))
+
     @_book_open
     def delete_creditor(self, creditor_id, book=None):
         """Remove this creditor from the database."""
-        deleted = self.find_creditors(id=creditor_id).delete()
+        deleted = self.find_creditors(id=creditor_id).delete(
+            synchronize_session=False)
         if deleted >= 2:
             raise RuntimeError("Deleted more than one creditor, but only one "
                                "should have existed.")
         if deleted == 0:
             raise ValueError("Tried to delete non-existent creditor.")
+        self._record_changes("deleted", "creditor", [creditor_id])
+
+    @_book_open
+    def delete_creditors(self, creditor_ids, delete_contracts=False,
+                         delete_accounts=False, book=None):
+        """Remove many creditors from the database, in one transaction.
+
+All checks are done before anything is deleted, then there is one DELETE
+statement for the contracts and one for the creditors.
+
+Parameters
+----------
+creditor_ids : iterable
+    The IDs of the creditors to be deleted.  All of them must exist.
+
+delete_contracts : bool, optional
+    If the creditors' contracts shall also be deleted.  Default is False.  If
+    False, an exception is raised if there are any contracts by these
+    creditors.
+
+delete_accounts : bool, optional
+    If the GnuCash accounts of the deleted contracts shall also be deleted.
+    Accounts which still have transactions or sub-accounts are kept.  Default
+    is False.
+
+Returns
+-------
+out : tuple
+    The numbers of deleted creditors, contracts and accounts.
+        """
+        Base = self._reflect(book)
+        Creditor = _get_table(Base, "creditors")
+        Contract = _get_table(Base, "contracts")
+        session = book.session
+        creditor_ids = set(creditor_ids)
+        if not creditor_ids:
+            return 0, 0, 0
+
+        existing = {row[0] for row in session.query(Creditor.id).filter(
+            Creditor.id.in_(creditor_ids))}
+        if existing != creditor_ids:
+            raise ValueError("Tried to delete non-existent creditor(s): {}"
+                             .format(sorted(creditor_ids - existing)))
+        contract_filter = Contract.creditor.in_(creditor_ids)
+        linked = session.query(Contract.id, Contract.account).filter(
+            contract_filter).all()
+        if linked and not delete_contracts:
+            raise errors.DatabaseError(
+                "creditors", "id",
+                "There are still contracts linked to the creditors: {}".format(
+                    sorted(row[0] for row in linked)))
+
+        deleted_contracts = 0
+        if linked:
+            deleted_contracts = session.query(Contract).filter(
+                contract_filter).delete(synchronize_session=False)
+        deleted_creditors = session.query(Creditor).filter(
+            Creditor.id.in_(creditor_ids)).delete(synchronize_session=False)
+
+        deleted_accounts = 0
+        if delete_accounts and linked:
+            guids = [row[1] for row in linked]
+            for account in session.query(piecash.Account).filter(
+                    piecash.Account.guid.in_(guids)):
+                if account.splits or account.children:
+                    continue
+                session.delete(account)
+                deleted_accounts += 1
+        session.flush()
+        self._record_changes("deleted", "contract",
+                             sorted(int(row[0]) for row in linked))
+        self._record_changes("deleted", "creditor", sorted(creditor_ids))
+        return deleted_creditors, deleted_contracts, deleted_accounts
 
     @_book_open
     def add_contract(self, contract_id, creditor, date, amount, interest,
@@ -487,14 +1680,12 @@ Returns
 out : None
 
         """
-        engine = book.session.connection().engine
-        Base = automap_base()
-        Base.prepare(engine, reflect=True)
+        Base = self._reflect(book)
         Contract = _get_table(Base, "contracts")
 
         contract_id = int(contract_id)
         # print("Add contract {}".format(contract_id))
-        dk_parent_account = book.accounts.get(name="Direktkredite")
+        dk_parent_account = book.accounts.get(guid=self._account_guids["dk"])
         dk_account_name = "DK {:03d}".format(contract_id)
         dk_account_code = "{parent_code}{contract_id:03d}".format(
             parent_code=dk_parent_account.code,
@@ -520,80 +1711,156 @@ out : None
         try:
             book.session.flush()
         except sqlalchemy.exc.IntegrityError as int_err:
-            unique_expr = "UNIQUE constraint failed: "
-            if unique_expr in int_err.args[0]:
-                table_col = int_err.args[0].split(unique_expr)
-                table_name, col_name = table_col[-1].split(".")
-                exc = errors.DatabaseError(
-                    table_name, col_name,
-                    "`{}` of `{}` was not unique.".format(
-                        col_name, table_name))
-                raise exc from int_err
-            # Unhandled exception
-            raise int_err
+            _raise_unique_error(int_err)
+        self._record_changes("inserted", "contract", [int(contract_id)])
 
     @_book_open
+    def add_creditors(self, creditors, book=None):
+        """Add many creditors at once, in one transaction.
+
+Parameters
+----------
+creditors : iterable of dict
+    The keyword arguments of `add_creditor` for each creditor.
+
+Returns
+-------
+out : list
+    The IDs of the new creditors, in the same order.
+        """
+        Base = self._reflect(book)
+        Creditor = _get_table(Base, "creditors")
+        added = []
+        for values in creditors:
+            address = values.get("address", "")
+            if isinstance(address, str):
+                address = [address]
+            address = (list(address) + [""] * 4)[:4]
+            if not address[0]:
+                raise ValueError("Address field must not be empty.")
+            added.append(Creditor(
+                name=values["name"], address1=address[0],
+                address2=address[1], address3=address[2],
+                address4=address[3], phone=values.get("phone"),
+                email=values.get("email"),
+                newsletter=values.get("newsletter", False)))
+        book.session.add_all(added)
+        book.session.flush()
+        ids = [creditor.id for creditor in added]
+        self._record_changes("inserted", "creditor", ids)
+        return ids
+
+    @_book_open
+    def add_contracts(self, contracts, book=None):
+        """Add many contracts at once, in one transaction.
+
+Like `add_contract`, but the GnuCash accounts are created with one flush and
+the contracts with one multi-row insert.
+
+Parameters
+----------
+contracts : iterable of dict
+    The keyword arguments of `add_contract` for each contract, with `id`
+    instead of `contract_id`.
+
+Returns
+-------
+out : int
+    The number of added contracts.
+        """
+        Base = self._reflect(book)
+        Contract = _get_table(Base, "contracts")
+        defaults = {"interest_payment": "payout",
+                    "period_type": "fixed_duration", "period_notice": None,
+                    "period_end": None, "version": None,
+                    "cancellation_date": None}
+        parent = book.accounts.get(guid=self._account_guids["dk"])
+        accounts = {child.name: child for child in parent.children}
+        EUR = book.commodities.get(mnemonic="EUR")
+        records = []
+        for values in contracts:
+            record = dict(defaults, active=False)
+            record.update(values)
+            record["id"] = int(record["id"])
+            name = "DK {:03d}".format(record["id"])
+            if name not in accounts:
+                accounts[name] = piecash.Account(
+                    name=name, type="LIABILITY", parent=parent, commodity=EUR,
+                    code="{}{:03d}".format(parent.code, record["id"]))
+            records.append((record, accounts[name]))
+        if not records:
+            return 0
+        # Need to flush to get guids for the accounts.
+        book.flush()
+        try:
+            book.session.execute(
+                Contract.__table__.insert(),
+                [dict(record, account=account.guid)
+                 for record, account in records])
+        except sqlalchemy.exc.IntegrityError as int_err:
+            _raise_unique_error(int_err)
+        self._record_changes("inserted", "contract",
+                             [record["id"] for record, _ in records])
+        return len(records)
+
     def update_contract(self, contract_id, creditor=None, date=None,
                         amount=None, interest=None, interest_payment=None,
                         period_type=None, period_notice=None, period_end=None,
-                        version=None, cancellation_date=None, active=None,
-                        book=None):
+                        version=None, cancellation_date=None, active=None):
         """Updates the contract's entry in the database.
 
+Only the values which are not None are changed.
+
 Returns
 -------
 out: boolean
 True if something was updated, else False.
         """
-        contract = self.find_contracts(id=contract_id)[0]
-        update = False
-        if creditor is not None:
-            contract.creditor = creditor
-            update = True
-        if date is not None:
-            contract.date = date
-            update = True
-        if amount is not None:
-            contract.amount = amount
-            update = True
-        if interest is not None:
-            contract.interest = interest
-            update = True
-        if interest_payment is not None:
-            contract.interest_payment = interest_payment
-            update = True
-        if period_type is not None:
-            contract.period_type = period_type
-            update = True
-        if period_notice is not None:
-            contract.period_notice = period_notice
-            update = True
-        if period_end is not None:
-            contract.period_end = period_end
-            update = True
-        if version is not None:
-            contract.version = version
-            update = True
-        if cancellation_date is not None:
-            contract.cancellation_date = cancellation_date
-            update = True
-        if active is not None:
-            contract.active = active
-            update = True
-        if update:
-            book.session.commit()
-            book.session.flush()
-            print(creditor)
-        return update
+        values = {"creditor": creditor, "date": date, "amount": amount,
+                  "interest": interest, "interest_payment": interest_payment,
+                  "period_type": period_type, "period_notice": period_notice,
+                  "period_end": period_end, "version": version,
+                  "cancellation_date": cancellation_date, "active": active}
+        values = {key: value for key, value in values.items()
+                  if value is not None}
+        if not values:
+            return False
+        return len(self.update_contracts([contract_id], **values)) > 0
+
+    def update_contracts(self, contract_ids, **values):
+        """Set the same values for all given contracts, e.g. `active=False`.
+
+Like `update_creditors`.
 
+Parameters
+----------
+contract_ids : iterable
+    The IDs of the contracts to be updated.
 
-    @_book_open
-    def find_contracts(self, book=None, **kwargs):
+**values :
+    Column -> new value.
+
+Returns
+-------
+out : list
+    The updated contracts as tuples, see `contract_rows`.
+        """
+        return self._update_rows("contracts", self.contract_columns,
+                                 [str(key) for key in contract_ids], values)
+
+    @_book_read(overlay=True)
+    def find_contracts(self, book=None, include=(), **kwargs):
         """Find contracts matching the given filters.
 
 Parameters
 ----------
 
+include : iterable of str, optional
+    Related records which are loaded together with the contracts, so that a
+    listing needs a fixed number of queries.  Possible values are "creditor"
+    (loaded into the `creditor_record` attribute), "account" (`account_record`)
+    and "splits" (`splits`, the GnuCash splits of the contract's account).
+
 **kwargs : SqlAlchemy filters
     Filters which are passed on to SqlAlchemy's `filter_by` method:
     https://docs.sqlalchemy.org/en/13/orm/query.html#sqlalchemy.orm.query.Query.filter_by
@@ -607,20 +1874,166 @@ Returns
 out : Query
 An iterable of contracts (automapped by SqlAlchemy).
              """
-        engine = book.session.connection().engine
-        Base = automap_base()
-        Base.prepare(engine, reflect=True)
+        Base = self._reflect(book)
         Contract = _get_table(Base, "contracts")
-        filtered = _filter_flexible(book.session.query(Contract), Contract,
-                                    **kwargs)
+        filtered = _filter_flexible(book.session, Contract, **kwargs)
+        if include:
+            filtered = filtered.options(
+                *_include_options(Base, "contracts", include))
         return filtered
 
+    @_book_read(overlay=True)
+    def contract_rows(self, book=None, **kwargs):
+        """Like `find_contracts`, but return plain rows instead of objects.
+
+Returns
+-------
+out : list
+    The matching contracts as tuples, with the values in the order of
+    `contract_columns`.
+        """
+        Contract = _get_table(self._reflect(book), "contracts")
+        query = self.find_contracts(**kwargs).with_entities(
+            *[getattr(Contract, column) for column in self.contract_columns])
+        return list(self._overlay_writes("contracts", query.all()))
+
+    @_book_read
+    def sum_amounts(self, book=None, **kwargs):
+        """The total amount of all contracts matching the filters.
+
+The sum is calculated by the database, see `find_contracts` for the filters.
+
+Returns
+-------
+out : Decimal
+        """
+        Contract = _get_table(self._reflect(book), "contracts")
+        total = self.find_contracts(**kwargs).with_entities(
+            sqlalchemy.func.sum(Contract.amount)).scalar()
+        if total is None:
+            return Decimal("0.00")
+        return total
+
+    @_book_read
+    def changes_since(self, seq=0, book=None):
+        """The creditors and contracts which changed after `seq`.
+
+Changes are counted by the `dkcash_changes` table, whoever made them.
+
+Parameters
+----------
+seq : int, optional
+    The sequence number returned by a previous call, 0 for all records which
+    were ever changed.
+
+Returns
+-------
+out : tuple
+    (seq, changes), with the current sequence number and a dict: "creditor" or
+    "contract" -> set of IDs (int) which were inserted, updated or deleted.
+        """
+        changes = {"creditor": set(), "contract": set()}
+        rows = book.session.execute(sqlalchemy.text(
+            "SELECT kind, key, seq FROM dkcash_changes WHERE seq > :seq"),
+                                    {"seq": seq}).fetchall()
+        for kind, key, row_seq in rows:
+            changes[kind].add(int(key))
+            seq = max(seq, row_seq)
+        return seq, changes
+
+    @_book_read
+    def contract_overview_rows(self, contract_ids=None, creditor_ids=None,
+                               book=None):
+        """The contracts together with their creditor's name.
+
+Parameters
+----------
+contract_ids, creditor_ids : iterable, optional
+    If any of them is given, only the given contracts and the contracts of the
+    given creditors are returned.
+
+Returns
+-------
+out : list
+    Tuples with the values of `contract_columns` and the creditor's name.
+        """
+        Base = self._reflect(book)
+        Creditor = _get_table(Base, "creditors")
+        Contract = _get_table(Base, "contracts")
+        query = book.session.query(
+            *[getattr(Contract, column) for column in self.contract_columns],
+            Creditor.name).join(Creditor, Creditor.id == Contract.creditor)
+        if contract_ids is not None or creditor_ids is not None:
+            query = query.filter(sqlalchemy.or_(
+                Contract.id.in_([str(key) for key in contract_ids or ()]),
+                Contract.creditor.in_(list(creditor_ids or ()))))
+        return query.all()
+
+    @_book_read
+    def gnucash_state(self, book=None):
+        """Return a cheap fingerprint of the GnuCash tables.
+
+The file may be edited in GnuCash, too.  If the fingerprint did not change, no
+transactions have been added, changed or deleted in the meantime.  GnuCash
+saves a changed transaction by deleting and inserting its splits again, so
+changes show up as new split rowids.
+
+Returns
+-------
+out : GnuCashState
+        """
+        values = book.session.execute(sqlalchemy.text(
+            "SELECT (SELECT count(*) FROM splits), "
+            "(SELECT max(rowid) FROM splits), "
+            "(SELECT count(*) FROM accounts), "
+            "(SELECT max(rowid) FROM accounts), "
+            "(SELECT max(enter_date) FROM transactions), "
+            "(SELECT max(post_date) FROM transactions)")).fetchone()
+        return GnuCashState._make(values)
+
+    @_book_read
+    def split_rows(self, since=None, book=None):
+        """Return the splits of all transactions, or only the new ones.
+
+Parameters
+----------
+since : GnuCashState, optional
+    If given, only splits which were added or changed after this state are
+    returned, i.e. those with a larger rowid or of transactions entered later.
+
+Returns
+-------
+out : list of SplitRow
+    The post date is a datetime.date, the value a Decimal, the description is
+    the transaction's.
+        """
+        statement = (
+            "SELECT splits.rowid, splits.guid, splits.account_guid, "
+            "transactions.post_date, splits.value_num, splits.value_denom, "
+            "transactions.description "
+            "FROM splits JOIN transactions "
+            "ON splits.tx_guid = transactions.guid")
+        params = {}
+        if since is not None:
+            statement += (" WHERE splits.rowid > :rowid "
+                          "OR transactions.enter_date > :enter_date")
+            params = {"rowid": since.max_split_rowid or 0,
+                      "enter_date": since.max_enter_date or ""}
+        rows = book.session.execute(sqlalchemy.text(statement), params)
+        return [SplitRow(rowid, guid, account,
+                         _to_date(post_date[:10]) if post_date else None,
+                         Decimal(num) / Decimal(denom), description)
+                for rowid, guid, account, post_date, num, denom, description
+                in rows]
+
     @_book_open
     def delete_contract(self, contract_id, book=None):
         """Remove this contract from the database."""
-        deleted = self.find_contracts(id=contract_id).delete()
+        deleted = self.find_contracts(id=contract_id).delete(
+            synchronize_session=False)
         if deleted >= 2:
             raise RuntimeError("Deleted more than one contract, but only one "
                                "should have existed.")
         if deleted == 0:
             raise ValueError("Tried to delete non-existent contract.")
+        self._record_changes("deleted", "contract", [int(contract_id)])
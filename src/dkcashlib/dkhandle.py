@@ -1,8 +1,66 @@
 """Classes to handle connections, the database, high-level methods.
 """
 
+import contextlib
+import csv
+import datetime
+import os
+import threading
+from decimal import Decimal
+
 from . import dkdata
 
+
+def _parse_date(value):
+    """Return `value` as a datetime.date, or None.
+
+Strings are interpreted as `YYYY-MM-DD`, the month and day do not need to be
+zero-padded.
+    """
+    if value is None or value == "":
+        return None
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    year, month, day = (int(part) for part in str(value).split("-"))
+    return datetime.date(year, month, day)
+
+
+def _due_date(contract):
+    """The date when `contract` is due, or None if this is not known yet.
+
+This is the cancellation date if the contract was canceled, else the end of the
+fixed period (for "fixed_duration" and "initial_plus_n" contracts).
+    """
+    if contract.cancellation_date:
+        return _parse_date(contract.cancellation_date)
+    if contract.period_type in ("fixed_duration", "initial_plus_n"):
+        return _parse_date(contract.period_end)
+    return None
+
+def _interest(contract, start, end):
+    """The interest of `contract` from `start` until `end` (excluded).
+
+The interest is calculated on the contract amount, pro rata temporis (act/365),
+for the part of the range between the contract's date and its due date.
+
+Returns
+-------
+out : Decimal
+    Rounded to cents.
+    """
+    begin = max(start, _parse_date(contract.date))
+    finish = end
+    due_date = _due_date(contract)
+    if due_date is not None:
+        finish = min(finish, due_date)
+    days = max((finish - begin).days, 0)
+    interest = (Decimal(str(contract.amount)) * Decimal(str(contract.interest))
+                / 100 * days / 365)
+    return interest.quantize(Decimal("0.01"))
+
+
 class Connection:
     """Connection to the database/GnuCash file.
 
@@ -35,32 +93,536 @@ base_account : String, optional
         self._data = dkdata.DKData(gnucash_file=gnucash_file, base_dk=base_dk,
                                    base_ausgleich=base_ausgleich,
                                    base_zinsen=base_zinsen)
-
-    ###########################################################################
-    # The following methods are just some ideas what should be(come) possible #
-    ###########################################################################
+        # In-memory copy of the GnuCash splits, kept up to date by `sync`.
+        self._gnucash_state = None
+        self._splits = {}    # split guid -> dkdata.SplitRow
+        self._balances = {}  # account guid -> sum of the split values
+        # `sync` may be called from several threads, see `asynchandle`.
+        self._sync_lock = threading.RLock()
+        self._split_cache = None
+        self._report_cache = None
+        self._overview = None
 
     def find_creditors(self, **kwargs):
-        raise NotImplementedError("API and behaviour not defined yet")
+        """Find creditors matching the given filters.
+
+Parameters
+----------
+**kwargs :
+    Filters on the columns of the creditors table, see
+    `dkdata.DKData.find_creditors`.
+
+Returns
+-------
+out : list of common.Creditor
+        """
+        from .common import Creditor
+        return [Creditor._from_row(row, connection=self)
+                for row in self._data.creditor_rows(**kwargs)]
+
+    def iter_creditors(self, batch_size=500, **kwargs):
+        """Yield the creditors matching the filters, one by one.
+
+The rows are fetched in batches and each creditor is created only when it is
+needed, see `dkdata.DKData.iter_creditor_rows`.  The file can not be changed
+while iterating.
+
+Returns
+-------
+out : generator of common.Creditor
+        """
+        from .common import Creditor
+        for row in self._data.iter_creditor_rows(batch_size=batch_size,
+                                                 **kwargs):
+            yield Creditor._from_row(row, connection=self)
+
+    def iter_contracts(self, batch_size=500, **kwargs):
+        """Yield the contracts matching the filters, one by one.
+
+Like `iter_creditors`.
+
+Returns
+-------
+out : generator of common.Contract
+        """
+        from .common import Contract
+        for row in self._data.iter_contract_rows(batch_size=batch_size,
+                                                 **kwargs):
+            yield Contract._from_row(row, connection=self)
+
+    def find_creditors_page(self, page_size=100, after=None, order_by="id",
+                            **kwargs):
+        """One page of the creditors matching the filters.
+
+See `dkdata.DKData.creditor_page` for the parameters.
+
+Returns
+-------
+out : dkdata.Page
+    With a list of common.Creditor and the cursor for the next page.
+        """
+        from .common import Creditor
+        page = self._data.creditor_page(page_size=page_size, after=after,
+                                        order_by=order_by, **kwargs)
+        return dkdata.Page([Creditor._from_row(row, connection=self)
+                            for row in page.rows], page.cursor)
+
+    def find_contracts_page(self, page_size=100, after=None, order_by="id",
+                            **kwargs):
+        """One page of the contracts matching the filters.
+
+See `dkdata.DKData.contract_page` for the parameters.
+
+Returns
+-------
+out : dkdata.Page
+    With a list of common.Contract and the cursor for the next page.
+        """
+        from .common import Contract
+        page = self._data.contract_page(page_size=page_size, after=after,
+                                        order_by=order_by, **kwargs)
+        return dkdata.Page([Contract._from_row(row, connection=self)
+                            for row in page.rows], page.cursor)
+
+    def search_creditors(self, text, limit=20, fuzzy=True):
+        """Search creditors, e.g. for a type-ahead search.
+
+See `dkdata.DKData.search_creditors`.
+
+Returns
+-------
+out : list of common.Creditor
+    The best matches first.
+        """
+        from .common import Creditor
+        return [Creditor._from_row(row, connection=self)
+                for row in self._data.search_creditors(text, limit=limit,
+                                                       fuzzy=fuzzy)]
 
     def find_contracts(self, **kwargs):
-        raise NotImplementedError("API and behaviour not defined yet")
+        """Find contracts matching the given filters.
 
-    def calculate_interests(self, **kwargs):
-        raise NotImplementedError("API and behaviour not defined yet")
+Parameters
+----------
+**kwargs :
+    Filters on the columns of the contracts table, see
+    `dkdata.DKData.find_contracts`.
 
-    def generate_report(self, **kwargs):
-        raise NotImplementedError("API and behaviour not defined yet")
+Returns
+-------
+out : list of common.Contract
+        """
+        from .common import Contract
+        return [Contract._from_row(row, connection=self)
+                for row in self._data.contract_rows(**kwargs)]
 
-    def generate_spreadsheet(self, **kwargs):
-        raise NotImplementedError("API and behaviour not defined yet")
+    def delete_creditors(self, creditors, delete_contracts=False,
+                         delete_accounts=False):
+        """Delete many creditors at once, in one transaction.
 
-    def next_due_dates(self, **kwargs):
-        """The dates when the next accounts are due."""
-        raise NotImplementedError("API and behaviour not defined yet")
+Parameters
+----------
+creditors : iterable
+    The creditors (common.Creditor objects or IDs) to be deleted.
 
-    def generate_account_statements(self, **kwargs):
-        raise NotImplementedError("API and behaviour not defined yet")
+delete_contracts, delete_accounts : bool, optional
+    See `dkdata.DKData.delete_creditors`.
+
+Returns
+-------
+out : tuple
+    The numbers of deleted creditors, contracts and accounts.
+        """
+        creditor_ids = [getattr(creditor, "creditor_id", creditor)
+                        for creditor in creditors]
+        return self._data.delete_creditors(
+            creditor_ids, delete_contracts=delete_contracts,
+            delete_accounts=delete_accounts)
+
+    def subscribe(self, callback):
+        """Call `callback(events)` after changes, see `dkdata.DKData.subscribe`.
+
+Changed balances are published by `sync`.
+        """
+        self._data.subscribe(callback)
+
+    def unsubscribe(self, callback):
+        """Remove a callback which was added with `subscribe`."""
+        self._data.unsubscribe(callback)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Group several operations into one transaction (unit of work).
+
+All changes which are made inside the `with` block, with `common.Creditor` and
+`common.Contract` objects, the methods of this connection or directly on the
+yielded book, use the same open book.  They are saved together, in one SQLite
+transaction, when the block is left.  If an exception is raised, nothing is
+saved.  Opening and saving the book (with piecash's backup copy) happens only
+once, which is much faster than doing it for each step.
+
+Example::
+
+    with connection.transaction() as book:
+        contract.update(cancellation_date="2021-06-30")
+        new = common.Contract("2", creditor, ..., connection=connection)
+        book.add(piecash.Transaction(...))
+
+A transaction inside another one simply joins the outer one.  The transaction
+only applies to operations of the current thread.
+
+Yields
+------
+out : piecash.Book
+    The open book, for bookings.
+        """
+        try:
+            with dkdata._opened_book(self._data) as book:
+                yield book
+        except BaseException:
+            # The cached splits may contain changes which were rolled back.
+            with self._sync_lock:
+                self._gnucash_state = None
+            raise
+
+    def sync(self):
+        """Load the changes which were made in GnuCash since the last sync.
+
+Only transactions which were added or changed since the last call are read, see
+`dkdata.DKData.gnucash_state`.  If splits were deleted, everything is loaded
+again.  This is cheap if nothing changed, so it can be called often.
+
+Subscribers (see `subscribe`) get an "updated" ChangeEvent for each account
+whose balance changed, except for the first sync.
+
+Returns
+-------
+out : set
+    The guids of the accounts whose balance may have changed.
+        """
+        with self._sync_lock:
+            first = self._gnucash_state is None
+            changed = self._sync()
+        if changed and not first:
+            self._data._publish([dkdata.ChangeEvent("updated", "account", guid)
+                                 for guid in sorted(changed)])
+        return changed
+
+    def _sync(self):
+        """Do the work of `sync`, the caller holds the lock."""
+        state = self._data.gnucash_state()
+        if state == self._gnucash_state:
+            return set()
+        changed = set()
+        if self._gnucash_state is not None:
+            for row in self._data.split_rows(since=self._gnucash_state):
+                changed.update(self._store_split(row))
+        if self._gnucash_state is None or len(self._splits) != state.splits:
+            # First sync, or splits were deleted: load everything.
+            old_balances = self._balances
+            self._splits = {}
+            self._balances = {}
+            for row in self._data.split_rows():
+                self._store_split(row)
+            changed = {account
+                       for account in set(old_balances) | set(self._balances)
+                       if old_balances.get(account) != self._balances.get(
+                           account)}
+        self._gnucash_state = state
+        return changed
+
+    def _store_split(self, row):
+        """Add or replace a split in the cache, return the affected accounts."""
+        affected = {row.account}
+        if row.guid in self._splits:
+            old = self._splits[row.guid]
+            self._balances[old.account] -= old.value
+            affected.add(old.account)
+        self._splits[row.guid] = row
+        self._balances[row.account] = (self._balances.get(row.account, 0)
+                                       + row.value)
+        return affected
+
+    def balances(self):
+        """The balances of all GnuCash accounts, after a `sync`.
+
+Returns
+-------
+out : dict
+    Account guid -> sum of the account's splits (Decimal), without
+    sub-accounts.  Liabilities such as the contract accounts are negative.
+        """
+        with self._sync_lock:
+            self.sync()
+            return dict(self._balances)
+
+    def splits(self):
+        """All GnuCash splits, after a `sync`.
+
+Returns
+-------
+out : list of dkdata.SplitRow
+        """
+        with self._sync_lock:
+            self.sync()
+            return list(self._splits.values())
+
+    def contract_balances(self, **kwargs):
+        """The amount currently owed for each contract, according to GnuCash.
+
+Parameters
+----------
+**kwargs :
+    Filters for the contracts, see `find_contracts`.
+
+Returns
+-------
+out : dict
+    Contract ID -> balance of the contract's account (Decimal), positive if
+    money is owed to the creditor.
+        """
+        balances = self.balances()
+        return {int(row.id): -balances.get(row.account, Decimal(0))
+                for row in self._data.contract_rows(**kwargs)}
+
+    def split_cache(self):
+        """The columnar cache of the contract accounts' splits.
+
+Returns
+-------
+out : splitcache.SplitCache
+    Brought up to date with the GnuCash file.  Needs NumPy.
+        """
+        if self._split_cache is None:
+            from .splitcache import SplitCache
+            self._split_cache = SplitCache(self._data)
+        self._split_cache.refresh()
+        return self._split_cache
+
+    def contract_overview(self):
+        """The materialized overview of all contracts, for listings.
+
+Returns
+-------
+out : overview.ContractOverview
+    Its `page` method refreshes the overview incrementally and returns one page.
+        """
+        if self._overview is None:
+            from .overview import ContractOverview
+            self._overview = ContractOverview(self)
+        return self._overview
+
+    def forecast(self, years=1, start=None, use_balances=False, **kwargs):
+        """Forecast balances, interest and payments month by month.
+
+See the `forecast` module for the model.  Needs NumPy.
+
+Parameters
+----------
+years : int, optional
+    The length of the forecast, 1 to 10 years.  Default is 1.
+
+start : datetime.date or str, optional
+    The forecast starts with this month, default is the current month.
+
+use_balances : bool, optional
+    If True, contracts signed before `start` start with their balance in GnuCash
+    (see `contract_balances`) instead of their amount.  Default is False.
+
+**kwargs :
+    Filters for the contracts, see `find_contracts`.
+
+Returns
+-------
+out : forecast.Forecast
+    Matrices with one row per contract and one column per month.
+        """
+        from . import forecast
+        if not 1 <= years <= 10:
+            raise ValueError("The forecast must be 1 to 10 years long.")
+        start = _parse_date(start) or datetime.date.today()
+        balances = self.contract_balances(**kwargs) if use_balances else None
+        return forecast.project(self._data.contract_rows(**kwargs), start,
+                                months=12 * years, due_date=_due_date,
+                                balances=balances)
+
+    def calculate_interests(self, start, end, **kwargs):
+        """Calculate the interest of each contract for a date range.
+
+See `_interest` for the calculation.  Nothing is booked yet.
+
+Parameters
+----------
+start, end : datetime.date or str
+    The date range, `end` is not included.
+
+**kwargs :
+    Filters for the contracts, see `find_contracts`.
+
+Returns
+-------
+out : dict
+    Contract ID -> interest (Decimal, rounded to cents).
+        """
+        start = _parse_date(start)
+        end = _parse_date(end)
+        return {contract.contract_id: _interest(contract, start, end)
+                for contract in self.find_contracts(**kwargs)}
+
+    def generate_spreadsheet(self, filename, **kwargs):
+        """Export all contracts, together with the creditor's name, as CSV.
+
+Parameters
+----------
+filename : str
+    The file to write to.
+
+**kwargs :
+    Filters for the contracts, see `find_contracts`.
+
+Returns
+-------
+out : int
+    The number of exported contracts.
+        """
+        names = {row.id: row.name for row in self._data.creditor_rows()}
+        count = 0
+        with open(filename, "w", newline="") as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(["contract", "creditor", "name", "date", "amount",
+                             "interest", "interest_payment", "period_type",
+                             "period_notice", "period_end",
+                             "cancellation_date", "due_date"])
+            for contract in self.iter_contracts(**kwargs):
+                count += 1
+                writer.writerow([
+                    contract.contract_id, contract.creditor_id,
+                    names[contract.creditor_id], contract.date,
+                    contract.amount, contract.interest,
+                    contract.interest_payment, contract.period_type,
+                    contract.period_notice, contract.period_end,
+                    contract.cancellation_date, _due_date(contract)])
+        return count
+
+    def next_due_dates(self, before=None, **kwargs):
+        """The dates when the next contracts are due.
+
+Parameters
+----------
+before : datetime.date or str, optional
+    If given, only contracts which are due before this date are returned.
+
+**kwargs :
+    Filters for the contracts, see `find_contracts`.
+
+Returns
+-------
+out : list
+    Tuples (due date, contract), sorted by the due date.  Contracts without a
+    known due date are not included.
+        """
+        before = _parse_date(before)
+        due = []
+        for contract in self.find_contracts(**kwargs):
+            due_date = _due_date(contract)
+            if due_date is None:
+                continue
+            if before is not None and due_date >= before:
+                continue
+            due.append((due_date, contract))
+        due.sort(key=lambda entry: (entry[0], entry[1].contract_id))
+        return due
+
+    def generate_report(self, directory, year=None, workers=None,
+                        progress=None, **kwargs):
+        """Write a yearly report for each creditor, see the `reports` module.
+
+Reports of creditors whose data did not change since the last run into the
+same directory are not rendered again.
+
+Parameters
+----------
+directory : str
+    The output directory.
+
+year : int, optional
+    The year of the reports, default is the previous year.
+
+workers : int, optional
+    The number of worker processes for rendering, default is the number of
+    CPUs.
+
+progress : callable, optional
+    Called as `progress(done, total, creditor_id)` after each creditor.
+
+**kwargs :
+    Filters for the creditors, see `find_creditors`.
+
+Returns
+-------
+out : reports.ReportResult
+        """
+        from . import reports
+        if year is None:
+            year = datetime.date.today().year - 1
+        payloads = reports.gather(self, year, **kwargs)
+        return reports.write_reports(payloads, directory, workers=workers,
+                                     progress=progress,
+                                     cache=self.report_cache())
+
+    def generate_account_statements(self, directory=None, start=None,
+                                    end=None, workers=None, progress=None,
+                                    **kwargs):
+        """Write an account statement for each creditor.
+
+Like `generate_report`, statements whose data did not change are not rendered
+again.
+
+Parameters
+----------
+directory : str, optional
+    The output directory, default is `<GnuCash file>-statements` (without the
+    extension of the GnuCash file).
+
+start, end : datetime.date or str, optional
+    The period of the statements, `end` is not included.  Default is the
+    previous year.
+
+workers, progress, **kwargs :
+    See `generate_report`.
+
+Returns
+-------
+out : reports.ReportResult
+        """
+        from . import reports
+        if directory is None:
+            directory = (os.path.splitext(self._data._gnucash_file)[0]
+                         + "-statements")
+        year = datetime.date.today().year - 1
+        start = _parse_date(start) or datetime.date(year, 1, 1)
+        end = _parse_date(end) or datetime.date(start.year + 1, 1, 1)
+        payloads = reports.gather_statements(self, start, end, **kwargs)
+        return reports.write_reports(payloads, directory, kind="statement",
+                                     workers=workers, progress=progress,
+                                     cache=self.report_cache())
+
+    def report_cache(self):
+        """The cache of rendered reports, next to the GnuCash file.
+
+Returns
+-------
+out : reports.ReportCache
+        """
+        if self._report_cache is None:
+            from .reports import ReportCache
+            self._report_cache = ReportCache(
+                os.path.abspath(self._data._gnucash_file) + ".reportcache")
+        return self._report_cache
+
+    ###########################################################################
+    # The following methods are just some ideas what should be(come) possible #
+    ###########################################################################
 
     def average_interest(self, **kwargs):
         raise NotImplementedError("API and behaviour not defined yet")
@@ -0,0 +1,135 @@
+"""Monthly projection of balances, interest and payments of all contracts.
+
+For liquidity planning, `project` computes how the contracts develop month by
+month.  All contracts are computed at once: each month is one vectorized step
+over arrays with one entry per contract, and the results are matrices with one
+row per contract and one column per month.
+
+The model (with a granularity of whole months):
+
+- The contract's amount is paid in the month of its date.  Contracts which were
+  signed before the forecast starts begin with their amount, or with the given
+  balance.
+- Interest accrues monthly, 1/12 of the yearly rate on the balance, from the
+  month after the payment until the month before the due date (see
+  `dkhandle._due_date`).  Contracts without a known due date run until the end
+  of the forecast.
+- At the end of each year (December), the accrued interest is paid out
+  ("payout") or added to the balance ("reinvest", with compound interest).
+  With "cumulative", it just accumulates.
+- In the month of the due date, the balance is repaid and all accrued interest
+  is paid out.
+
+This module needs NumPy.
+"""
+
+import collections
+import datetime
+
+import numpy as np
+
+# The result of `project`.  `periods` are the first days of the months, the
+# other matrices have the shape (contracts, periods) and contain EUR (float).
+# `balance` is the balance at the end of the month, `interest` the interest
+# accrued in that month, `payout` the paid interest and `repayment` the repaid
+# balance.
+Forecast = collections.namedtuple(
+    "Forecast", ("contract_ids", "periods", "balance", "interest", "payout",
+                 "repayment"))
+
+
+def _month_index(start, date):
+    """The number of months from `start` to `date`."""
+    return (date.year - start.year) * 12 + date.month - start.month
+
+
+def project(contracts, start, months, due_date, balances=None):
+    """Project the contracts month by month.
+
+Parameters
+----------
+contracts : iterable
+    Contracts or contract rows, with the attributes `id` or `contract_id`,
+    `date`, `amount`, `interest` and `interest_payment`.
+
+start : datetime.date
+    The forecast starts with the month of this date.
+
+months : int
+    The number of months.
+
+due_date : callable
+    Returns the due date (or None) of a contract.
+
+balances : dict, optional
+    Contract ID -> balance at the start of the forecast, for contracts signed
+    before it.  By default, the contract amounts are used.
+
+Returns
+-------
+out : Forecast
+    """
+    start = datetime.date(start.year, start.month, 1)
+    contracts = list(contracts)
+    count = len(contracts)
+    ids = [int(contract.id if getattr(contract, "contract_id", None) is None
+               else contract.contract_id) for contract in contracts]
+    if balances is None:
+        balances = {}
+
+    begin = np.empty(count, dtype=np.int64)
+    due = np.full(count, months + 1, dtype=np.int64)
+    amount = np.empty(count)
+    rate = np.empty(count)
+    modes = [contract.interest_payment for contract in contracts]
+    for number, contract in enumerate(contracts):
+        begin[number] = _month_index(start, contract.date)
+        # Contracts which start later are paid in full, whatever their
+        # (empty) balance.
+        if begin[number] < 0:
+            amount[number] = float(balances.get(ids[number], contract.amount))
+        else:
+            amount[number] = float(contract.amount)
+        rate[number] = float(contract.interest) / 100 / 12
+        contract_due = due_date(contract)
+        if contract_due is not None:
+            due[number] = _month_index(start, contract_due)
+    payout_mode = np.array([mode == "payout" for mode in modes], dtype=bool)
+    reinvest_mode = np.array([mode == "reinvest" for mode in modes],
+                             dtype=bool)
+    # Contracts which ended before the start do not count at all.
+    amount[due < 0] = 0.0
+    # Interest accrues from the month after the payment, for older contracts
+    # (which start with their balance in the first month) from the start.
+    accrual = np.where(begin < 0, 0, begin + 1)
+    begin = np.maximum(begin, 0)
+
+    shape = (count, months)
+    result = {name: np.zeros(shape)
+              for name in ("balance", "interest", "payout", "repayment")}
+    periods = []
+    balance = np.zeros(count)
+    accrued = np.zeros(count)
+    for month in range(months):
+        period = datetime.date(start.year + (start.month - 1 + month) // 12,
+                               (start.month - 1 + month) % 12 + 1, 1)
+        periods.append(period)
+        balance += np.where(begin == month, amount, 0.0)
+        active = (accrual <= month) & (month < due)
+        interest = np.where(active, balance * rate, 0.0)
+        accrued += interest
+        ending = due == month
+        if period.month == 12:
+            paid = payout_mode & ~ending
+            result["payout"][paid, month] = accrued[paid]
+            accrued[paid] = 0.0
+            reinvested = reinvest_mode & ~ending
+            balance[reinvested] += accrued[reinvested]
+            accrued[reinvested] = 0.0
+        result["payout"][ending, month] = accrued[ending]
+        result["repayment"][ending, month] = balance[ending]
+        accrued[ending] = 0.0
+        balance[ending] = 0.0
+        result["interest"][:, month] = interest
+        result["balance"][:, month] = balance
+    return Forecast(ids, periods, **result)
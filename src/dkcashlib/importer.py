@@ -0,0 +1,319 @@
+"""Import creditors and contracts from CSV or ODS files.
+
+The rows are read as a stream, then all of them are validated at once, with the
+same rules as `common.Creditor._check` and `common._State._validate_attributes`.
+Instead of stopping at the first problem, all errors are collected into one
+report.  The valid rows are then inserted in one transaction, through the bulk
+methods of `dkdata.DKData`.
+
+The first row of the file must contain the column names, see `COLUMNS`.  Empty
+cells count as missing values.
+
+Example::
+
+    report = importer.import_file(connection, "kredite.csv", "contracts")
+    print(importer.format_report(report))
+"""
+
+import collections
+import csv
+import math
+import os
+import zipfile
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from xml.etree import ElementTree
+
+from . import dkdata
+from .common import Creditor, _State
+
+# Kind of record -> the columns which can be imported.
+COLUMNS = {
+    "creditors": ("name", "address1", "address2", "address3", "address4",
+                  "phone", "email", "newsletter"),
+    "contracts": ("id", "creditor", "date", "amount", "interest",
+                  "interest_payment", "period_type", "period_notice",
+                  "period_end", "version", "cancellation_date"),
+}
+
+# A problem in a row of the file.  `line` is the row number in the file,
+# counting the header as 1 and skipping empty rows.
+RowError = collections.namedtuple("RowError", ("line", "column", "message"))
+
+ImportReport = collections.namedtuple(
+    "ImportReport", ("kind", "rows", "inserted", "errors"))
+
+
+def _to_bool(value):
+    text = str(value).strip().lower()
+    if text in ("1", "true", "yes", "ja", "x"):
+        return True
+    if text in ("0", "false", "no", "nein"):
+        return False
+    raise ValueError("Not a yes/no value")
+
+
+def _to_amount(value):
+    """Convert a money amount, rounded to cents like `dkdata._to_cents`.
+
+Amounts which are not finite or do not fit into the integer cents column are
+rejected.
+    """
+    amount = Decimal(value)
+    if not amount.is_finite():
+        raise ValueError("Not a finite number")
+    # Raises InvalidOperation if there are too many digits.
+    amount = amount.quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+    if abs(amount.scaleb(2)) >= 2 ** 63:
+        raise ValueError("Out of range")
+    return amount
+
+
+def _to_float(value):
+    number = float(value)
+    if not math.isfinite(number):
+        raise ValueError("Not a finite number")
+    return number
+
+
+# Column -> function which converts the text of a cell.
+_CONVERTERS = {
+    "id": int,
+    "creditor": int,
+    "date": dkdata._to_date,
+    "period_end": dkdata._to_date,
+    "cancellation_date": dkdata._to_date,
+    "amount": _to_amount,
+    "interest": _to_float,
+    "newsletter": _to_bool,
+}
+
+# Values for missing cells.
+_DEFAULTS = {
+    "interest_payment": "payout",
+    "period_type": "fixed_duration",
+    "newsletter": False,
+}
+
+
+def _read_ods(filename):
+    """Yield the rows of the first sheet of an ODS file, as lists of str."""
+    ns_table = "{urn:oasis:names:tc:opendocument:xmlns:table:1.0}"
+    ns_text = "{urn:oasis:names:tc:opendocument:xmlns:text:1.0}"
+    with zipfile.ZipFile(filename) as archive:
+        with archive.open("content.xml") as content:
+            for event, element in ElementTree.iterparse(content,
+                                                        ("start", "end")):
+                if event == "end" and element.tag == ns_table + "table":
+                    return
+                if event != "end" or element.tag != ns_table + "table-row":
+                    continue
+                row = []
+                for cell in element.iter(ns_table + "table-cell"):
+                    text = "\n".join("".join(paragraph.itertext())
+                                     for paragraph in cell.iter(ns_text + "p"))
+                    repeat = int(cell.get(ns_table + "number-columns-repeated",
+                                          1))
+                    # Trailing empty cells are often repeated a lot.
+                    row.extend([text] * (1 if not text else repeat))
+                while row and not row[-1]:
+                    row.pop()
+                element.clear()
+                yield row
+
+
+def read_rows(filename):
+    """Yield the rows of a CSV or ODS file as dicts (column -> str).
+
+The file type is determined by the extension, everything but ".ods" is read as
+CSV.  The first row contains the column names.  Empty rows are skipped.
+    """
+    if os.path.splitext(filename)[1].lower() == ".ods":
+        rows = _read_ods(filename)
+        header = [name.strip() for name in next(rows, [])]
+        for row in rows:
+            if any(row):
+                yield dict(zip(header, row))
+        return
+    with open(filename, newline="", encoding="utf-8-sig") as csv_file:
+        for row in csv.DictReader(csv_file):
+            if any(row.values()):
+                yield {(name or "").strip(): value
+                       for name, value in row.items()}
+
+
+def _columns(rows, kind):
+    """Transpose the rows into columns, converting the values.
+
+Returns
+-------
+out : tuple
+    (columns, errors), with columns: name -> list of values (None if missing).
+    """
+    errors = []
+    columns = {name: [] for name in COLUMNS[kind]}
+    unknown = set()
+    for row in rows:
+        unknown.update(set(row) - set(columns) - {""})
+        for name, values in columns.items():
+            value = row.get(name)
+            values.append(value.strip() if isinstance(value, str) and
+                          value.strip() else None)
+    # Unknown columns are ignored, they are reported for the header line.
+    errors.extend(RowError(1, name, "Unknown column") for name in unknown)
+    for name, values in columns.items():
+        converter = _CONVERTERS.get(name)
+        for index, value in enumerate(values):
+            if value is None:
+                values[index] = _DEFAULTS.get(name)
+            elif converter is not None:
+                try:
+                    values[index] = converter(value)
+                except (ValueError, ArithmeticError, InvalidOperation):
+                    errors.append(RowError(index + 2, name,
+                                           "Invalid value: {}".format(value)))
+                    values[index] = None
+    return columns, errors
+
+
+def _validate_creditors(columns, connection):
+    """Check the creditor rows with the rules of `Creditor._check`."""
+    errors = []
+    for name in ("name", "address1"):
+        errors.extend(RowError(index + 2, name, "Missing value")
+                      for index, value in enumerate(columns[name])
+                      if value is None)
+    missing = {(error.line, error.column) for error in errors}
+    addresses = zip(*[columns[name] for name in COLUMNS["creditors"]
+                      if name.startswith("address")])
+    for index, (address, email, newsletter) in enumerate(zip(
+            addresses, columns["email"], columns["newsletter"])):
+        for column, message in Creditor._check(address, email, newsletter):
+            if (index + 2, column) not in missing:
+                errors.append(RowError(index + 2, column, message))
+    return errors
+
+
+def _validate_contracts(columns, connection):
+    """Check the contract columns with the rules of `_State`."""
+    errors = []
+    for name in _State.required + ("id", "creditor"):
+        errors.extend(RowError(index + 2, name, "Missing value")
+                      for index, value in enumerate(columns[name])
+                      if value is None)
+    for name in _State.non_negative:
+        errors.extend(RowError(index + 2, name, "Must not be negative")
+                      for index, value in enumerate(columns.get(name, ()))
+                      if value is not None and value < 0)
+    for name, choices in _State.choices.items():
+        errors.extend(RowError(index + 2, name,
+                               "Must be one of {}".format(", ".join(choices)))
+                      for index, value in enumerate(columns[name])
+                      if value not in choices)
+    for index, period_type in enumerate(columns["period_type"]):
+        if period_type not in _State.period_rules:
+            errors.append(RowError(index + 2, "period_type",
+                                   "Unknown `period_type` argument."))
+            continue
+        for name in _State.period_rules[period_type][0]:
+            if columns[name][index] is None:
+                errors.append(RowError(
+                    index + 2, name, _State.missing_message.format(
+                        period_type=period_type, name=name)))
+
+    # IDs must be unique, creditors must exist.
+    existing = {int(row.id) for row in connection._data.contract_rows()}
+    seen = set()
+    for index, contract_id in enumerate(columns["id"]):
+        if contract_id in existing or contract_id in seen:
+            errors.append(RowError(index + 2, "id",
+                                   "Duplicate ID: {}".format(contract_id)))
+        if contract_id is not None:
+            seen.add(contract_id)
+    creditors = {row.id for row in connection._data.creditor_rows()}
+    errors.extend(RowError(index + 2, "creditor",
+                           "Unknown creditor: {}".format(creditor))
+                  for index, creditor in enumerate(columns["creditor"])
+                  if creditor is not None and creditor not in creditors)
+    return errors
+
+
+def validate(rows, kind, connection):
+    """Validate all rows at once.
+
+Parameters
+----------
+rows : iterable of dict
+    The rows, e.g. from `read_rows`.
+
+kind : str
+    "creditors" or "contracts".
+
+connection : dkhandle.Connection
+    Used to check for duplicate contracts and unknown creditors.
+
+Returns
+-------
+out : tuple
+    (records, errors): The converted records (dicts) of all rows, and a list of
+    RowError, sorted by line.
+    """
+    if kind not in COLUMNS:
+        raise ValueError("Unknown kind of records: {}".format(kind))
+    columns, errors = _columns(rows, kind)
+    if kind == "creditors":
+        errors.extend(_validate_creditors(columns, connection))
+    else:
+        errors.extend(_validate_contracts(columns, connection))
+    records = [dict(zip(columns, values)) for values in zip(*columns.values())]
+    errors.sort()
+    return records, errors
+
+
+def import_file(connection, filename, kind, dry_run=False):
+    """Import creditors or contracts from a CSV or ODS file.
+
+All rows are validated first.  Then the valid rows are inserted, in one
+transaction, rows with errors are left out.
+
+Parameters
+----------
+connection : dkhandle.Connection
+
+filename : str
+    The CSV or ODS file, see `read_rows`.
+
+kind : str
+    "creditors" or "contracts".
+
+dry_run : bool, optional
+    If True, only validate.  Default is False.
+
+Returns
+-------
+out : ImportReport
+    With the number of rows and of inserted rows, and all errors.  Errors in
+    line 1 (the header) do not keep any rows from being inserted.
+    """
+    records, errors = validate(read_rows(filename), kind, connection)
+    bad_lines = {error.line for error in errors}
+    valid = [record for line, record in enumerate(records, start=2)
+             if line not in bad_lines]
+    inserted = 0
+    if valid and not dry_run:
+        if kind == "creditors":
+            for record in valid:
+                record["address"] = [record.pop("address{}".format(number))
+                                     or "" for number in range(1, 5)]
+            inserted = len(connection._data.add_creditors(valid))
+        else:
+            inserted = connection._data.add_contracts(valid)
+    return ImportReport(kind, len(records), inserted, errors)
+
+
+def format_report(report):
+    """Return a human readable text for an ImportReport."""
+    lines = ["{}: {} row(s), {} inserted, {} error(s)".format(
+        report.kind, report.rows, report.inserted, len(report.errors))]
+    lines.extend("    line {}, {}: {}".format(*error)
+                 for error in report.errors)
+    return "\n".join(lines)
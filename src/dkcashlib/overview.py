@@ -0,0 +1,250 @@
+"""A materialized overview of the contracts, for listings.
+
+The contracts overview shows for each contract the creditor's name, the terms,
+the current balance, the interest accrued in the current year and the due date.
+Computing this needs the contracts, the creditors and the balances from the
+GnuCash splits.  `ContractOverview` keeps the result in one narrow table, in a
+SQLite file next to the GnuCash file, so that listings only page through that
+table (see `ContractOverview.page`).
+
+`ContractOverview.refresh` updates the table incrementally:
+
+- Contracts and creditors which changed since the last refresh, by DKCash or
+  any other process, are read from the change log in the GnuCash file (see
+  `dkdata.DKData.changes_since`).  Only their rows are computed again.
+- If the GnuCash splits changed (see `dkdata.DKData.gnucash_state`), the
+  balances are compared with the stored ones and the differing ones are updated.
+- Once a day the whole table is computed again, because the accrued interest
+  depends on the date.
+"""
+
+import collections
+import contextlib
+import datetime
+import json
+import os
+import sqlite3
+import threading
+from decimal import Decimal
+
+from . import dkdata
+from . import dkhandle
+
+# The columns of the overview.  Money values are Decimal, dates datetime.date.
+# `balance` is the amount owed to the creditor, `accrued_interest` the interest
+# from the start of the year until the day of the last refresh.
+COLUMNS = ("contract_id", "creditor", "creditor_name", "account", "date",
+           "amount", "interest", "interest_payment", "period_type",
+           "due_date", "balance", "accrued_interest", "active")
+
+OverviewRow = collections.namedtuple("OverviewRow", COLUMNS)
+
+# The columns which can be used for sorting -> SQL expression.  Contracts
+# without a due date come last.
+ORDER_BY = {
+    "contract_id": "contract_id",
+    "creditor_name": "creditor_name",
+    "due_date": "coalesce(due_date, '9999-12-31')",
+    "balance": "balance",
+}
+
+_DDL = [
+    "CREATE TABLE IF NOT EXISTS overview (contract_id INTEGER PRIMARY KEY, "
+    "creditor INTEGER, creditor_name TEXT, account TEXT, date TEXT, "
+    "amount INTEGER, interest REAL, interest_payment TEXT, period_type TEXT, "
+    "due_date TEXT, balance INTEGER, accrued_interest INTEGER, "
+    "active INTEGER)",
+    "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)",
+] + ["CREATE INDEX IF NOT EXISTS ix_overview_{} ON overview ({}, "
+     "contract_id)".format(name, expression)
+     for name, expression in ORDER_BY.items() if name != "contract_id"]
+
+# A row of `dkdata.DKData.contract_overview_rows`.
+_SourceRow = collections.namedtuple(
+    "_SourceRow", dkdata.DKData.contract_columns + ("creditor_name",))
+
+
+def _from_cents(value):
+    return None if value is None else Decimal(value).scaleb(-2)
+
+
+class ContractOverview:
+    """The overview table of the contracts of a connection.
+
+Attributes
+----------
+filename : str
+    The SQLite file with the table.
+    """
+
+    def __init__(self, connection, filename=None):
+        """
+Parameters
+----------
+connection : dkhandle.Connection
+
+filename : str, optional
+    The SQLite file, by default `<gnucash file>.overview` next to the GnuCash
+    file.  It is created if necessary.
+        """
+        self._connection = connection
+        if filename is None:
+            filename = (os.path.abspath(connection._data._gnucash_file)
+                        + ".overview")
+        self.filename = filename
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def _database(self):
+        """Yield a connection to the overview file, commit at the end."""
+        with contextlib.closing(sqlite3.connect(self.filename)) as database:
+            with database:
+                for statement in _DDL:
+                    database.execute(statement)
+                yield database
+
+    def refresh(self, full=False, today=None):
+        """Bring the table up to date.
+
+Parameters
+----------
+full : bool, optional
+    If True, compute all rows again.  Default is False.
+
+today : datetime.date, optional
+    The date for the accrued interest, default is today.
+
+Returns
+-------
+out : int
+    The number of written or changed rows.
+        """
+        if today is None:
+            today = datetime.date.today()
+        data = self._connection._data
+        with self._lock, self._database() as database:
+            meta = dict(database.execute("SELECT key, value FROM meta"))
+            full = full or meta.get("as_of") != str(today)
+            # The changes are read first, so that nothing is missed if there
+            # are more while refreshing.
+            seq, changes = data.changes_since(int(meta.get("seq", 0)))
+            state = json.dumps(list(data.gnucash_state()), default=str)
+            balances = self._connection.balances()
+            if full:
+                database.execute("DELETE FROM overview")
+                count = self._write(database, data.contract_overview_rows(),
+                                    balances, today)
+            else:
+                count = 0
+                if changes["contract"] or changes["creditor"]:
+                    # Deleted contracts are not returned, so they are removed.
+                    database.executemany(
+                        "DELETE FROM overview WHERE contract_id = ?",
+                        [(key,) for key in changes["contract"]])
+                    count += self._write(database, data.contract_overview_rows(
+                        changes["contract"], changes["creditor"]), balances,
+                                         today)
+                if meta.get("state") != state:
+                    count += self._update_balances(database, balances)
+            database.executemany(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                [("seq", str(seq)), ("state", state), ("as_of", str(today))])
+        return count
+
+    @staticmethod
+    def _balance(balances, account):
+        return dkdata._to_cents(-balances.get(account, Decimal(0)))
+
+    def _write(self, database, rows, balances, today):
+        start = datetime.date(today.year, 1, 1)
+        values = []
+        for row in rows:
+            contract = _SourceRow._make(row)
+            due_date = dkhandle._due_date(contract)
+            values.append((
+                int(contract.id), contract.creditor, contract.creditor_name,
+                contract.account, str(contract.date),
+                dkdata._to_cents(contract.amount), contract.interest,
+                contract.interest_payment, contract.period_type,
+                None if due_date is None else str(due_date),
+                self._balance(balances, contract.account),
+                dkdata._to_cents(dkhandle._interest(contract, start, today)),
+                int(bool(contract.active))))
+        database.executemany(
+            "INSERT OR REPLACE INTO overview ({}) VALUES ({})".format(
+                ", ".join(COLUMNS), ", ".join("?" * len(COLUMNS))), values)
+        return len(values)
+
+    def _update_balances(self, database, balances):
+        changed = []
+        for contract_id, account, balance in database.execute(
+                "SELECT contract_id, account, balance FROM overview"):
+            new_balance = self._balance(balances, account)
+            if new_balance != balance:
+                changed.append((new_balance, contract_id))
+        database.executemany(
+            "UPDATE overview SET balance = ? WHERE contract_id = ?", changed)
+        return len(changed)
+
+    def page(self, page_size=100, after=None, order_by="contract_id",
+             refresh=True):
+        """One page of the overview, with keyset pagination.
+
+Parameters
+----------
+page_size : int, optional
+    The maximum number of rows.  Default is 100.
+
+after : tuple, optional
+    The cursor of the previous page, None for the first page.
+
+order_by : str, optional
+    The sort column, a key of `ORDER_BY`.  Ties are sorted by contract ID.
+    Default is "contract_id".
+
+refresh : bool, optional
+    If True (the default), `refresh` the table first.
+
+Returns
+-------
+out : dkdata.Page
+    With a list of OverviewRow and the cursor for the next page.
+        """
+        if order_by not in ORDER_BY:
+            raise ValueError("Cannot sort by: {}".format(order_by))
+        if page_size < 1:
+            raise ValueError("`page_size` must be positive.")
+        if refresh:
+            self.refresh()
+        order = ["contract_id"]
+        if order_by != "contract_id":
+            order.insert(0, ORDER_BY[order_by])
+        statement = "SELECT {}, {} FROM overview".format(", ".join(COLUMNS),
+                                                          order[0])
+        params = []
+        if after is not None:
+            statement += " WHERE ({}) > ({})".format(
+                ", ".join(order), ", ".join("?" * len(order)))
+            params = list(after)
+        statement += " ORDER BY {} LIMIT ?".format(", ".join(order))
+        params.append(page_size + 1)
+        with self._database() as database:
+            rows = database.execute(statement, params).fetchall()
+        cursor = None
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            cursor = (rows[-1][0],)
+            if order_by != "contract_id":
+                cursor = (rows[-1][-1],) + cursor
+        return dkdata.Page([self._row(row[:len(COLUMNS)]) for row in rows],
+                           cursor)
+
+    @staticmethod
+    def _row(values):
+        row = OverviewRow._make(values)
+        return row._replace(
+            date=dkhandle._parse_date(row.date),
+            due_date=dkhandle._parse_date(row.due_date),
+            amount=_from_cents(row.amount), balance=_from_cents(row.balance),
+            accrued_interest=_from_cents(row.accrued_interest),
+            active=bool(row.active))
@@ -0,0 +1,390 @@
+"""Yearly reports and account statements, one file per creditor.
+
+Generating the reports has two stages:
+
+1. Gathering the data: all creditors with their contracts are read in one query
+   (`dkdata.DKData.creditor_contract_rows`), the balances and splits come from
+   the cached GnuCash splits (`dkhandle.Connection.sync`).  The result is one
+   plain, picklable payload per creditor.
+2. Rendering: each payload is rendered independently, in worker processes.
+
+The rendered text only depends on the payload and on the template version (see
+`TEMPLATES`), so the hash of both (`payload_hash`) identifies a report:
+
+- The hashes of the written reports are kept in a manifest file in the output
+  directory, creditors whose hash did not change are skipped.
+- Rendered texts are kept in a `ReportCache` by their hash, so that they are not
+  rendered again, e.g. after a correction was reverted.
+"""
+
+import collections
+import concurrent.futures
+import datetime
+import hashlib
+import json
+import os
+import time
+from decimal import Decimal
+
+from . import dkhandle
+
+ReportResult = collections.namedtuple("ReportResult", ("files", "rendered"))
+
+
+class ReportCache:
+    """Rendered texts on disk, by the hash of their payload.
+
+The least recently used entries are removed when the cache grows larger than
+`max_bytes`, and entries which were not used for `max_age` seconds.
+    """
+
+    def __init__(self, directory, max_bytes=64 * 1024 * 1024,
+                 max_age=90 * 24 * 3600):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+    def _path(self, digest):
+        return os.path.join(self.directory, digest + ".txt")
+
+    def get(self, digest):
+        """Return the cached text, or None."""
+        try:
+            with open(self._path(digest)) as cached:
+                text = cached.read()
+        except OSError:
+            return None
+        # The modification time tells when the entry was used last.
+        os.utime(self._path(digest))
+        return text
+
+    def put(self, digest, text):
+        os.makedirs(self.directory, exist_ok=True)
+        temporary = self._path(digest) + ".tmp"
+        with open(temporary, "w") as cached:
+            cached.write(text)
+        os.replace(temporary, self._path(digest))
+
+    def evict(self, now=None):
+        """Remove old entries, and the least recently used ones if the cache is
+too large.
+
+Returns
+-------
+out : int
+    The number of removed entries.
+        """
+        if now is None:
+            now = time.time()
+        try:
+            names = [name for name in os.listdir(self.directory)
+                     if name.endswith(".txt")]
+        except OSError:
+            return 0
+        entries = []
+        for name in names:
+            stat = os.stat(os.path.join(self.directory, name))
+            entries.append((stat.st_mtime, stat.st_size, name))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for mtime, size, name in entries:
+            if total <= self.max_bytes and now - mtime <= self.max_age:
+                continue
+            os.remove(os.path.join(self.directory, name))
+            total -= size
+            removed += 1
+        return removed
+
+
+def gather(connection, year, **kwargs):
+    """Collect the data of all reports.
+
+Parameters
+----------
+connection : dkhandle.Connection
+
+year : int
+    The year of the reports.
+
+**kwargs :
+    Filters for the creditors, see `dkdata.DKData.find_creditors`.
+
+Returns
+-------
+out : dict
+    Creditor ID -> payload (a dict of JSON compatible values), sorted by ID.
+    The balances are those at the end of `year`, so that later bookings do not
+    change the payloads.
+    """
+    data = connection._data
+    end = datetime.date(year + 1, 1, 1)
+    balances = collections.defaultdict(Decimal)
+    for split in connection.splits():
+        if split.post_date is not None and split.post_date < end:
+            balances[split.account] += split.value
+    payloads = {}
+    for creditor, contract in data.creditor_contract_rows(**kwargs):
+        creditor = dict(zip(data.creditor_columns, creditor))
+        payload = payloads.setdefault(creditor["id"], {
+            "year": year, "creditor": creditor, "contracts": []})
+        if contract is None:
+            continue
+        contract = dict(zip(data.contract_columns, contract))
+        contract["balance"] = -balances.get(contract["account"], Decimal(0))
+        contract["id"] = int(contract["id"])
+        payload["contracts"].append(contract)
+    for payload in payloads.values():
+        payload["contracts"].sort(key=lambda contract: contract["id"])
+        payload["creditor"]["newsletter"] = bool(
+            payload["creditor"]["newsletter"])
+    return _normalize(payloads)
+
+
+def _normalize(payloads):
+    """Convert the values (dates, Decimals) to what ends up in the report."""
+    return {creditor_id: json.loads(json.dumps(payload, default=str))
+            for creditor_id, payload in sorted(payloads.items())}
+
+
+def gather_statements(connection, start, end, **kwargs):
+    """Collect the data of all account statements.
+
+Parameters
+----------
+connection : dkhandle.Connection
+
+start, end : datetime.date
+    The period of the statements, `end` is not included.
+
+**kwargs :
+    Filters for the creditors, see `dkdata.DKData.find_creditors`.
+
+Returns
+-------
+out : dict
+    Creditor ID -> payload, sorted by ID.  Each contract contains the opening
+    balance and the splits of its account in the period, as amounts owed to the
+    creditor.
+    """
+    # `gather` syncs the GnuCash splits, too.
+    payloads = gather(connection, start.year, **kwargs)
+    accounts = {contract["account"]
+                for payload in payloads.values()
+                for contract in payload["contracts"]}
+    splits = collections.defaultdict(list)
+    for split in connection.splits():
+        if split.account in accounts:
+            splits[split.account].append(split)
+    for payload in payloads.values():
+        del payload["year"]
+        payload["start"] = str(start)
+        payload["end"] = str(end)
+        for contract in payload["contracts"]:
+            del contract["balance"]
+            opening = Decimal(0)
+            entries = []
+            for split in splits[contract["account"]]:
+                if split.post_date is None or split.post_date >= end:
+                    continue
+                if split.post_date < start:
+                    opening -= split.value
+                else:
+                    entries.append((str(split.post_date),
+                                    split.description or "",
+                                    str(-split.value)))
+            contract["opening"] = str(opening)
+            contract["splits"] = sorted(entries)
+    return _normalize(payloads)
+
+
+def payload_hash(payload, kind="report"):
+    """The content hash of the `kind` of report for `payload`."""
+    text = json.dumps([kind, TEMPLATES[kind][1], payload], sort_keys=True)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def _money(value):
+    return "{:,.2f}".format(Decimal(value)).replace(",", "'")
+
+
+def render(payload):
+    """Render the report text for one creditor.
+
+This is a pure function of `payload`, so that it can run in a worker process
+and the output is deterministic.
+    """
+    year = payload["year"]
+    start = dkhandle._parse_date("{}-01-01".format(year))
+    end = dkhandle._parse_date("{}-01-01".format(year + 1))
+    creditor = payload["creditor"]
+    title = "Direktkredite: Übersicht {}".format(year)
+    lines = [title, "=" * len(title), "", creditor["name"]]
+    lines.extend(creditor["address{}".format(number)]
+                 for number in range(1, 5) if creditor["address{}".format(
+                     number)])
+    lines.append("")
+
+    columns = "{:>8}  {:<10}  {:>12}  {:>6}  {:<10}  {:>12}  {:>12}"
+    lines.append(columns.format("Vertrag", "Datum", "Betrag", "Zins",
+                                "Fällig", "Saldo", "Zinsen"))
+    total_balance = Decimal(0)
+    total_interest = Decimal(0)
+    for values in payload["contracts"]:
+        contract = collections.namedtuple("Contract", values)(**values)
+        interest = dkhandle._interest(contract, start, end)
+        due_date = dkhandle._due_date(contract)
+        total_balance += Decimal(contract.balance)
+        total_interest += interest
+        lines.append(columns.format(
+            contract.id, contract.date, _money(contract.amount),
+            "{:.2f}%".format(float(contract.interest)),
+            str(due_date or "-"), _money(contract.balance), _money(interest)))
+    if not payload["contracts"]:
+        lines.append("Keine Verträge.")
+    lines.append("")
+    lines.append("Summe Saldo:  {:>12}".format(_money(total_balance)))
+    lines.append("Summe Zinsen: {:>12}".format(_money(total_interest)))
+    return "\n".join(lines) + "\n"
+
+
+def render_statement(payload):
+    """Render the account statement text for one creditor, like `render`."""
+    creditor = payload["creditor"]
+    title = "Kontoauszug {} bis {}".format(
+        payload["start"], dkhandle._parse_date(payload["end"])
+        - datetime.timedelta(days=1))
+    lines = [title, "=" * len(title), "", creditor["name"]]
+    lines.extend(creditor["address{}".format(number)]
+                 for number in range(1, 5) if creditor["address{}".format(
+                     number)])
+    columns = "{:<10}  {:<40}  {:>12}"
+    for contract in payload["contracts"]:
+        balance = Decimal(contract["opening"])
+        lines.extend(["", "Vertrag {}".format(contract["id"]),
+                      columns.format("", "Anfangssaldo", _money(balance))])
+        for date, description, value in contract["splits"]:
+            balance += Decimal(value)
+            lines.append(columns.format(date, description[:40],
+                                        _money(value)))
+        lines.append(columns.format("", "Endsaldo", _money(balance)))
+    if not payload["contracts"]:
+        lines.extend(["", "Keine Verträge."])
+    return "\n".join(lines) + "\n"
+
+
+# Kind of report -> (render function, template version).  Increase the version
+# when the output of the render function changes.
+TEMPLATES = {
+    "report": (render, 1),
+    "statement": (render_statement, 1),
+}
+
+
+def _manifest_path(directory, kind):
+    return os.path.join(directory, ".dkcash-{}s.json".format(kind))
+
+
+def _read_manifest(directory, kind):
+    try:
+        with open(_manifest_path(directory, kind)) as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_reports(payloads, directory, kind="report", workers=None,
+                  progress=None, cache=None):
+    """Render the reports for `payloads` into `directory`.
+
+Parameters
+----------
+payloads : dict
+    Creditor ID -> payload, see `gather` and `gather_statements`.
+
+directory : str
+    The output directory, it is created if necessary.  The reports are called
+    `<kind>_<creditor ID>.txt`.
+
+kind : str, optional
+    The kind of report, a key of `TEMPLATES`.  Default is "report".
+
+workers : int, optional
+    The number of worker processes, default is the number of CPUs.  With 1, the
+    reports are rendered in this process.
+
+progress : callable, optional
+    Called as `progress(done, total, creditor_id)` after each creditor,
+    including the skipped ones.
+
+cache : ReportCache, optional
+    Texts which are in the cache are not rendered again, new texts are added.
+
+Returns
+-------
+out : ReportResult
+    `files` maps the creditor IDs to the report files, `rendered` lists the
+    creditors whose report was rendered (neither skipped nor cached), in order.
+    """
+    render_function = TEMPLATES[kind][0]
+    os.makedirs(directory, exist_ok=True)
+    manifest = _read_manifest(directory, kind)
+    files = {}
+    digests = {}
+    todo = []
+    done = 0
+
+    def finish(creditor_id, text):
+        nonlocal done
+        if text is not None:
+            with open(files[creditor_id], "w") as report_file:
+                report_file.write(text)
+            manifest[str(creditor_id)] = digests[creditor_id]
+        done += 1
+        if progress is not None:
+            progress(done, len(payloads), creditor_id)
+
+    try:
+        for creditor_id, payload in payloads.items():
+            files[creditor_id] = os.path.join(
+                directory, "{}_{}.txt".format(kind, creditor_id))
+            digests[creditor_id] = payload_hash(payload, kind)
+            if (manifest.get(str(creditor_id)) == digests[creditor_id]
+                    and os.path.exists(files[creditor_id])):
+                finish(creditor_id, None)
+                continue
+            text = cache.get(digests[creditor_id]) if cache else None
+            if text is not None:
+                finish(creditor_id, text)
+            else:
+                todo.append(creditor_id)
+
+        def rendered(creditor_id, text):
+            if cache is not None:
+                cache.put(digests[creditor_id], text)
+            finish(creditor_id, text)
+
+        if workers == 1 or len(todo) <= 1:
+            for creditor_id in todo:
+                rendered(creditor_id, render_function(payloads[creditor_id]))
+        elif todo:
+            with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=workers) as pool:
+                futures = {pool.submit(render_function, payloads[creditor_id]):
+                           creditor_id for creditor_id in todo}
+                try:
+                    for future in concurrent.futures.as_completed(futures):
+                        rendered(futures[future], future.result())
+                except BaseException:
+                    # E.g. cancelled through `progress`: The renders which did
+                    # not start yet are dropped instead of waited for.
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    raise
+    finally:
+        with open(_manifest_path(directory, kind), "w") as manifest_file:
+            json.dump(manifest, manifest_file, sort_keys=True, indent=1)
+        if cache is not None:
+            cache.evict()
+    todo = set(todo)
+    return ReportResult(files, [creditor_id for creditor_id in payloads
+                                if creditor_id in todo])
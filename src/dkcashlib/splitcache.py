@@ -0,0 +1,173 @@
+"""A columnar cache of the contract accounts' splits, for analytics.
+
+Interest calculations and reports need the (account, date, value) of all splits
+on the contract accounts, and reading them through the ORM again and again is
+slow.  `SplitCache` keeps them in a sidecar directory next to the GnuCash file,
+one raw binary file per column, which are opened with `numpy.memmap`.
+
+The cache is brought up to date with `SplitCache.refresh`: If the fingerprint of
+the GnuCash tables (`dkdata.DKData.gnucash_state`) did not change, nothing is
+read at all.  If only splits were added, they are appended to the column files.
+Otherwise (splits were changed or deleted, contracts were added) the cache is
+rebuilt from scratch.
+
+This module needs NumPy.
+"""
+
+import json
+import os
+
+import numpy as np
+
+from . import dkdata
+
+# Column name -> dtype of the column file.
+COLUMNS = {
+    "account": np.dtype("int32"),  # index into `SplitCache.accounts`
+    "date": np.dtype("datetime64[D]"),
+    "value": np.dtype("int64"),  # in cents
+}
+
+
+class SplitCache:
+    """Memory-mapped columns of the splits on the contract accounts.
+
+Attributes
+----------
+accounts : list of str
+    The guids of the contract accounts, the "account" column holds indices into
+    this list.
+
+directory : str
+    Where the column files are stored.
+    """
+
+    def __init__(self, data, directory=None):
+        """
+Parameters
+----------
+data : dkdata.DKData
+    The data whose splits are cached.
+
+directory : str, optional
+    The cache directory, by default `<gnucash file>.splitcache` next to the
+    GnuCash file.  It is created if necessary.
+        """
+        self._data = data
+        if directory is None:
+            directory = os.path.abspath(data._gnucash_file) + ".splitcache"
+        self.directory = directory
+        self.accounts = []
+        self._meta = None
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _read_meta(self):
+        """Return the stored meta data, or None if it is missing or broken."""
+        try:
+            with open(self._path("meta.json")) as meta_file:
+                meta = json.load(meta_file)
+            meta["state"] = dkdata.GnuCashState._make(meta["state"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        for name, dtype in COLUMNS.items():
+            path = self._path(name + ".bin")
+            if (not os.path.exists(path)
+                    or os.path.getsize(path) != meta["rows"] * dtype.itemsize):
+                return None
+        return meta
+
+    def _write_meta(self, meta):
+        stored = dict(meta, state=list(meta["state"]))
+        temporary = self._path("meta.json.tmp")
+        with open(temporary, "w") as meta_file:
+            json.dump(stored, meta_file)
+        os.replace(temporary, self._path("meta.json"))
+        self._meta = meta
+        self.accounts = meta["accounts"]
+
+    def _append(self, rows, accounts, mode="ab"):
+        """Write the splits in `rows` which belong to one of the `accounts`."""
+        index = {guid: number for number, guid in enumerate(accounts)}
+        rows = [row for row in rows if row.account in index]
+        columns = {
+            "account": [index[row.account] for row in rows],
+            "date": [row.post_date for row in rows],
+            "value": [dkdata._to_cents(row.value) for row in rows],
+        }
+        for name, dtype in COLUMNS.items():
+            with open(self._path(name + ".bin"), mode) as column_file:
+                np.array(columns[name], dtype=dtype).tofile(column_file)
+        return len(rows)
+
+    def refresh(self):
+        """Bring the cache up to date with the GnuCash file.
+
+Returns
+-------
+out : bool
+    True if the cache was changed.
+        """
+        state = self._data.gnucash_state()
+        if self._meta is None:
+            self._meta = self._read_meta()
+        meta = self._meta
+        accounts = sorted(row.account for row in self._data.contract_rows())
+        if meta is not None and meta["accounts"] == accounts:
+            if meta["state"] == state:
+                self.accounts = accounts
+                return False
+            rows = self._data.split_rows(since=meta["state"])
+            # Only appended splits can be appended, everything else (edited or
+            # deleted splits) shows up as a mismatch of the split count.
+            if meta["state"].splits + len(rows) == state.splits:
+                added = self._append(rows, accounts)
+                self._write_meta(dict(meta, state=state,
+                                      rows=meta["rows"] + added))
+                return True
+        os.makedirs(self.directory, exist_ok=True)
+        count = self._append(self._data.split_rows(), accounts, mode="wb")
+        self._write_meta({"state": state, "accounts": accounts,
+                          "rows": count})
+        return True
+
+    def columns(self):
+        """Return the cached columns, refreshing the cache first.
+
+Returns
+-------
+out : dict
+    Column name -> read-only array, see `COLUMNS`.  The arrays are mapped from
+    the cache files, without copying.
+        """
+        self.refresh()
+        if self._meta["rows"] == 0:
+            return {name: np.empty(0, dtype=dtype)
+                    for name, dtype in COLUMNS.items()}
+        return {name: np.memmap(self._path(name + ".bin"), dtype=dtype,
+                                mode="r", shape=(self._meta["rows"],))
+                for name, dtype in COLUMNS.items()}
+
+    def balances(self, until=None):
+        """The balances of the contract accounts, in cents.
+
+Parameters
+----------
+until : datetime.date, optional
+    If given, only splits posted before this date are summed up.
+
+Returns
+-------
+out : dict
+    Account guid -> sum of the split values in cents (int).  Liabilities are
+    negative, as in GnuCash.
+        """
+        columns = self.columns()
+        selected = np.ones(len(columns["value"]), dtype=bool)
+        if until is not None:
+            selected = columns["date"] < np.datetime64(until, "D")
+        sums = np.zeros(len(self.accounts), dtype=COLUMNS["value"])
+        np.add.at(sums, columns["account"][selected],
+                  columns["value"][selected])
+        return {guid: int(total) for guid, total in zip(self.accounts, sums)}
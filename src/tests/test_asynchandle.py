@@ -0,0 +1,118 @@
+#!/usr/bin/env pytest
+"""Test the asynchandle module.
+
+Call e.g. with `pytest` (for Python3).
+"""
+
+import asyncio
+import datetime
+import threading
+from decimal import Decimal
+
+import pytest
+
+from dkcashlib import asynchandle
+from dkcashlib import common
+
+
+@pytest.fixture
+def filename(tmp_path):
+    filename = str(tmp_path / "test.gnucash")
+    connection = asynchandle.AsyncConnection(filename).connection
+    dagobert = common.Creditor("Dagobert Duck", ["Geldspeicher 1"],
+                               connection=connection)
+    common.Creditor("Donald Duck", ["Entenhausen"], connection=connection)
+    common.Contract("1", dagobert, date="2020-01-01", amount=1000.0,
+                    interest=1.0, period_end=datetime.date(2020, 7, 1),
+                    connection=connection)
+    common.Contract("2", dagobert, date="2020-01-01", amount=365.0,
+                    interest=10.0, period_type="fixed_period_notice",
+                    period_notice="0-03", connection=connection)
+    return filename
+
+
+def test_reads(filename):
+    async def main():
+        async with await asynchandle.AsyncConnection.open(
+                filename, readers=3) as connection:
+            creditors, contracts, interests, due = await asyncio.gather(
+                connection.find_creditors(),
+                connection.find_contracts(creditor=1),
+                connection.calculate_interests("2020-01-01", "2021-01-01"),
+                connection.next_due_dates())
+            # Concurrent reads run in several threads.
+            names = await asyncio.gather(*[
+                connection.run_read(
+                    lambda conn: (threading.current_thread().name,
+                                  [creditor.name for creditor
+                                   in conn.find_creditors()]))
+                for _ in range(6)])
+        return creditors, contracts, interests, due, names
+
+    creditors, contracts, interests, due, names = asyncio.run(main())
+    assert [creditor.name for creditor in creditors] == ["Dagobert Duck",
+                                                         "Donald Duck"]
+    assert [contract.contract_id for contract in contracts] == [1, 2]
+    assert interests == {1: Decimal("4.99"), 2: Decimal("36.60")}
+    assert [contract.contract_id for _, contract in due] == [1]
+    assert all(name.startswith("dkcash-read") for name, _ in names)
+    assert all(result == ["Dagobert Duck", "Donald Duck"]
+               for _, result in names)
+
+
+def test_writes(filename):
+    async def main():
+        async with asynchandle.AsyncConnection(filename) as connection:
+            threads = await asyncio.gather(*[
+                connection.run_write(
+                    lambda conn: threading.current_thread().name)
+                for _ in range(3)])
+            deleted = await connection.delete_creditors([2])
+            return threads, deleted, await connection.find_creditors()
+
+    threads, deleted, creditors = asyncio.run(main())
+    assert len(set(threads)) == 1
+    assert deleted[0] == 1
+    assert [creditor.name for creditor in creditors] == ["Dagobert Duck"]
+
+
+def test_cancel_report(filename, tmp_path):
+    started = threading.Event()
+    release = threading.Event()
+
+    async def main():
+        connection = asynchandle.AsyncConnection(filename, readers=1)
+        # Keep the only reader busy, so that the report waits in the queue.
+        blocker = asyncio.ensure_future(connection.run_read(
+            lambda conn: (started.set(), release.wait(5))))
+        report = asyncio.ensure_future(connection.generate_report(
+            str(tmp_path / "reports"), year=2020, workers=1))
+        await asyncio.get_running_loop().run_in_executor(None, started.wait)
+        report.cancel()
+        # Wait until the cancellation reached the queue.
+        await asyncio.wait([report])
+        release.set()
+        await blocker
+        with pytest.raises(asyncio.CancelledError):
+            await report
+        await connection.close()
+
+    asyncio.run(main())
+    assert not (tmp_path / "reports").exists()
+
+
+def test_progress(filename, tmp_path):
+    calls = []
+
+    async def main():
+        async with asynchandle.AsyncConnection(filename) as connection:
+            loop_thread = threading.current_thread()
+            await connection.generate_report(
+                str(tmp_path / "reports"), year=2020, workers=1,
+                progress=lambda *args: calls.append(
+                    (threading.current_thread() is loop_thread,) + args))
+            # The callbacks are scheduled in the loop.
+            await asyncio.sleep(0)
+
+    asyncio.run(main())
+    assert calls == [(True, 1, 2, 1), (True, 2, 2, 2)]
@@ -0,0 +1,77 @@
+#!/usr/bin/env pytest
+"""Test the batch module.
+
+Call e.g. with `pytest` (for Python3).
+"""
+
+import datetime
+from decimal import Decimal
+
+import pytest
+
+from dkcashlib import batch
+from dkcashlib import dkhandle
+
+from dkcashlib.common import Creditor
+
+
+@pytest.fixture
+def files(tmp_path):
+    filenames = []
+    for number in range(3):
+        filename = str(tmp_path / "project{}.gnucash".format(number))
+        conn = dkhandle.Connection(gnucash_file=filename)
+        creditor = Creditor("Creditor {}".format(number),
+                            ["Street {}".format(number)], connection=conn)
+        for contract_id in range(number):
+            conn._data.add_contract(
+                contract_id, creditor.creditor_id, date="2019-01-01",
+                amount=100.0, interest=1.0,
+                period_end=datetime.date(2030, 1, 1))
+        filenames.append(filename)
+    return filenames
+
+
+def test_expand_files(files, tmp_path):
+    pattern = str(tmp_path / "project?.gnucash")
+    assert batch.expand_files([pattern, files[0]]) == files
+    assert batch.expand_files(["missing.gnucash"]) == ["missing.gnucash"]
+    # Backups of piecash are left out.
+    backup = tmp_path / "project0.20200101120000.gnucash"
+    backup.write_bytes(b"")
+    assert batch.expand_files([str(tmp_path / "*.gnucash")]) == files
+    assert batch.expand_files([str(backup)]) == []
+
+
+def test_run_batch(files, tmp_path):
+    missing = str(tmp_path / "missing.gnucash")
+    summary = batch.run_batch(files + [missing], workers=2)
+    assert [outcome["file"] for outcome in summary["files"]] == (files +
+                                                                  [missing])
+    assert summary["totals"] == {"creditors": 3, "contracts": 3,
+                                 "amount": 300.0}
+    assert summary["failed"] == [missing]
+    assert "open" in summary["files"][-1]["errors"]
+
+    with pytest.raises(ValueError):
+        batch.run_batch(files, tasks=["no such task"])
+
+
+def test_run_batch_exit(files):
+    # A missing base account makes the initialization exit.
+    summary = batch.run_batch(files[:1], base_dk="Aktiva:Nope")
+    assert summary["failed"] == files[:1]
+    assert summary["files"][0]["errors"]["open"] == "SystemExit: 1"
+
+
+def test_interest_and_export(files, capsys):
+    assert batch.main(["-t", "interest", "export", "--start", "2020-01-01",
+                       "--"] + files[1:]) == 0
+    assert "FAILED" not in capsys.readouterr().out
+    summary = batch.run_batch(files[2:], tasks=["interest", "export"],
+                              task_kwargs={"interest": {"start": "2020-01-01"}})
+    results = summary["files"][0]["results"]
+    assert results["interest"] == {0: Decimal("1.00"), 1: Decimal("1.00")}
+    assert results["export"] == 2
+    with open(files[2][:-len(".gnucash")] + ".csv") as csv_file:
+        assert len(csv_file.readlines()) == 3
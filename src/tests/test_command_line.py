@@ -0,0 +1,53 @@
+#!/usr/bin/env pytest
+"""Test the headless command line interface.
+
+Call e.g. with `pytest` (for Python3).
+"""
+
+import json
+import sys
+
+import pytest
+
+from dkcashlib import command_line
+from dkcashlib import dkhandle
+
+from dkcashlib.common import Creditor
+
+
+@pytest.fixture
+def filename(tmp_path):
+    filename = str(tmp_path / "test.gnucash")
+    conn = dkhandle.Connection(gnucash_file=filename)
+    Creditor("Donald Duck", ["Entengasse 5"], connection=conn)
+    Creditor("Dagobert Duck", ["Geldspeicher 1"], connection=conn)
+    return filename
+
+
+def test_creditors(filename, capsys):
+    assert command_line.main(["-f", filename, "creditors",
+                              "-w", "name=Dago*"]) == 0
+    lines = capsys.readouterr().out.splitlines()
+    assert [json.loads(line)["name"] for line in lines] == ["Dagobert Duck"]
+
+    assert command_line.main(["-f", filename, "--format", "csv",
+                              "creditors"]) == 0
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0].startswith("id,name,address1")
+    assert len(lines) == 3
+
+
+def test_statements(filename, tmp_path, capsys):
+    output = tmp_path / "statements"
+    assert command_line.main(["-f", filename, "statements", "-o",
+                              str(output), "--start", "2020-01-01"]) == 0
+    records = [json.loads(line)
+               for line in capsys.readouterr().out.splitlines()]
+    assert [record["creditor"] for record in records] == [1, 2]
+    assert all(record["rendered"] for record in records)
+    assert (output / "statement_1.txt").exists()
+
+
+def test_no_gui_import(filename):
+    command_line.main(["-f", filename, "contracts"])
+    assert "PyQt5" not in sys.modules
@@ -13,6 +13,7 @@ import sys
 import unittest
 
 # from datetime import date
+from decimal import Decimal
 # from dkcashlib import dkdata, errors
 from dkcashlib import common
 from dkcashlib import dkhandle
@@ -209,3 +210,93 @@ def test_contract_delete(connection):
 
     # delete the contract
     contract.delete()
+
+
+def test_slots(connection):
+    """Creditors, contracts and their states have no instance dicts."""
+    creditor = _create_creditor(connection=connection)
+    contract = _create_contract(creditor, connection=connection)
+    for obj in (creditor, contract, contract._initial_state):
+        assert not hasattr(obj, "__dict__")
+    with unittest.TestCase().assertRaises(AttributeError):
+        creditor.no_such_attribute = 1
+
+
+def test_find_rows(connection):
+    """Listing creditors and contracts as rows."""
+    creditor = _create_creditor(connection=connection, number=1)
+    _create_creditor(connection=connection, number=2)
+    contract = _create_contract(creditor, connection=connection, number=42)
+    contract.insert()
+
+    rows = Creditor.find_rows(connection)
+    assert [row.name for row in rows] == ["Creditor 1", "Creditor 2"]
+    assert rows[0].id == creditor.creditor_id
+    assert Creditor.find_rows(connection, name="*2") == [rows[1]]
+
+    rows = Contract.find_rows(connection, creditor=creditor.creditor_id)
+    assert len(rows) == 1
+    assert rows[0].id == "42"
+    assert rows[0].amount == Decimal(str(contract.amount))
+    assert rows[0].date == datetime.date(2019, 1, 12)
+    assert rows[0].active is False
+    with unittest.TestCase().assertRaises(AttributeError):
+        rows[0].amount = 0
+
+
+def test_creditor_find(connection):
+    """Finding creditors by different properties."""
+    donald = _create_creditor(connection=connection, number=1)
+    daisy = _create_creditor(connection=connection, number=2)
+    daisy.update(email="daisy@example.com", newsletter=True)
+
+    found = Creditor.find(connection, name="Creditor *")
+    assert [x.creditor_id for x in found] == [donald.creditor_id,
+                                              daisy.creditor_id]
+    found = Creditor.find(connection, address=["Street 2"])
+    assert [x.creditor_id for x in found] == [daisy.creditor_id]
+    found = Creditor.find(connection, newsletter=True)
+    assert [x.email for x in found] == ["daisy@example.com"]
+    assert found[0].address == ("Street 2", "2 Entenhausen", "", "")
+
+
+def test_contract_hydration(connection):
+    """Contracts loaded from the database are complete."""
+    creditor = _create_creditor(connection=connection)
+    contract = _create_contract(creditor, connection=connection, number=17)
+    contract.insert()
+
+    found = Contract.find(connection, creditor=creditor)
+    assert len(found) == 1
+    assert found[0].contract_id == 17
+    assert found[0].creditor_id == creditor.creditor_id
+    assert found[0].interest_payment == contract.interest_payment
+    assert found[0].period_notice == contract.period_notice
+    assert found[0]._states == {found[0].date: found[0]._initial_state}
+    assert Contract.find(connection, version="2.0") == []
+
+    query_result = connection._data.find_contracts(id=17)
+    from_namespace = Contract.from_namespace(query_result.first(),
+                                             connection=connection)
+    assert from_namespace.amount == found[0].amount
+
+
+def test_contract_update_many(connection):
+    """Deactivating many contracts at once."""
+    creditor = _create_creditor(connection=connection)
+    contracts = [_create_contract(creditor, connection=connection, number=n)
+                 for n in (1, 2, 3)]
+    for contract in contracts:
+        contract.insert()
+
+    updated = Contract.update_many(connection, contracts[:2], active=True)
+    assert sorted(x.contract_id for x in updated) == [1, 2]
+    rows = Contract.find_rows(connection, active=True)
+    assert sorted(row.id for row in rows) == ["1", "2"]
+
+    assert contracts[2].update(interest=2.5, version="2.0")
+    assert contracts[2].interest == 2.5
+    assert contracts[2].version == "2.0"
+    assert not contracts[2].update()
+    with unittest.TestCase().assertRaises(ValueError):
+        Contract.update_many(connection, contracts, no_such_column=1)
@@ -0,0 +1,86 @@
+#!/usr/bin/env pytest
+"""Test the daemon module.
+
+Call e.g. with `pytest` (for Python3).
+"""
+
+import json
+import os
+import stat
+import threading
+
+import pytest
+
+from dkcashlib import command_line
+from dkcashlib import daemon
+from dkcashlib import dkhandle
+
+from dkcashlib.common import Creditor
+
+
+@pytest.fixture
+def server(tmp_path):
+    filename = str(tmp_path / "test.gnucash")
+    conn = dkhandle.Connection(gnucash_file=filename)
+    Creditor("Dagobert Duck", ["Geldspeicher 1"], connection=conn)
+    server = daemon.DaemonServer(conn)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def test_request(server):
+    filename = server.gnucash_file
+    response = daemon.request(filename, ["-f", filename, "creditors"])
+    assert response["exit"] == 0
+    assert [x["name"] for x in response["records"]] == ["Dagobert Duck"]
+
+    response = daemon.request(filename, ["-f", filename, "export", "x.csv"])
+    assert response["exit"] == 1
+    response = daemon.request(filename, ["-f", "other.gnucash", "creditors"])
+    assert response["exit"] == 1
+
+    with pytest.raises(RuntimeError):
+        daemon.DaemonServer(server.connection)
+
+
+def test_socket_mode(server):
+    mode = os.stat(daemon.socket_path(server.gnucash_file)).st_mode
+    assert stat.S_IMODE(mode) == 0o600
+
+
+def test_command_line(server, capsys, monkeypatch):
+    filename = server.gnucash_file
+    # Make sure that the daemon answers, not a local connection.
+    monkeypatch.setattr(dkhandle, "Connection", None)
+    assert command_line.main(["-f", filename, "creditors"]) == 0
+    lines = capsys.readouterr().out.splitlines()
+    assert [json.loads(line)["name"] for line in lines] == ["Dagobert Duck"]
+
+
+def test_command_line_relative(server, capsys, monkeypatch, tmp_path):
+    # The client's working directory differs from the daemon's.
+    monkeypatch.setattr(dkhandle, "Connection", None)
+    subdirectory = tmp_path / "sub"
+    subdirectory.mkdir()
+    monkeypatch.chdir(subdirectory)
+    request = daemon.request
+
+    def request_elsewhere(gnucash_file, argv):
+        path = daemon.socket_path(gnucash_file)
+        # The daemon resolves the paths in its own working directory.
+        monkeypatch.chdir(tmp_path.parent)
+        return request(gnucash_file, argv, path=path)
+
+    monkeypatch.setattr(daemon, "request", request_elsewhere)
+    assert command_line.main(["--format", "csv", "-f", "../test.gnucash",
+                              "creditors"]) == 0
+    assert "Dagobert Duck" in capsys.readouterr().out
+
+
+def test_no_daemon(tmp_path):
+    filename = str(tmp_path / "test.gnucash")
+    assert daemon.request(filename, ["-f", filename, "creditors"]) is None
@@ -8,10 +8,12 @@ import argparse
 import os
 import pathlib2
 import pytest
+import sqlite3
 import sys
 import unittest
 
 from datetime import date
+from decimal import Decimal
 from dkcashlib import dkdata, errors
 
 
@@ -39,3 +41,346 @@ def test_dkdata_add_contract(data):
         data.add_contract("2038", creditor_id, date="2002-02-02", amount=0.01,
                           interest=0.0, period_end=date(2003, 3, 3))
 
+
+def test_dkdata_update(data):
+    creditor_id = data.add_creditor("Someone", ["address line 1"],
+                                    email="hallo@example.com")
+    other_id = data.add_creditor("Someone else", ["address line 1"])
+    rows = data.update_creditors([creditor_id, other_id], newsletter=True,
+                                 address2="address line 2")
+    assert len(rows) == 2
+    assert all(row[-1] is True for row in rows)
+    assert data.update_creditor(creditor_id, phone="+49123")
+    assert data.creditor_rows(id=creditor_id)[0][6] == "+49123"
+    assert not data.update_creditor(creditor_id)
+    assert not data.update_creditor(12345, name="Nobody")
+
+def test_dkdata_delete_creditors(data):
+    creditor_ids = [data.add_creditor("Someone {}".format(number),
+                                      ["address line 1"])
+                    for number in range(3)]
+    data.add_contract("1", creditor_ids[0], date="2001-01-01", amount=1.0,
+                      interest=0.1, period_end=date(2002, 1, 1))
+    data.add_contract("2", creditor_ids[1], date="2001-01-01", amount=1.0,
+                      interest=0.1, period_end=date(2002, 1, 1))
+
+    with unittest.TestCase().assertRaises(errors.DatabaseError):
+        data.delete_creditors(creditor_ids)
+    with unittest.TestCase().assertRaises(ValueError):
+        data.delete_creditors(creditor_ids + [12345], delete_contracts=True)
+    assert len(data.creditor_rows()) == 3
+
+    assert data.delete_creditors(creditor_ids[:2], delete_contracts=True,
+                                 delete_accounts=True) == (2, 2, 2)
+    assert [row[0] for row in data.creditor_rows()] == creditor_ids[2:]
+    assert data.contract_rows() == []
+    # The contract accounts can be created again.
+    data.add_contract("1", creditor_ids[2], date="2001-01-01", amount=1.0,
+                      interest=0.1, period_end=date(2002, 1, 1))
+
+def test_dkdata_typed_columns(data):
+    creditor_id = data.add_creditor("Someone", ["address line 1"])
+    data.add_contract("1", creditor_id, date="2001-1-5", amount=1234.56,
+                      interest=0.1, period_end=date(2002, 1, 1))
+    data.add_contract("2", creditor_id, date=date(2001, 2, 3), amount="0.1",
+                      interest=0.1, period_end="2002-01-01")
+    rows = data.contract_rows()
+    assert [row[3] for row in rows] == [date(2001, 1, 5), date(2001, 2, 3)]
+    assert [row[4] for row in rows] == [Decimal("1234.56"), Decimal("0.10")]
+    assert data.sum_amounts() == Decimal("1234.66")
+    assert data.sum_amounts(id="2") == Decimal("0.10")
+    assert data.sum_amounts(id="3") == Decimal("0")
+
+
+def test_dkdata_migrate_contracts(tmp_path):
+    filename = str(tmp_path / "old.gnucash")
+    data = dkdata.DKData(gnucash_file=filename)
+    creditor_id = data.add_creditor("Someone", ["address line 1"])
+    # Replace the contracts table by the untyped one of older versions.
+    connection = sqlite3.connect(filename)
+    account = connection.execute("SELECT guid FROM accounts").fetchone()[0]
+    connection.executescript("""
+        DROP TABLE dkcash_meta;
+        DROP TABLE contracts;
+        CREATE TABLE contracts (
+            id VARCHAR PRIMARY KEY, creditor INTEGER NOT NULL
+            REFERENCES creditors(id), account VARCHAR NOT NULL
+            REFERENCES accounts(guid), date VARCHAR NOT NULL,
+            amount FLOAT NOT NULL, interest FLOAT NOT NULL,
+            interest_payment VARCHAR NOT NULL, version VARCHAR,
+            period_type VARCHAR NOT NULL, period_notice VARCHAR,
+            period_end VARCHAR, cancellation_date VARCHAR,
+            active BOOLEAN NOT NULL);""")
+    connection.execute(
+        "INSERT INTO contracts VALUES ('7', ?, ?, '2019-1-5', 0.1, 1.0, "
+        "'payout', NULL, 'fixed_duration', NULL, '2020-12-31', NULL, 0)",
+        (creditor_id, account))
+    connection.commit()
+    connection.close()
+
+    data = dkdata.DKData(gnucash_file=filename)
+    rows = data.contract_rows()
+    assert len(rows) == 1
+    assert rows[0][3:5] == (date(2019, 1, 5), Decimal("0.10"))
+    assert rows[0][10] == date(2020, 12, 31)
+    connection = sqlite3.connect(filename)
+    assert connection.execute(
+        "SELECT amount, date FROM contracts").fetchone() == (10, "2019-01-05")
+    connection.close()
+
+
+def test_dkdata_meta(data, monkeypatch):
+    filename = data._gnucash_file
+    connection = sqlite3.connect(filename)
+    meta = dict(connection.execute("SELECT key, value FROM dkcash_meta"))
+    connection.close()
+    assert meta["schema_version"] == str(dkdata.DKData.schema_version)
+    assert meta["account_dk"] == data._account_guids["dk"]
+
+    # An initialized file needs no initialization anymore.
+    def fail(*args, **kwargs):
+        raise AssertionError("Should not be called.")
+    monkeypatch.setattr(dkdata.DKData, "_init_full", fail)
+    data_again = dkdata.DKData(gnucash_file=filename)
+    assert data_again._account_guids == data._account_guids
+    monkeypatch.undo()
+
+    # An outdated file is initialized again.
+    connection = sqlite3.connect(filename)
+    connection.execute(
+        "UPDATE dkcash_meta SET value = '1' WHERE key = 'schema_version'")
+    connection.commit()
+    connection.close()
+    data_again = dkdata.DKData(gnucash_file=filename)
+    assert data_again._account_guids == data._account_guids
+    creditor_id = data_again.add_creditor("Someone", ["address line 1"])
+    data_again.add_contract("1", creditor_id, date="2001-01-01", amount=1.0,
+                            interest=0.1, period_end=date(2002, 1, 1))
+
+
+def test_dkdata_meta_base_accounts(data):
+    import piecash
+
+    filename = data._gnucash_file
+    with piecash.open_book(filename, readonly=False) as book:
+        piecash.Account(name="Passiva", type="LIABILITY",
+                        parent=book.root_account,
+                        commodity=book.commodities.get(mnemonic="EUR"))
+        book.save()
+    # Other base accounts are initialized, although the file is up to date.
+    data_again = dkdata.DKData(gnucash_file=filename, base_dk="Passiva")
+    assert data_again._account_guids["dk"] != data._account_guids["dk"]
+    assert (data_again._account_guids["zinsen"]
+            == data._account_guids["zinsen"])
+    with sqlite3.connect(filename) as connection:
+        meta = dict(connection.execute("SELECT key, value FROM dkcash_meta"))
+    assert meta["base_dk"] == "Passiva"
+    assert meta["base_zinsen"] == ""
+    assert meta["account_dk"] == data_again._account_guids["dk"]
+
+
+def test_dkdata_query_cache(data, monkeypatch):
+    monkeypatch.setattr(dkdata, "_query_cache", dkdata._QueryCache(maxsize=2))
+    data.add_creditor("Dagobert Duck", ["Geldspeicher 1"], email=None)
+    data.add_creditor("Donald Duck", ["Erpelweg 13"], email="d@example.org")
+
+    assert [row.name for row in data.creditor_rows(name="Dago*")] == [
+        "Dagobert Duck"]
+    assert [row.name for row in data.creditor_rows(name="Do*")] == [
+        "Donald Duck"]
+    assert [row.name for row in data.creditor_rows(email=None)] == [
+        "Dagobert Duck"]
+    assert [row.name for row in data.creditor_rows(
+        email="d@example.org")] == ["Donald Duck"]
+    stats = data.query_cache_stats()
+    assert (stats["hits"], stats["misses"], stats["size"]) == (1, 3, 2)
+    assert stats["hit_rate"] == 0.25
+    # LIKE patterns, None and exact values have different shapes.
+    assert data.find_creditors(name="Donald Duck").count() == 1
+    assert data.query_cache_stats()["misses"] == 4
+
+
+def test_dkdata_like_typed_columns(data):
+    creditor_id = data.add_creditor("Someone", ["Street 1"])
+    data.add_contract("1", creditor_id, date="2019-03-01", amount=1234.56,
+                      interest=1.0, period_end=date(2030, 1, 1))
+    data.add_contract("2", creditor_id, date="2020-03-01", amount=100,
+                      interest=1.0, period_end=date(2025, 1, 1))
+    assert [row.id for row in data.contract_rows(date="2019*")] == ["1"]
+    assert [row.id for row in data.contract_rows(period_end="2030*")] == ["1"]
+    # Amounts are stored in cents.
+    assert [row.id for row in data.contract_rows(amount="1234*")] == ["1"]
+
+
+def test_dkdata_pages(data):
+    creditor_id = data.add_creditor("Dagobert Duck", ["Geldspeicher 1"])
+    for name in ("Donald Duck", "Daisy Duck", "Gustav Gans", "Daisy Duck"):
+        data.add_creditor(name, ["Entenhausen"])
+    for contract_id in range(1, 12):
+        data.add_contract(contract_id, creditor_id,
+                          date="2020-01-{:02d}".format(contract_id % 3 + 1),
+                          amount=100.0, interest=1.0,
+                          period_end=date(2030, 1, 1))
+
+    def all_pages(method, **kwargs):
+        pages = []
+        page = method(**kwargs)
+        pages.append(page.rows)
+        while page.cursor is not None:
+            page = method(after=page.cursor, **kwargs)
+            pages.append(page.rows)
+        return [[row.id for row in rows] for rows in pages]
+
+    assert all_pages(data.contract_page, page_size=4) == [
+        ["1", "2", "3", "4"], ["5", "6", "7", "8"], ["9", "10", "11"]]
+    assert all_pages(data.contract_page, page_size=5, order_by="date") == [
+        ["3", "6", "9", "1", "4"], ["7", "10", "2", "5", "8"], ["11"]]
+    assert all_pages(data.creditor_page, page_size=2, order_by="name") == [
+        [1, 3], [5, 2], [4]]
+    assert all_pages(data.creditor_page, page_size=5, name="D*") == [
+        [1, 2, 3, 5]]
+
+    # Inserting rows does not shift the following pages.
+    page = data.contract_page(page_size=4)
+    data.add_contract(0, creditor_id, date="2020-01-01", amount=1.0,
+                      interest=1.0, period_end=date(2030, 1, 1))
+    page = data.contract_page(page_size=4, after=page.cursor)
+    assert [row.id for row in page.rows] == ["5", "6", "7", "8"]
+
+    with pytest.raises(ValueError):
+        data.contract_page(order_by="interest")
+    with pytest.raises(ValueError):
+        data.creditor_page(page_size=0)
+
+
+def test_dkdata_defer_writes(data, monkeypatch):
+    creditor_id = data.add_creditor("Someone", ["Street 1"])
+    data.add_contract("7", creditor_id, date="2001-01-01", amount=100,
+                      interest=1.0, period_end=date(2002, 1, 1))
+
+    def stored(column, table="contracts"):
+        with sqlite3.connect(data._gnucash_file) as connection:
+            return connection.execute("SELECT {} FROM {}".format(
+                column, table)).fetchone()[0]
+
+    saves = []
+    monkeypatch.setattr(dkdata.piecash.Book, "save",
+                        lambda book: saves.append(book.session.commit()))
+    data.defer_writes(delay=None)
+    data.update_creditor(creditor_id, name="Someone Else")
+    data.update_contract(7, amount="150.5")
+    rows = data.update_contracts([7], period_end="2003-2-1")
+    assert rows[0][4] == Decimal("150.50")
+    assert rows[0][10] == date(2003, 2, 1)
+    assert data.update_contracts([8], interest=2.0) == []
+    assert data.pending_writes() == {
+        ("creditors", creditor_id): {"name": "Someone Else"},
+        ("contracts", "7"): {"amount": "150.5", "period_end": "2003-2-1"}}
+    assert saves == []
+    assert stored("amount") == 10000
+
+    # Reads see the pending updates without writing them.
+    assert data.contract_rows()[0].amount == Decimal("150.50")
+    assert next(data.iter_contract_rows()).period_end == date(2003, 2, 1)
+    assert data.creditor_page().rows[0].name == "Someone Else"
+    assert data.find_creditors()[0].name == "Someone Else"
+    assert data.find_contracts()[0].amount == Decimal("150.50")
+    data.update_contract(7, amount=160)
+    assert data.contract_rows()[0].amount == Decimal("160.00")
+    assert saves == []
+    # Unless the filters use an updated column.
+    assert data.creditor_rows(name="Someone Else")[0].id == creditor_id
+    assert len(saves) == 1
+    assert data.pending_writes() == {}
+    assert stored("name", "creditors") == "Someone Else"
+    assert stored("amount") == 16000
+
+    assert data.save() == 0
+    data.update_contract(7, interest=2.5)
+    assert data.save() == 1
+    assert stored("interest") == 2.5
+    assert len(saves) == 2
+
+    # With a delay, the updates are written in the background.
+    data.defer_writes(delay=0.1)
+    data.update_contract(7, interest=3.0)
+    timer = data._write_behind._timer
+    assert stored("interest") == 2.5
+    timer.join()
+    assert stored("interest") == 3.0
+    data.defer_writes(False)
+    data.update_contract(7, interest=3.5)
+    assert stored("interest") == 3.5
+
+
+def test_dkdata_defer_writes_rollback(data):
+    creditor_id = data.add_creditor("A", ["Street 1"])
+    data.defer_writes(delay=None)
+    data.update_creditor(creditor_id, name="B")
+    # The updates are written in a transaction which is rolled back.
+    with pytest.raises(KeyError):
+        with dkdata._opened_book(data):
+            data.save()
+            data.update_creditor(creditor_id, phone="123")
+            raise KeyError()
+    assert data.pending_writes() == {("creditors", creditor_id): {"name": "B"}}
+    data.update_creditor(creditor_id, name="C")
+    assert data.save() == 1
+    with sqlite3.connect(data._gnucash_file) as connection:
+        assert connection.execute("SELECT name FROM creditors").fetchone() == (
+            "C",)
+
+
+def test_dkdata_include(data):
+    import piecash
+    import sqlalchemy
+
+    for number in range(1, 4):
+        creditor_id = data.add_creditor("Creditor {}".format(number),
+                                        ["Street {}".format(number)])
+        for contract in range(2):
+            data.add_contract(str(10 * number + contract), creditor_id,
+                              date="2020-01-01", amount=100, interest=1.0,
+                              period_end=date(2021, 1, 1))
+    with piecash.open_book(data._gnucash_file, readonly=False,
+                           open_if_lock=True) as book:
+        account = book.accounts.get(name="DK 010")
+        piecash.Transaction(
+            currency=book.default_currency, description="Payment",
+            post_date=date(2020, 1, 1),
+            splits=[piecash.Split(account=account, value=-100),
+                    piecash.Split(account=book.accounts.get(
+                        guid=data._account_guids["ausgleich"]), value=100)])
+        book.save()
+
+    statements = []
+
+    def count(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    with dkdata._opened_book(data, readonly=True):
+        sqlalchemy.event.listen(sqlalchemy.engine.Engine,
+                                "before_cursor_execute", count)
+        try:
+            contracts = data.find_contracts(
+                include=("creditor", "account", "splits")).all()
+            listing = [(contract.id, contract.creditor_record.name,
+                        contract.account_record.name, len(contract.splits))
+                       for contract in contracts]
+            assert len(statements) == 2
+            del statements[:]
+            creditors = data.find_creditors(
+                include=["contracts.splits"]).all()
+            nested = {creditor.name: [len(contract.splits)
+                                      for contract in creditor.contracts]
+                      for creditor in creditors}
+            assert len(statements) == 3
+        finally:
+            sqlalchemy.event.remove(sqlalchemy.engine.Engine,
+                                    "before_cursor_execute", count)
+    assert sorted(listing)[0] == ("10", "Creditor 1", "DK 010", 1)
+    assert len(listing) == 6
+    assert nested == {"Creditor 1": [1, 0], "Creditor 2": [0, 0],
+                      "Creditor 3": [0, 0]}
+    with pytest.raises(ValueError):
+        data.find_contracts(include=("contracts",))
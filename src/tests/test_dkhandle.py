@@ -7,12 +7,16 @@ Call e.g. with `pytest` (for Python3).
 # import argparse
 # import os
 # import pathlib2
+import datetime
 import pytest
 # import sys
 import unittest
 
+import piecash
+
 # from datetime import date
-# from dkcashlib import dkdata, errors
+from decimal import Decimal
+from dkcashlib import dkdata
 from dkcashlib import common
 from dkcashlib import dkhandle
 
@@ -31,3 +35,249 @@ def test_connection(connection):
 
 def test_contract(connection):
     pass
+
+
+def _add_contracts(connection):
+    creditor = common.Creditor("Dagobert Duck", ["Geldspeicher 1"],
+                               connection=connection)
+    common.Contract("1", creditor, date="2020-01-01", amount=1000.0,
+                    interest=1.0, period_end=datetime.date(2020, 7, 1),
+                    connection=connection)
+    common.Contract("2", creditor, date="2020-01-01", amount=365.0,
+                    interest=10.0, period_type="fixed_period_notice",
+                    period_notice="0-03", connection=connection)
+    return creditor
+
+
+def test_find(connection):
+    creditor = _add_contracts(connection)
+    found = connection.find_creditors(name="Dago*")
+    assert [x.creditor_id for x in found] == [creditor.creditor_id]
+    assert connection.find_creditors(name="Donald*") == []
+    assert len(connection.find_contracts(creditor=creditor.creditor_id)) == 2
+
+
+def test_due_dates_and_interest(connection):
+    _add_contracts(connection)
+    due = connection.next_due_dates()
+    assert [(x[0], x[1].contract_id) for x in due] == [
+        (datetime.date(2020, 7, 1), 1)]
+    assert connection.next_due_dates(before="2020-07-01") == []
+
+    interests = connection.calculate_interests("2020-01-01", "2021-01-01")
+    assert interests == {1: Decimal("4.99"), 2: Decimal("36.60")}
+
+
+def test_generate_spreadsheet(connection, tmp_path):
+    _add_contracts(connection)
+    filename = tmp_path / "export.csv"
+    assert connection.generate_spreadsheet(str(filename)) == 2
+    lines = filename.read_text().splitlines()
+    assert len(lines) == 3
+    assert "Dagobert Duck" in lines[1]
+
+
+def _transfer(filename, account, counter_account, amount):
+    """Book `amount` from `counter_account` to `account` in GnuCash."""
+    with piecash.open_book(filename, readonly=False,
+                           open_if_lock=True) as book:
+        piecash.Transaction(
+            currency=book.default_currency, description="Transfer",
+            num=str(amount),
+            post_date=datetime.date(2020, 1, 2),
+            splits=[piecash.Split(account=book.accounts.get(guid=account),
+                                  value=-amount),
+                    piecash.Split(
+                        account=book.accounts.get(guid=counter_account),
+                        value=amount)])
+        book.save()
+
+
+def test_sync(connection):
+    _add_contracts(connection)
+    filename = connection._data._gnucash_file
+    rows = {int(row.id): row for row in connection._data.contract_rows()}
+    ausgleich = connection._data._account_guids["ausgleich"]
+    assert connection.contract_balances() == {1: 0, 2: 0}
+    assert connection.sync() == set()
+
+    _transfer(filename, rows[1].account, ausgleich, Decimal("1000"))
+    assert connection.sync() == {rows[1].account, ausgleich}
+    _transfer(filename, rows[2].account, ausgleich, Decimal("365.5"))
+    assert connection.contract_balances() == {1: Decimal("1000"),
+                                              2: Decimal("365.5")}
+    assert connection.balances()[ausgleich] == Decimal("1365.5")
+
+    # Deleting a transaction in GnuCash requires a full reload.
+    with piecash.open_book(filename, readonly=False,
+                           open_if_lock=True) as book:
+        book.delete(book.transactions(post_date=datetime.date(2020, 1, 2),
+                                      num="1000"))
+        book.save()
+    assert connection.sync() == {rows[1].account, ausgleich}
+    assert connection.contract_balances(id=1) == {1: 0}
+
+
+def test_search_creditors(connection):
+    _check_search(connection)
+
+
+def test_search_creditors_without_index(tmp_path, monkeypatch):
+    # SQLite before 3.34 has no trigram tokenizer.
+    ddl = list(dkdata._search_ddl)
+    ddl[0] = ddl[0].replace("'trigram'", "'no_such_tokenizer'")
+    monkeypatch.setattr(dkdata, "_search_ddl", ddl)
+    with pytest.warns(UserWarning, match="No search index"):
+        connection = dkhandle.Connection(
+            gnucash_file=str(tmp_path / "test.gnucash"))
+    _check_search(connection)
+
+
+def _check_search(connection):
+    for name, address, email in (
+            ("Dagobert Duck", "Geldspeicher 1", "dagobert@example.org"),
+            ("Donald Duck", "Erpelweg 13", "donald@example.org"),
+            ("Daniel Düsentrieb", "Erfinderstraße 2", None)):
+        common.Creditor(name, [address, "Entenhausen"], email=email,
+                        connection=connection)
+
+    def search(text, **kwargs):
+        return [creditor.name
+                for creditor in connection.search_creditors(text, **kwargs)]
+
+    assert sorted(search("duck")) == ["Dagobert Duck", "Donald Duck"]
+    assert search("speicher") == ["Dagobert Duck"]
+    assert search("donald@") == ["Donald Duck"]
+    assert search("Da") == ["Dagobert Duck", "Daniel Düsentrieb"]
+    # Typos
+    assert search("Dagobret") == ["Dagobert Duck"]
+    assert search("Dagobret", fuzzy=False) == []
+    assert len(search("entenhausen", limit=2)) == 2
+
+    # The index follows updates and deletions.
+    creditor = connection.find_creditors(name="Donald Duck")[0]
+    creditor.update(name="Donald Fauntleroy Duck", address=["Erpelweg 13"],
+                    phone=None, email=None)
+    assert search("fauntleroy") == ["Donald Fauntleroy Duck"]
+    assert sorted(search("entenhausen")) == ["Dagobert Duck",
+                                             "Daniel Düsentrieb"]
+    creditor.delete()
+    assert search("fauntleroy") == []
+
+
+def test_find_pages(connection):
+    creditor = _add_contracts(connection)
+    page = connection.find_contracts_page(page_size=1)
+    assert [contract.contract_id for contract in page.rows] == [1]
+    page = connection.find_contracts_page(page_size=1, after=page.cursor)
+    assert [contract.contract_id for contract in page.rows] == [2]
+    assert page.cursor is None
+    page = connection.find_creditors_page(order_by="name")
+    assert page.rows[0].creditor_id == creditor.creditor_id
+    assert page.cursor is None
+
+
+def test_iter_contracts(connection):
+    creditor = _add_contracts(connection)
+    contracts = connection.iter_contracts(batch_size=1)
+    first = next(contracts)
+    assert first.contract_id == 1
+    # The book is open read-only while iterating.
+    with pytest.raises(RuntimeError):
+        connection._data.update_contract(1, interest=2.0)
+    assert [contract.contract_id for contract in contracts] == [2]
+    assert dkdata._open_books.books == {}
+    connection._data.update_contract(1, interest=2.0)
+
+    creditors = connection.iter_creditors(name="Dago*")
+    assert next(creditors).creditor_id == creditor.creditor_id
+    creditors.close()
+    assert dkdata._open_books.books == {}
+
+
+def test_transaction(connection):
+    creditor = _add_contracts(connection)
+    filename = connection._data._gnucash_file
+    ausgleich = connection._data._account_guids["ausgleich"]
+    with connection.transaction() as book:
+        account = connection._data.contract_rows(id=1)[0].account
+        connection.find_contracts(id=1)[0].update(
+            cancellation_date="2020-06-30")
+        common.Contract("3", creditor, date="2020-07-01", amount=500.0,
+                        interest=2.0, period_end=datetime.date(2021, 7, 1),
+                        connection=connection)
+        piecash.Transaction(
+            currency=book.default_currency, description="Transfer",
+            post_date=datetime.date(2020, 1, 2),
+            splits=[piecash.Split(account=book.accounts.get(guid=account),
+                                  value=-1000),
+                    piecash.Split(account=book.accounts.get(guid=ausgleich),
+                                  value=1000)])
+        # Not saved yet.
+        with piecash.open_book(filename, open_if_lock=True) as other:
+            assert len(other.transactions) == 0
+    assert dkdata._open_books.books == {}
+    assert connection.contract_balances() == {1: 1000, 2: 0, 3: 0}
+    assert str(connection.find_contracts(id=1)[0].cancellation_date) == (
+        "2020-06-30")
+
+    with pytest.raises(ZeroDivisionError):
+        with connection.transaction():
+            common.Creditor("Donald Duck", ["Entenhausen"],
+                            connection=connection)
+            connection.delete_creditors([creditor], delete_contracts=True)
+            assert connection.find_creditors(name="Dagobert*") == []
+            1 / 0
+    assert [found.name for found in connection.find_creditors()] == [
+        "Dagobert Duck"]
+    assert len(connection.find_contracts()) == 3
+    assert connection.contract_balances() == {1: 1000, 2: 0, 3: 0}
+
+
+def test_subscribe(connection):
+    batches = []
+    connection.subscribe(batches.append)
+    creditor = _add_contracts(connection)
+    assert batches == [[dkdata.ChangeEvent("inserted", "creditor", 1)],
+                       [dkdata.ChangeEvent("inserted", "contract", 1)],
+                       [dkdata.ChangeEvent("inserted", "contract", 2)]]
+
+    # One batch per transaction, nothing if it is rolled back.
+    del batches[:]
+    with connection.transaction():
+        creditor.update(name="Dagobert")
+        creditor.update(phone="123")
+        connection.find_contracts(id=2)[0].update(interest=2.0)
+    assert batches == [[dkdata.ChangeEvent("updated", "creditor", 1),
+                        dkdata.ChangeEvent("updated", "contract", 2)]]
+    with pytest.raises(ZeroDivisionError):
+        with connection.transaction():
+            creditor.update(name="Dagobert Duck")
+            1 / 0
+    assert len(batches) == 1
+
+    # Deferred updates are published when they are written.
+    connection._data.defer_writes(delay=None)
+    creditor.update(name="Dagobert Duck")
+    assert len(batches) == 1
+    connection._data.save()
+    assert batches[-1] == [dkdata.ChangeEvent("updated", "creditor", 1)]
+    connection._data.defer_writes(False)
+
+    # Balances which changed in GnuCash.
+    connection.sync()
+    account = connection._data.contract_rows(id=1)[0].account
+    ausgleich = connection._data._account_guids["ausgleich"]
+    _transfer(connection._data._gnucash_file, account, ausgleich,
+              Decimal(100))
+    connection.sync()
+    assert batches[-1] == [dkdata.ChangeEvent("updated", "account", guid)
+                           for guid in sorted([account, ausgleich])]
+
+    connection.unsubscribe(batches.append)
+    connection.delete_creditors([creditor], delete_contracts=True)
+    assert len(batches) == 3
+    connection.subscribe(batches.append)
+    common.Creditor("Donald Duck", ["Entenhausen"], connection=connection)
+    connection.delete_creditors([2])
+    assert batches[-1] == [dkdata.ChangeEvent("deleted", "creditor", 2)]
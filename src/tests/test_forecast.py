@@ -0,0 +1,85 @@
+#!/usr/bin/env pytest
+"""Test the forecast module.
+
+Call e.g. with `pytest` (for Python3).
+"""
+
+import datetime
+import types
+
+import numpy as np
+import pytest
+
+from dkcashlib import common
+from dkcashlib import dkhandle
+from dkcashlib import forecast
+
+
+@pytest.fixture
+def connection(tmp_path):
+    conn = dkhandle.Connection(gnucash_file=str(tmp_path / "test.gnucash"))
+    creditor = common.Creditor("Dagobert Duck", ["Geldspeicher 1"],
+                               connection=conn)
+    common.Contract("1", creditor, date="2019-12-01", amount=1200.0,
+                    interest=1.0, period_end=datetime.date(2020, 7, 1),
+                    connection=conn)
+    common.Contract("2", creditor, date="2019-06-01", amount=1200.0,
+                    interest=12.0, interest_payment="reinvest",
+                    period_type="fixed_period_notice", period_notice="0-03",
+                    connection=conn)
+    common.Contract("3", creditor, date="2020-03-15", amount=1200.0,
+                    interest=12.0, interest_payment="cumulative",
+                    period_type="initial_plus_n", period_notice="0-03",
+                    period_end=datetime.date(2021, 3, 1), connection=conn)
+    return conn
+
+
+def test_forecast(connection):
+    result = connection.forecast(years=2, start="2020-01-10")
+    assert result.contract_ids == [1, 2, 3]
+    assert len(result.periods) == 24
+    assert result.periods[0] == datetime.date(2020, 1, 1)
+    assert result.periods[-1] == datetime.date(2021, 12, 1)
+    assert result.balance.shape == (3, 24)
+
+    # Payout, repaid in July with the interest of six months.
+    assert np.allclose(result.interest[0, :6], 1.0)
+    assert result.interest[0, 6:].sum() == 0
+    assert result.payout[0, 6] == pytest.approx(6.0)
+    assert result.repayment[0, 6] == pytest.approx(1200.0)
+    assert result.balance[0, 6:].sum() == 0
+
+    # Reinvested at the end of the year, no due date.
+    assert np.allclose(result.interest[1, :12], 12.0)
+    assert result.balance[1, 11] == pytest.approx(1344.0)
+    assert result.interest[1, 12] == pytest.approx(13.44)
+    assert result.payout[1].sum() == 0
+
+    # Cumulative, from April 2020 until February 2021.
+    assert result.balance[2, 1] == 0
+    assert result.balance[2, 2] == pytest.approx(1200.0)
+    assert result.interest[2].sum() == pytest.approx(11 * 12.0)
+    assert result.payout[2, 14] == pytest.approx(11 * 12.0)
+    assert result.repayment[2, 14] == pytest.approx(1200.0)
+
+    with pytest.raises(ValueError):
+        connection.forecast(years=11)
+
+
+def test_forecast_balances(connection):
+    # Nothing is booked, so the balances are 0.
+    result = connection.forecast(start="2020-01-10", use_balances=True)
+    assert result.balance[0].sum() == 0
+    assert result.balance[1].sum() == 0
+    # The balance is only used for contracts signed before the start.
+    assert result.balance[2, 2] == pytest.approx(1200.0)
+    assert result.interest[2].sum() == pytest.approx(9 * 12.0)
+
+
+def test_project_contract_id_zero():
+    contract = types.SimpleNamespace(
+        contract_id=0, id="7", date=datetime.date(2020, 1, 1), amount=100.0,
+        interest=1.0, interest_payment="payout")
+    result = forecast.project([contract], datetime.date(2020, 1, 1), 12,
+                              due_date=lambda contract: None)
+    assert result.contract_ids == [0]
@@ -0,0 +1,123 @@
+#!/usr/bin/env pytest
+"""Test the importer module.
+
+Call e.g. with `pytest` (for Python3).
+"""
+
+import datetime
+import zipfile
+from decimal import Decimal
+
+import pytest
+
+from dkcashlib import dkhandle
+from dkcashlib import importer
+
+
+@pytest.fixture
+def connection(tmp_path):
+    conn = dkhandle.Connection(gnucash_file=str(tmp_path / "test.gnucash"))
+    return conn
+
+
+CREDITORS = """name,address1,address2,email,newsletter
+Dagobert Duck,Geldspeicher 1,Entenhausen,dagobert@example.org,ja
+Donald Duck,,Entenhausen,,
+Daisy Duck,Blumenweg 2,,,nein
+Gustav Gans,Glücksweg 7,,,ja
+"""
+
+CONTRACTS = """id,creditor,date,amount,interest,period_type,period_notice,period_end
+1,1,2020-01-01,1000.50,1.0,,,2025-01-01
+2,1,2020-02-01,500,0.5,fixed_period_notice,0-06,
+2,1,2020-03-01,-5,x,,,
+3,99,2020-13-01,100,1.0,initial_plus_n,,
+"""
+
+
+def test_import_creditors(connection, tmp_path):
+    filename = tmp_path / "creditors.csv"
+    filename.write_text(CREDITORS)
+    report = importer.import_file(connection, str(filename), "creditors")
+    assert report.rows == 4
+    assert report.inserted == 2
+    assert report.errors == [
+        importer.RowError(3, "address1", "Missing value"),
+        importer.RowError(5, "newsletter",
+                          "Newsletter is True, but no email is set.")]
+    rows = connection._data.creditor_rows()
+    assert [(row.name, row.address2, row.newsletter) for row in rows] == [
+        ("Dagobert Duck", "Entenhausen", True), ("Daisy Duck", "", False)]
+
+
+def test_import_contracts(connection, tmp_path):
+    creditors = tmp_path / "creditors.csv"
+    creditors.write_text(CREDITORS)
+    importer.import_file(connection, str(creditors), "creditors")
+    filename = tmp_path / "contracts.csv"
+    filename.write_text(CONTRACTS)
+
+    report = importer.import_file(connection, str(filename), "contracts",
+                                  dry_run=True)
+    assert (report.rows, report.inserted) == (4, 0)
+    assert {(error.line, error.column) for error in report.errors} == {
+        (4, "id"), (4, "amount"), (4, "interest"), (4, "period_end"),
+        (5, "creditor"),
+        (5, "date"), (5, "period_notice"), (5, "period_end")}
+    assert connection._data.contract_rows() == []
+
+    report = importer.import_file(connection, str(filename), "contracts")
+    assert report.inserted == 2
+    contracts = {contract.contract_id: contract
+                 for contract in connection.find_contracts()}
+    assert sorted(contracts) == [1, 2]
+    assert contracts[1].amount == Decimal("1000.50")
+    assert contracts[1].period_end == datetime.date(2025, 1, 1)
+    assert contracts[2].period_type == "fixed_period_notice"
+    assert contracts[2].interest_payment == "payout"
+
+    # Values which can not be stored are errors of their rows.
+    filename.write_text(
+        "id,creditor,date,amount,interest,period_end\n"
+        "10,1,2020-01-01,NaN,1.0,2025-01-01\n"
+        "11,1,2020-01-01,Infinity,1.0,2025-01-01\n"
+        "12,1,2020-01-01,1e400,1.0,2025-01-01\n"
+        "13,1,2020-01-01,1e20,1.0,2025-01-01\n"
+        "14,1,2020-01-01,100,nan,2025-01-01\n"
+        "15,1,2020-01-01,100,-inf,2025-01-01\n"
+        "16,1,2020-01-01,100.005,1.0,2025-01-01\n")
+    report = importer.import_file(connection, str(filename), "contracts")
+    assert {(error.line, error.column) for error in report.errors} == {
+        (2, "amount"), (3, "amount"), (4, "amount"), (5, "amount"),
+        (6, "interest"), (7, "interest")}
+    assert report.inserted == 1
+    assert connection.find_contracts(id=16)[0].amount == Decimal("100.01")
+    filename.write_text(CONTRACTS)
+
+    # The same IDs can not be imported again.
+    report = importer.import_file(connection, str(filename), "contracts")
+    assert report.inserted == 0
+
+
+def test_read_ods(tmp_path):
+    table = "urn:oasis:names:tc:opendocument:xmlns:table:1.0"
+    text = "urn:oasis:names:tc:opendocument:xmlns:text:1.0"
+    rows = [["name", "address1"], ["Dagobert Duck", "Geldspeicher 1"], []]
+    content = ('<office:document-content xmlns:office="urn:oasis:names:tc:'
+               'opendocument:xmlns:office:1.0" xmlns:table="{}" '
+               'xmlns:text="{}"><office:body><office:spreadsheet>'
+               '<table:table>'.format(table, text))
+    for row in rows:
+        content += "<table:table-row>"
+        for cell in row:
+            content += ("<table:table-cell><text:p>{}</text:p>"
+                        "</table:table-cell>".format(cell))
+        content += ('<table:table-cell table:number-columns-repeated="1000"/>'
+                    "</table:table-row>")
+    content += "</table:table></office:spreadsheet></office:body>"
+    content += "</office:document-content>"
+    filename = tmp_path / "creditors.ods"
+    with zipfile.ZipFile(filename, "w") as archive:
+        archive.writestr("content.xml", content)
+    assert list(importer.read_rows(str(filename))) == [
+        {"name": "Dagobert Duck", "address1": "Geldspeicher 1"}]
@@ -0,0 +1,109 @@
+#!/usr/bin/env pytest
+"""Test the overview module.
+
+Call e.g. with `pytest` (for Python3).
+"""
+
+import datetime
+import sqlite3
+from decimal import Decimal
+
+import piecash
+import pytest
+
+from dkcashlib import common
+from dkcashlib import dkhandle
+
+TODAY = datetime.date(2020, 3, 1)
+
+
+@pytest.fixture
+def connection(tmp_path):
+    conn = dkhandle.Connection(gnucash_file=str(tmp_path / "test.gnucash"))
+    dagobert = common.Creditor("Dagobert Duck", ["Geldspeicher 1"],
+                               connection=conn)
+    donald = common.Creditor("Donald Duck", ["Entenhausen"], connection=conn)
+    common.Contract("1", dagobert, date="2020-01-01", amount=1000.0,
+                    interest=1.0, period_end=datetime.date(2020, 7, 1),
+                    connection=conn)
+    common.Contract("2", dagobert, date="2020-01-01", amount=365.0,
+                    interest=10.0, period_type="fixed_period_notice",
+                    period_notice="0-03", connection=conn)
+    common.Contract("3", donald, date="2020-02-01", amount=100.0,
+                    interest=0.0, period_end=datetime.date(2020, 5, 1),
+                    connection=conn)
+    return conn
+
+
+def _transfer(filename, account, counter_account, amount):
+    """Book `amount` from `counter_account` to `account` in GnuCash."""
+    with piecash.open_book(filename, readonly=False,
+                           open_if_lock=True) as book:
+        piecash.Transaction(
+            currency=book.default_currency, description="Transfer",
+            post_date=datetime.date(2020, 1, 2),
+            splits=[piecash.Split(account=book.accounts.get(guid=account),
+                                  value=-amount),
+                    piecash.Split(
+                        account=book.accounts.get(guid=counter_account),
+                        value=amount)])
+        book.save()
+
+
+def _rows(overview):
+    return overview.page(page_size=10, refresh=False).rows
+
+
+def test_refresh(connection):
+    overview = connection.contract_overview()
+    assert overview.refresh(today=TODAY) == 3
+    rows = _rows(overview)
+    assert [row.contract_id for row in rows] == [1, 2, 3]
+    assert rows[0].creditor_name == "Dagobert Duck"
+    assert rows[0].due_date == datetime.date(2020, 7, 1)
+    assert rows[1].due_date is None
+    assert rows[0].amount == Decimal("1000.00")
+    assert rows[0].accrued_interest == Decimal("1.64")
+    assert rows[0].balance == 0
+    assert overview.refresh(today=TODAY) == 0
+
+    # Only the changed rows are computed again.
+    connection.find_creditors(id=1)[0].update(name="Dagobert")
+    assert overview.refresh(today=TODAY) == 2
+    assert [row.creditor_name for row in _rows(overview)] == [
+        "Dagobert", "Dagobert", "Donald Duck"]
+    # Changes by other processes are noticed, too.
+    with sqlite3.connect(connection._data._gnucash_file) as database:
+        database.execute("UPDATE contracts SET interest = 2.0 WHERE id = '3'")
+    assert overview.refresh(today=TODAY) == 1
+    assert _rows(overview)[2].interest == 2.0
+    connection.find_contracts(id=3)[0].delete()
+    assert overview.refresh(today=TODAY) == 0
+    assert [row.contract_id for row in _rows(overview)] == [1, 2]
+
+    account = _rows(overview)[1].account
+    _transfer(connection._data._gnucash_file, account,
+              connection._data._account_guids["ausgleich"], Decimal(365))
+    assert overview.refresh(today=TODAY) == 1
+    assert _rows(overview)[1].balance == Decimal(365)
+
+    # On the next day, everything is computed again.
+    assert overview.refresh(today=TODAY + datetime.timedelta(days=1)) == 2
+
+
+def test_page(connection):
+    overview = connection.contract_overview()
+    overview.refresh(today=TODAY)
+    page = overview.page(page_size=2, order_by="due_date", refresh=False)
+    assert [row.contract_id for row in page.rows] == [3, 1]
+    page = overview.page(page_size=2, after=page.cursor, order_by="due_date",
+                         refresh=False)
+    assert [row.contract_id for row in page.rows] == [2]
+    assert page.cursor is None
+    page = overview.page(page_size=1, order_by="creditor_name",
+                         refresh=False)
+    page = overview.page(page_size=5, after=page.cursor,
+                         order_by="creditor_name", refresh=False)
+    assert [row.contract_id for row in page.rows] == [2, 3]
+    with pytest.raises(ValueError):
+        overview.page(order_by="interest")
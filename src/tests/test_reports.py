@@ -0,0 +1,176 @@
+#!/usr/bin/env pytest
+"""Test the reports module.
+
+Call e.g. with `pytest` (for Python3).
+"""
+
+import concurrent.futures
+import datetime
+import os
+import time
+from decimal import Decimal
+
+import piecash
+import pytest
+
+from dkcashlib import common
+from dkcashlib import dkhandle
+from dkcashlib import reports
+
+
+@pytest.fixture
+def connection(tmp_path):
+    conn = dkhandle.Connection(gnucash_file=str(tmp_path / "test.gnucash"))
+    dagobert = common.Creditor("Dagobert Duck", ["Geldspeicher 1"],
+                               connection=conn)
+    common.Creditor("Donald Duck", ["Entenhausen"], connection=conn)
+    common.Contract("1", dagobert, date="2020-01-01", amount=1000.0,
+                    interest=1.0, period_end=datetime.date(2020, 7, 1),
+                    connection=conn)
+    common.Contract("2", dagobert, date="2020-01-01", amount=365.0,
+                    interest=10.0, period_type="fixed_period_notice",
+                    period_notice="0-03", connection=conn)
+    return conn
+
+
+def test_gather(connection):
+    payloads = reports.gather(connection, 2020)
+    assert list(payloads) == [1, 2]
+    assert [contract["id"] for contract in payloads[1]["contracts"]] == [1, 2]
+    assert payloads[2]["contracts"] == []
+    assert reports.payload_hash(payloads[1]) == reports.payload_hash(
+        reports.gather(connection, 2020)[1])
+    assert reports.payload_hash(payloads[1]) != reports.payload_hash(
+        reports.gather(connection, 2021)[1])
+
+
+def _book(connection, contract_id, day, amount):
+    """Book a payment of `amount` into the account of the contract."""
+    account = connection._data.contract_rows(id=contract_id)[0].account
+    with piecash.open_book(connection._data._gnucash_file, readonly=False,
+                           open_if_lock=True) as book:
+        piecash.Transaction(
+            currency=book.default_currency,
+            description="Einzahlung {}".format(amount),
+            post_date=datetime.date.fromisoformat(day),
+            splits=[piecash.Split(account=book.accounts.get(guid=account),
+                                  value=-Decimal(amount)),
+                    piecash.Split(account=book.accounts.get(
+                        guid=connection._data._account_guids["ausgleich"]),
+                        value=Decimal(amount))])
+        book.save()
+
+
+def test_gather_balance(connection):
+    _book(connection, 1, "2020-03-01", 1000)
+    payload = reports.gather(connection, 2020)[1]
+    assert payload["contracts"][0]["balance"] == "1000"
+    # Bookings after the year do not change the report.
+    _book(connection, 1, "2021-02-01", 50)
+    assert reports.gather(connection, 2020)[1] == payload
+    assert reports.payload_hash(reports.gather(connection, 2020)[1]) == (
+        reports.payload_hash(payload))
+    assert reports.gather(connection, 2021)[1]["contracts"][0][
+        "balance"] == "1050"
+
+
+def test_generate_report(connection, tmp_path):
+    directory = tmp_path / "reports"
+    calls = []
+    result = connection.generate_report(
+        str(directory), year=2020, workers=2,
+        progress=lambda *args: calls.append(args))
+    assert result.rendered == [1, 2]
+    assert [call[:2] for call in calls] == [(1, 2), (2, 2)]
+    assert {call[2] for call in calls} == {1, 2}
+    text = (directory / "report_1.txt").read_text()
+    assert "Dagobert Duck" in text
+    assert "4.99" in text and "36.60" in text
+    assert "Keine Verträge." in (directory / "report_2.txt").read_text()
+
+    # Nothing changed, nothing is rendered.
+    result = connection.generate_report(str(directory), year=2020, workers=1)
+    assert result.rendered == []
+    assert (directory / "report_1.txt").read_text() == text
+
+    connection._data.update_contract(2, interest=5.0)
+    result = connection.generate_report(str(directory), year=2020, workers=1)
+    assert result.rendered == [1]
+    assert "18.30" in (directory / "report_1.txt").read_text()
+
+    # Another directory gets the texts from the cache.
+    other = tmp_path / "other"
+    result = connection.generate_report(str(other), year=2020, workers=1)
+    assert result.rendered == []
+    assert (other / "report_1.txt").read_text() == (
+        directory / "report_1.txt").read_text()
+
+
+def test_generate_account_statements(connection, tmp_path):
+    filename = connection._data._gnucash_file
+    account = connection._data.contract_rows(id=1)[0].account
+    with piecash.open_book(filename, readonly=False,
+                           open_if_lock=True) as book:
+        for day, amount in (("2019-12-30", 600), ("2020-01-02", 400),
+                            ("2021-01-02", 5)):
+            piecash.Transaction(
+                currency=book.default_currency,
+                description="Einzahlung {}".format(amount),
+                post_date=datetime.date.fromisoformat(day),
+                splits=[piecash.Split(account=book.accounts.get(guid=account),
+                                      value=-Decimal(amount)),
+                        piecash.Split(account=book.accounts.get(
+                            guid=connection._data._account_guids[
+                                "ausgleich"]), value=Decimal(amount))])
+        book.save()
+
+    result = connection.generate_account_statements(start="2020-01-01")
+    directory = os.path.splitext(filename)[0] + "-statements"
+    assert result.files[1] == os.path.join(directory, "statement_1.txt")
+    assert result.rendered == [1, 2]
+    text = open(result.files[1]).read()
+    assert "Kontoauszug 2020-01-01 bis 2020-12-31" in text
+    assert "Anfangssaldo                                    600.00" in text
+    assert "2020-01-02  Einzahlung 400" in text
+    assert "Endsaldo                                      1'000.00" in text
+    assert "Einzahlung 5" not in text
+    assert connection.generate_account_statements(
+        start="2020-01-01").rendered == []
+
+
+def test_report_cache(tmp_path):
+    cache = reports.ReportCache(str(tmp_path), max_bytes=10, max_age=100)
+    assert cache.get("a") is None
+    cache.put("a", "12345")
+    cache.put("b", "12345")
+    assert cache.evict() == 0
+    now = time.time()
+    os.utime(tmp_path / "a.txt", (now - 10, now - 10))
+    cache.put("c", "12345")
+    # Too large: the least recently used entry is removed.
+    assert cache.evict() == 1
+    assert cache.get("a") is None
+    assert cache.get("b") == "12345"
+    # Too old.
+    assert cache.evict(now=now + 1000) == 2
+    assert os.listdir(str(tmp_path)) == []
+
+
+def _slow_render(payload):
+    time.sleep(0.2)
+    return str(payload)
+
+
+def test_write_reports_cancel(tmp_path, monkeypatch):
+    monkeypatch.setitem(reports.TEMPLATES, "slow", (_slow_render, 1))
+
+    def progress(done, total, creditor_id):
+        raise concurrent.futures.CancelledError()
+
+    started = time.monotonic()
+    with pytest.raises(concurrent.futures.CancelledError):
+        reports.write_reports({number: {"n": number} for number in range(40)},
+                              str(tmp_path), kind="slow", workers=2,
+                              progress=progress)
+    # The queued renders were not waited for.
+    assert time.monotonic() - started < 2
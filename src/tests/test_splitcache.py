@@ -0,0 +1,76 @@
+#!/usr/bin/env pytest
+"""Test the splitcache module.
+
+Call e.g. with `pytest` (for Python3).
+"""
+
+import datetime
+from decimal import Decimal
+
+import piecash
+import pytest
+
+from dkcashlib import common
+from dkcashlib import dkhandle
+from dkcashlib import splitcache
+
+
+@pytest.fixture
+def connection(tmp_path):
+    conn = dkhandle.Connection(gnucash_file=str(tmp_path / "test.gnucash"))
+    creditor = common.Creditor("Dagobert Duck", ["Geldspeicher 1"],
+                               connection=conn)
+    for contract_id in (1, 2):
+        conn._data.add_contract(contract_id, creditor.creditor_id,
+                                date="2020-01-01", amount=100.0, interest=1.0,
+                                period_end=datetime.date(2030, 1, 1))
+    return conn
+
+
+def _transfer(filename, account, counter_account, amount):
+    """Book `amount` from `counter_account` to `account` in GnuCash."""
+    with piecash.open_book(filename, readonly=False,
+                           open_if_lock=True) as book:
+        piecash.Transaction(
+            currency=book.default_currency, description="Transfer",
+            num=str(amount), post_date=datetime.date(2020, 1, 2),
+            splits=[piecash.Split(account=book.accounts.get(guid=account),
+                                  value=-amount),
+                    piecash.Split(
+                        account=book.accounts.get(guid=counter_account),
+                        value=amount)])
+        book.save()
+
+
+def test_split_cache(connection):
+    filename = connection._data._gnucash_file
+    accounts = {int(row.id): row.account
+                for row in connection._data.contract_rows()}
+    ausgleich = connection._data._account_guids["ausgleich"]
+    cache = connection.split_cache()
+    assert cache.directory == filename + ".splitcache"
+    assert cache.balances() == {accounts[1]: 0, accounts[2]: 0}
+    assert not cache.refresh()
+
+    _transfer(filename, accounts[1], ausgleich, Decimal("1000"))
+    _transfer(filename, accounts[2], ausgleich, Decimal("365.5"))
+    assert cache.refresh()
+    columns = cache.columns()
+    assert isinstance(columns["value"], splitcache.np.memmap)
+    assert sorted(columns["value"]) == [-100000, -36550]
+    assert cache.balances() == {accounts[1]: -100000, accounts[2]: -36550}
+    assert cache.balances(until=datetime.date(2020, 1, 2)) == {
+        accounts[1]: 0, accounts[2]: 0}
+
+    # A new cache object reuses the files.
+    other = splitcache.SplitCache(connection._data)
+    assert not other.refresh()
+    assert other.balances() == cache.balances()
+
+    # Deleted splits lead to a rebuild.
+    with piecash.open_book(filename, readonly=False,
+                           open_if_lock=True) as book:
+        book.delete(book.transactions(num="1000"))
+        book.save()
+    assert cache.refresh()
+    assert cache.balances() == {accounts[1]: 0, accounts[2]: -36550}